@@ -23,6 +23,8 @@ from multiprocessing import cpu_count
 
 from ckx_tools.common import wide_log
 
+from ckx_tools.execution.event_log import get_event_log_fd
+
 import ckx_tools.execution.job_server as job_server
 
 
@@ -39,6 +41,15 @@ def add_context_args(parser):
         help='The name of a config profile to use (default: active profile)')
 
 
+def event_log_type(value):
+    """Argument type of the target of an event log, a path or `fd:N`."""
+    try:
+        get_event_log_fd(value)
+    except ValueError as exc:
+        raise argparse.ArgumentTypeError(str(exc))
+    return value
+
+
 def add_workspace_arg(parser):
     """Add common workspace arg to an argparse parser.
 
@@ -75,8 +86,8 @@ def add_cmake_and_make_and_catkin_make_args(parser):
 
     add = parser.add_mutually_exclusive_group().add_argument
     add('--env-cache', dest='use_env_cache', default=None, action='store_true',
-        help='Re-use cached environment variables when re-sourcing a resultspace that has been '
-             'loaded at a different stage in the task.')
+        help='Re-use the environment variables cached in the profile metadata when re-sourcing a resultspace '
+             'whose setup files and base environment haven\'t changed. This is the default.')
     add('--no-env-cache', dest='use_env_cache', default=None, action='store_false',
         help='Don\'t cache environment variables when re-sourcing the same resultspace.')
 
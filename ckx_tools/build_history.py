@@ -0,0 +1,377 @@
+# Copyright 2016 Open Source Robotics Foundation, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Persistent history of the jobs and stages run by each invocation of a verb.
+
+Every build appends one compact JSON record to a history file in the log
+space, holding the duration, return code and input fingerprint of each job
+and the duration and return code of each of its stages. The history is used
+to report trends, the slowest packages and regressions.
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import time
+
+from .common import format_time_delta
+from .common import mkdir_p
+
+from .terminal_color import ColorMapper
+
+mapper = ColorMapper()
+clr = mapper.clr
+
+HISTORY_FILE_SUFFIX = '_history.jsonl'
+
+# Bump this whenever the layout of the history records changes
+HISTORY_VERSION = 1
+
+# When the history file grows larger than this, the older half is dropped
+MAX_HISTORY_SIZE = 8 * 1024 * 1024
+
+# A job is reported as a regression if its last duration exceeds the median
+# of its previous durations by this factor and by at least this many seconds
+REGRESSION_FACTOR = 1.25
+REGRESSION_MIN_DELTA = 1.0
+
+# The states of jobs in a history record
+JOB_SUCCEEDED = 'succeeded'
+JOB_FAILED = 'failed'
+JOB_ABANDONED = 'abandoned'
+JOB_UP_TO_DATE = 'up-to-date'
+
+
+def get_history_path(log_path, verb):
+    """Get the path to the history file of a verb in a log space."""
+    return os.path.join(log_path, verb + HISTORY_FILE_SUFFIX)
+
+
+class HistoryRecorder(object):
+
+    """Collects a history record from the events generated by the executor.
+
+    The recorder is handed every event consumed by a
+    :py:class:`ckx_tools.execution.controllers.ConsoleStatusController`.
+    """
+
+    subscribed_event_ids = ['STARTED_JOB', 'STARTED_STAGE', 'FINISHED_STAGE', 'FINISHED_JOB', 'ABANDONED_JOB']
+
+    def __init__(self, verb, fingerprints=None, up_to_date_jobs=None, max_jobs=None, start_time=None):
+        """
+        :param verb: The verb whose jobs are recorded
+        :param fingerprints: Map from job id to the digest of the inputs of the job
+        :param up_to_date_jobs: Jobs which were skipped because they were already up to date
+        :param max_jobs: The number of jobs which could run at the same time
+        :param start_time: The time at which the verb was started
+        """
+        self.verb = verb
+        self.fingerprints = fingerprints or {}
+        self.start_time = time.time() if start_time is None else start_time
+        self.max_jobs = max_jobs
+
+        self.jobs = {}
+        self.stage_start_times = {}
+
+        for jid in (up_to_date_jobs or []):
+            self.jobs[jid] = {'status': JOB_UP_TO_DATE}
+            self._add_fingerprint(jid)
+
+    def _add_fingerprint(self, jid):
+        if self.fingerprints.get(jid) is not None:
+            self.jobs[jid]['fingerprint'] = self.fingerprints[jid]
+
+    def handle_event(self, event):
+        eid = event.event_id
+        data = event.data
+
+        if 'STARTED_JOB' == eid:
+            self.jobs[data['job_id']] = {'start': event.time, 'stages': []}
+            self._add_fingerprint(data['job_id'])
+
+        elif 'STARTED_STAGE' == eid:
+            self.stage_start_times[data['job_id']] = event.time
+
+        elif 'FINISHED_STAGE' == eid:
+            job = self.jobs.get(data['job_id'])
+            start_time = self.stage_start_times.pop(data['job_id'], None)
+            if job is not None and start_time is not None:
+                job['stages'].append([data['stage_label'], round(event.time - start_time, 3), data['retcode']])
+
+        elif 'FINISHED_JOB' == eid:
+            job = self.jobs.get(data['job_id'])
+            if job is not None:
+                job['status'] = JOB_SUCCEEDED if data['succeeded'] else JOB_FAILED
+                job['duration'] = round(event.time - job.pop('start'), 3)
+                job['retcode'] = ([s[2] for s in job['stages'] if s[2] != 0] or [0])[0]
+
+        elif 'ABANDONED_JOB' == eid:
+            self.jobs[data['job_id']] = {'status': JOB_ABANDONED, 'reason': data['reason']}
+
+    def get_record(self):
+        """Get the history record of the jobs which have been recorded so far."""
+        return {
+            'version': HISTORY_VERSION,
+            'verb': self.verb,
+            'start': round(self.start_time, 3),
+            'duration': round(time.time() - self.start_time, 3),
+            'max_jobs': self.max_jobs,
+            'jobs': self.jobs,
+        }
+
+
+def append_history(log_path, record):
+    """Append a record to the history of its verb.
+
+    :param log_path: The log space in which the history is stored
+    :param record: A record from :py:meth:`HistoryRecorder.get_record`
+    """
+    history_path = get_history_path(log_path, record['verb'])
+    mkdir_p(log_path)
+
+    with open(history_path, 'a') as history_file:
+        history_file.write(json.dumps(record, sort_keys=True, separators=(',', ':')) + '\n')
+
+    # Keep the history from growing without bounds
+    if os.path.getsize(history_path) > MAX_HISTORY_SIZE:
+        with open(history_path) as history_file:
+            lines = history_file.readlines()
+        tmp_path = history_path + '.tmp'
+        with open(tmp_path, 'w') as history_file:
+            history_file.writelines(lines[len(lines) // 2:])
+        os.rename(tmp_path, history_path)
+
+
+def load_history(log_path, verb):
+    """Load the history records of a verb, oldest first.
+
+    Records which can't be read or which have a different layout are skipped.
+
+    :param log_path: The log space in which the history is stored
+    :param verb: The verb whose history is loaded
+    :rtype: list
+    """
+    history_path = get_history_path(log_path, verb)
+    if not os.path.exists(history_path):
+        return []
+
+    records = []
+    with open(history_path) as history_file:
+        for line in history_file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get('version') == HISTORY_VERSION:
+                records.append(record)
+
+    return records
+
+
+def _median(values):
+    values = sorted(values)
+    if len(values) == 0:
+        return None
+    mid = len(values) // 2
+    if len(values) % 2 == 1:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
+
+
+def _format_date(timestamp):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+
+
+def _format_change(value, reference):
+    if not reference:
+        return ''
+    return '{:+.0f}%'.format(100.0 * (value - reference) / reference)
+
+
+def get_job_durations(records, jid):
+    """Get the durations of the successful runs of a job, oldest first."""
+    return [
+        r['jobs'][jid]['duration'] for r in records
+        if r['jobs'].get(jid, {}).get('status') == JOB_SUCCEEDED]
+
+
+def get_median_job_durations(records, n_records=10):
+    """Get the median duration of each job over its recent successful runs.
+
+    :param records: History records from :py:func:`load_history`, oldest first
+    :param n_records: The number of most recent records to consider
+    :returns: Map from job id to median duration in seconds
+    :rtype: dict
+    """
+    durations = {}
+    for record in records[-n_records:]:
+        for jid, job in record['jobs'].items():
+            if job.get('status') == JOB_SUCCEEDED:
+                durations.setdefault(jid, []).append(job['duration'])
+
+    return dict([(jid, _median(values)) for jid, values in durations.items()])
+
+
+def get_stage_durations(records, n_records=10):
+    """Get the median duration of each stage of each job over its recent successful runs.
+
+    :param records: History records from :py:func:`load_history`, oldest first
+    :param n_records: The number of most recent records to consider
+    :returns: Map from job id to a map from stage label to median duration
+    :rtype: dict
+    """
+    durations = {}
+    for record in records[-n_records:]:
+        for jid, job in record['jobs'].items():
+            if job.get('status') != JOB_SUCCEEDED:
+                continue
+            job_durations = durations.setdefault(jid, {})
+            for label, duration, retcode in job['stages']:
+                job_durations.setdefault(label, []).append(duration)
+
+    return dict([
+        (jid, dict([(label, _median(values)) for label, values in job_durations.items()]))
+        for jid, job_durations in durations.items()])
+
+
+def get_slowest_jobs(records, count):
+    """Get the jobs with the longest median duration of their successful runs.
+
+    :returns: list of (job id, median duration) tuples, slowest first
+    """
+    jids = set()
+    for record in records:
+        jids.update(record['jobs'].keys())
+
+    medians = [(jid, _median(get_job_durations(records, jid))) for jid in jids]
+    medians = [(jid, m) for jid, m in medians if m is not None]
+    return sorted(medians, key=lambda jm: (-jm[1], jm[0]))[:count]
+
+
+def get_regressions(records):
+    """Find the jobs whose last successful run was significantly slower than the runs before.
+
+    :returns: list of (job id, last duration, median previous duration,
+        whether the inputs changed since the previous run) tuples
+    """
+    regressions = []
+    if len(records) == 0:
+        return regressions
+
+    for jid, job in sorted(records[-1]['jobs'].items()):
+        if job.get('status') != JOB_SUCCEEDED:
+            continue
+        previous = get_job_durations(records[:-1], jid)
+        if len(previous) < 2:
+            continue
+        reference = _median(previous)
+        if job['duration'] > REGRESSION_FACTOR * reference and job['duration'] - reference > REGRESSION_MIN_DELTA:
+            last_fingerprints = [
+                r['jobs'][jid].get('fingerprint') for r in records[:-1]
+                if r['jobs'].get(jid, {}).get('status') in (JOB_SUCCEEDED, JOB_UP_TO_DATE)]
+            inputs_changed = (
+                len(last_fingerprints) == 0 or
+                job.get('fingerprint') is None or
+                last_fingerprints[-1] != job.get('fingerprint'))
+            regressions.append((jid, job['duration'], reference, inputs_changed))
+
+    return regressions
+
+
+def format_history_report(records, jid=None, n_records=10, n_slowest=10):
+    """Format a report of the history of a verb, or of a single job.
+
+    :param records: History records from :py:func:`load_history`, oldest first
+    :param jid: If given, report the history of this job only
+    :param n_records: The number of most recent records to list
+    :param n_slowest: The number of slowest jobs to list
+    :returns: colorized lines of the report
+    :rtype: list
+    """
+    if len(records) == 0:
+        return ['No history has been recorded yet.']
+
+    if jid is not None:
+        return _format_job_history_report(records, jid, n_records)
+
+    lines = [clr('@!Recent runs:@|')]
+    previous_duration = None
+    for record in records[-n_records:]:
+        jobs = record['jobs'].values()
+        counts = dict([(s, len([j for j in jobs if j.get('status') == s]))
+                       for s in (JOB_SUCCEEDED, JOB_FAILED, JOB_ABANDONED, JOB_UP_TO_DATE)])
+        lines.append('  {}  {:>24} {:>6}  {} built, {} up to date, {} failed, {} abandoned'.format(
+            _format_date(record['start']),
+            format_time_delta(record['duration']),
+            _format_change(record['duration'], previous_duration),
+            counts[JOB_SUCCEEDED], counts[JOB_UP_TO_DATE], counts[JOB_FAILED], counts[JOB_ABANDONED]))
+        previous_duration = record['duration']
+
+    slowest = get_slowest_jobs(records, n_slowest)
+    if len(slowest) > 0:
+        total = sum([d for _, d in get_slowest_jobs(records, None)])
+        lines.append(clr('@!Slowest (median of successful runs):@|'))
+        for slow_jid, duration in slowest:
+            lines.append(clr('  @{cf}{:<32}@| {:>24}  {:>4.0f}%').format(
+                slow_jid, format_time_delta(duration), 100.0 * duration / total if total else 0.0))
+
+    regressions = get_regressions(records)
+    lines.append(clr('@!Regressions in the last run:@|'))
+    if len(regressions) == 0:
+        lines.append('  None')
+    for reg_jid, duration, reference, inputs_changed in regressions:
+        lines.append(clr('  @{yf}{:<32}@| {} instead of {} ({}, {})').format(
+            reg_jid,
+            format_time_delta(duration),
+            format_time_delta(reference),
+            _format_change(duration, reference),
+            'inputs changed' if inputs_changed else 'inputs unchanged'))
+
+    return lines
+
+
+def _format_job_history_report(records, jid, n_records):
+    job_records = [(r, r['jobs'][jid]) for r in records if jid in r['jobs']]
+    if len(job_records) == 0:
+        return ['No history has been recorded for `{}` yet.'.format(jid)]
+
+    lines = [clr('@!Recent runs of @{cf}{}@|@!:@|').format(jid)]
+    previous_duration = None
+    for record, job in job_records[-n_records:]:
+        if 'duration' in job:
+            stages = ', '.join(['{} {:.1f}s{}'.format(label, duration, '' if retcode == 0 else ' (%s)' % retcode)
+                                for label, duration, retcode in job['stages']])
+            lines.append('  {}  {:<10} {:>24} {:>6}  {}  [{}]'.format(
+                _format_date(record['start']),
+                job['status'],
+                format_time_delta(job['duration']),
+                _format_change(job['duration'], previous_duration),
+                (job.get('fingerprint') or '-')[:8],
+                stages))
+            if job['status'] == JOB_SUCCEEDED:
+                previous_duration = job['duration']
+        else:
+            lines.append('  {}  {:<10} {:>24} {:>6}  {}'.format(
+                _format_date(record['start']), job['status'], '', '', (job.get('fingerprint') or '-')[:8]))
+
+    durations = get_job_durations(records, jid)
+    if len(durations) > 0:
+        lines.append(clr('@!Trend:@| last {}, median {}, best {} over {} successful runs').format(
+            format_time_delta(durations[-1]),
+            format_time_delta(_median(durations)),
+            format_time_delta(min(durations)),
+            len(durations)))
+
+    return lines
@@ -18,6 +18,7 @@ import datetime
 import errno
 import os
 import re
+import signal
 import sys
 
 import trollius as asyncio
@@ -501,13 +502,59 @@ def terminal_width_linux():
     return width
 
 
+# The terminal width, while it is cached, see :py:func:`cache_terminal_width`
+__cached_terminal_width = None
+__terminal_width_is_cached = False
+
+
+def __invalidate_terminal_width(signum=None, frame=None, previous_handler=None):
+    global __cached_terminal_width
+    __cached_terminal_width = None
+    if callable(previous_handler):
+        previous_handler(signum, frame)
+
+
+def cache_terminal_width():
+    """Cache the terminal width until the terminal is resized
+
+    Querying the terminal width takes an ioctl, so it is cached and only
+    queried again after a SIGWINCH signal. This is only possible where the
+    signal exists and when called from the main thread, otherwise the width
+    is queried every time, as before.
+
+    :returns: True if the terminal width is cached
+    :rtype: bool
+    """
+    global __terminal_width_is_cached
+    if __terminal_width_is_cached:
+        return True
+    if not hasattr(signal, 'SIGWINCH'):
+        return False
+    try:
+        previous_handler = signal.getsignal(signal.SIGWINCH)
+        signal.signal(
+            signal.SIGWINCH,
+            lambda signum, frame: __invalidate_terminal_width(signum, frame, previous_handler))
+    except ValueError:
+        # Signal handlers can only be installed from the main thread
+        return False
+    __terminal_width_is_cached = True
+    return True
+
+
 def terminal_width():
     """Returns the estimated width of the terminal"""
+    global __cached_terminal_width
+    if __cached_terminal_width is not None:
+        return __cached_terminal_width
     try:
-        return terminal_width_windows() if os.name == 'nt' else terminal_width_linux()
+        width = terminal_width_windows() if os.name == 'nt' else terminal_width_linux()
     except ValueError:
         # Failed to get the width, use the default 80
-        return __default_terminal_width
+        width = __default_terminal_width
+    if __terminal_width_is_cached:
+        __cached_terminal_width = width
+    return width
 
 
 _ansi_escape = re.compile(r'\x1b[^m]*m')
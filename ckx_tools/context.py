@@ -30,6 +30,7 @@ from .common import terminal_width
 
 from .metadata import find_enclosing_workspace
 
+from .resultspace import get_env_cache_path
 from .resultspace import get_resultspace_environment
 
 from .terminal_color import ColorMapper
@@ -56,11 +57,19 @@ class Context(object):
     DEFAULT_BUILD_SPACE = 'build'
     DEFAULT_DEVEL_SPACE = 'devel'
     DEFAULT_INSTALL_SPACE = 'install'
+    DEFAULT_LOG_HISTORY = 10
+    DEFAULT_LOG_FSYNC = 'never'
+    DEFAULT_LOG_BUFFER_SIZE = 4
+    LOG_FSYNC_POLICIES = ['never', 'close', 'always']
 
     STORED_KEYS = [
         'underlays',
         'source_space',
         'log_space',
+        'log_history',
+        'compress_logs',
+        'log_fsync',
+        'log_buffer_size',
         'build_space',
         'devel_space',
         'install_space',
@@ -206,6 +215,10 @@ class Context(object):
         source_space=None,
         doc_space=None,
         log_space=None,
+        log_history=None,
+        compress_logs=False,
+        log_fsync=None,
+        log_buffer_size=None,
         build_space=None,
         devel_space=None,
         install_space=None,
@@ -216,7 +229,7 @@ class Context(object):
         make_args=None,
         jobs_args=None,
         use_internal_make_jobserver=True,
-        use_env_cache=False,
+        use_env_cache=True,
         catkin_make_args=None,
         whitelist=None,
         blacklist=None,
@@ -238,6 +251,14 @@ class Context(object):
         :type doc_space: str
         :param log_space: relative location of log space, defaults to '<workspace>/logs'
         :type log_space: str
+        :param log_history: number of previous logfiles kept for each verb and stage of a package, defaults to 10
+        :type log_history: int
+        :param compress_logs: logfiles are written compressed, with an index for reading them back in parts, if True
+        :type compress_logs: bool
+        :param log_fsync: when logfiles are synced to the disk, 'never', on 'close' or 'always', defaults to 'never'
+        :type log_fsync: str
+        :param log_buffer_size: MiB of stdout or stderr of each stage which are kept in memory, defaults to 4
+        :type log_buffer_size: int
         :param build_space: relativetarget location of build space, defaults to '<workspace>/build'
         :type build_space: str
         :param devel_space: relative target location of devel space, defaults to '<workspace>/devel'
@@ -259,6 +280,7 @@ class Context(object):
         :param use_internal_make_jobserver: true if this configuration should use an internal make jobserv
         :type use_internal_make_jobserver: bool
         :param use_env_cache: true if this configuration should cache job environments loaded from resultspaces
+            in the profile metadata, to be re-used until their setup files change
         :type use_env_cache: bool
         :param catkin_make_args: extra make arguments to be passed to make for each catkin package
         :type catkin_make_args: list
@@ -291,6 +313,10 @@ class Context(object):
         # might be to situate these on the current directory instead, just like the regular parallel build flow
         self.build_root = self.profile if self.profile != metadata.DEFAULT_PROFILE_NAME else ''
         self.log_space = os.path.join(self.build_root, Context.DEFAULT_LOG_SPACE) if log_space is None else log_space
+        self.log_history = Context.DEFAULT_LOG_HISTORY if log_history is None else log_history
+        self.compress_logs = compress_logs
+        self.log_fsync = Context.DEFAULT_LOG_FSYNC if log_fsync is None else log_fsync
+        self.log_buffer_size = Context.DEFAULT_LOG_BUFFER_SIZE if log_buffer_size is None else log_buffer_size
         self.doc_space = os.path.join(self.build_root, Context.DEFAULT_DOC_SPACE) if doc_space is None else doc_space
         self.build_space = os.path.join(self.build_root, Context.DEFAULT_BUILD_SPACE) if build_space is None else build_space
         self.devel_space = os.path.join(self.build_root, Context.DEFAULT_DEVEL_SPACE) if devel_space is None else devel_space
@@ -340,9 +366,11 @@ class Context(object):
 
         # Load and update mirror of 'sticky' CMake information
         if self.install:
-            sticky_env = get_resultspace_environment(self.install_space_abs, quiet=True)
+            sticky_env = get_resultspace_environment(
+                self.install_space_abs, quiet=True, cache_path=self.env_cache_path())
         else:
-            sticky_env = get_resultspace_environment(self.devel_space_abs, quiet=True)
+            sticky_env = get_resultspace_environment(
+                self.devel_space_abs, quiet=True, cache_path=self.env_cache_path())
 
         self.cached_cmake_prefix_path = ''
         if 'CMAKE_PREFIX_PATH' in sticky_env:
@@ -357,7 +385,8 @@ class Context(object):
         if self.underlays:
             for underlay_path in self.underlays.split(";"):
                 try:
-                    extended_env = get_resultspace_environment(underlay_path, quiet=False)
+                    extended_env = get_resultspace_environment(
+                        underlay_path, quiet=False, cache_path=self.env_cache_path())
                     underlay_cmake_prefix_path = set(extended_env.get('CMAKE_PREFIX_PATH', '').split(';'))
                     underlays_unique = underlays_unique.union(underlay_cmake_prefix_path)
                 except IOError as e:
@@ -463,6 +492,10 @@ class Context(object):
                 clr("@{cf}Additional catkin Make Args:@| @{yf}{catkin_make_args}@|"),
                 clr("@{cf}Internal Make Job Server:@|    @{yf}{_Context__use_internal_make_jobserver}@|"),
                 clr("@{cf}Cache Job Environments:@|      @{yf}{_Context__use_env_cache}@|"),
+                clr("@{cf}Log History:@|                 @{yf}{_Context__log_history}@|"),
+                clr("@{cf}Compress Logs:@|               @{yf}{_Context__compress_logs}@|"),
+                clr("@{cf}Log Fsync:@|                   @{yf}{_Context__log_fsync}@|"),
+                clr("@{cf}Log Buffer Size (MiB):@|       @{yf}{_Context__log_buffer_size}@|"),
             ],
             [
                 clr("@{cf}Whitelisted Packages:@|        @{yf}{whitelisted_packages}@|"),
@@ -792,6 +825,53 @@ class Context(object):
             raise RuntimeError("Setting of context members is not allowed while locked.")
         self.__use_internal_make_jobserver = value
 
+    @property
+    def log_history(self):
+        return self.__log_history
+
+    @log_history.setter
+    def log_history(self, value):
+        if self.__locked:
+            raise RuntimeError("Setting of context members is not allowed while locked.")
+        if int(value) < 1:
+            raise ValueError("The log history must keep at least one logfile, not {}.".format(value))
+        self.__log_history = int(value)
+
+    @property
+    def compress_logs(self):
+        return self.__compress_logs
+
+    @compress_logs.setter
+    def compress_logs(self, value):
+        if self.__locked:
+            raise RuntimeError("Setting of context members is not allowed while locked.")
+        self.__compress_logs = value
+
+    @property
+    def log_fsync(self):
+        return self.__log_fsync
+
+    @log_fsync.setter
+    def log_fsync(self, value):
+        if self.__locked:
+            raise RuntimeError("Setting of context members is not allowed while locked.")
+        if value not in Context.LOG_FSYNC_POLICIES:
+            raise ValueError("The log fsync policy must be one of {}, not '{}'.".format(
+                ', '.join(Context.LOG_FSYNC_POLICIES), value))
+        self.__log_fsync = value
+
+    @property
+    def log_buffer_size(self):
+        return self.__log_buffer_size
+
+    @log_buffer_size.setter
+    def log_buffer_size(self, value):
+        if self.__locked:
+            raise RuntimeError("Setting of context members is not allowed while locked.")
+        if int(value) < 1:
+            raise ValueError("The log buffer size must be at least 1 MiB, not {}.".format(value))
+        self.__log_buffer_size = int(value)
+
     @property
     def use_env_cache(self):
         return self.__use_env_cache
@@ -919,6 +999,18 @@ class Context(object):
         profile_path, _ = metadata.get_paths(self.workspace, self.profile)
         return profile_path
 
+    def env_cache_path(self):
+        """Get the path to the directory in which resultspace environments are cached for this profile.
+
+        :returns: the path, or None if environments shouldn't be cached across invocations
+        """
+        if not self.use_env_cache or not self.workspace:
+            return None
+        metadata_path = self.metadata_path()
+        if not os.path.isdir(metadata_path):
+            return None
+        return get_env_cache_path(metadata_path)
+
     def package_metadata_path(self, package=None):
         """Get the workspace and profile-specific metadata path for a package"""
         profile_path, _ = metadata.get_paths(self.workspace, self.profile)
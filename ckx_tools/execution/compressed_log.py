@@ -0,0 +1,189 @@
+# Copyright 2016 Open Source Robotics Foundation, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compressed logfiles which can be read from any block.
+
+A compressed logfile is a sequence of independently compressed gzip members,
+each holding a block of output, so it can still be read with ``zcat``. A
+small block index next to the logfile records the offset, compressed size,
+uncompressed size and number of line breaks of each block, so that the tail
+or any other range of a log can be read without decompressing the blocks
+before it.
+"""
+
+import gzip
+import os
+import zlib
+
+# The suffix of compressed logfiles and of their block indices
+COMPRESSED_LOG_SUFFIX = '.gz'
+BLOCK_INDEX_SUFFIX = '.idx'
+
+# The number of uncompressed bytes which are collected before a block is written
+BLOCK_SIZE = 64 * 1024
+
+COMPRESSION_LEVEL = 6
+
+# Window bits which make zlib read and write gzip members
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def is_compressed_log(path):
+    return path.endswith(COMPRESSED_LOG_SUFFIX)
+
+
+class CompressedLogWriter(object):
+
+    """A file-like object which writes a compressed logfile and its block index."""
+
+    def __init__(self, path, block_size=None):
+        self.path = path
+        self.index_path = path + BLOCK_INDEX_SUFFIX
+        self.block_size = BLOCK_SIZE if block_size is None else block_size
+
+        self.log_file = open(self.path, 'wb')
+        self.index_file = open(self.index_path, 'w')
+        self.offset = 0
+
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        if len(data) == 0:
+            return
+        self.chunks.append(data)
+        self.size += len(data)
+        if self.size >= self.block_size:
+            self._write_block()
+
+    def _write_block(self):
+        if self.size == 0:
+            return
+        data = b''.join(self.chunks)
+        self.chunks = []
+        self.size = 0
+
+        compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, GZIP_WBITS)
+        block = compressor.compress(data) + compressor.flush()
+        self.log_file.write(block)
+        self.index_file.write('{} {} {} {}\n'.format(self.offset, len(block), len(data), data.count(b'\n')))
+        self.offset += len(block)
+
+    def flush(self):
+        """Write the buffered data as a block, so the logfile can be read up to here."""
+        self._write_block()
+        self.log_file.flush()
+        self.index_file.flush()
+
+    def fsync(self):
+        """Sync the logfile and its block index to the disk."""
+        os.fsync(self.log_file.fileno())
+        os.fsync(self.index_file.fileno())
+
+    def close(self):
+        self.flush()
+        self.log_file.close()
+        self.index_file.close()
+
+
+def load_block_index(path):
+    """Load the block index of a compressed logfile.
+
+    :returns: list of (offset, compressed size, size, number of line breaks)
+        tuples, or None if the logfile has no readable index
+    """
+    try:
+        with open(path + BLOCK_INDEX_SUFFIX) as index_file:
+            return [tuple(int(v) for v in line.split()) for line in index_file]
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def iter_log(path, chunk_size=BLOCK_SIZE):
+    """Iterate over the uncompressed contents of a plain or compressed logfile in chunks.
+
+    :rtype: generator of bytes
+    """
+    if not is_compressed_log(path):
+        opener = open
+    elif load_block_index(path) is not None:
+        for data in iter_log_blocks(path, 0):
+            yield data
+        return
+    else:
+        # Logfiles of interrupted stages may lack a complete index
+        opener = gzip.open
+
+    with opener(path, 'rb') as log_file:
+        while True:
+            data = log_file.read(chunk_size)
+            if len(data) == 0:
+                break
+            yield data
+
+
+def iter_log_blocks(path, first_block, block_index=None):
+    """Iterate over the uncompressed blocks of a compressed logfile, starting at a given block."""
+    block_index = block_index or load_block_index(path) or []
+    if first_block >= len(block_index):
+        return
+    with open(path, 'rb') as log_file:
+        log_file.seek(block_index[first_block][0])
+        for offset, compressed_size, size, n_breaks in block_index[first_block:]:
+            yield zlib.decompress(log_file.read(compressed_size), GZIP_WBITS)
+
+
+def read_log(path):
+    """Read the uncompressed contents of a plain or compressed logfile."""
+    return b''.join(iter_log(path))
+
+
+def tail_log(path, n_lines):
+    """Read the last lines of a plain or compressed logfile.
+
+    Only the blocks which hold the last `n_lines` lines are read.
+
+    :rtype: list of bytes
+    """
+    if n_lines <= 0:
+        return []
+
+    block_index = load_block_index(path) if is_compressed_log(path) else None
+    if is_compressed_log(path) and block_index is None:
+        return read_log(path).splitlines(True)[-n_lines:]
+
+    if block_index is not None:
+        # Find the first block which is needed to hold the last n + 1 line breaks
+        first_block = len(block_index)
+        n_breaks = 0
+        while first_block > 0 and n_breaks <= n_lines:
+            first_block -= 1
+            n_breaks += block_index[first_block][3]
+        data = b''.join(iter_log_blocks(path, first_block, block_index))
+        return data.splitlines(True)[-n_lines:]
+
+    # Read plain logfiles backwards until enough line breaks have been found
+    chunks = []
+    n_breaks = 0
+    with open(path, 'rb') as log_file:
+        log_file.seek(0, os.SEEK_END)
+        position = log_file.tell()
+        while position > 0 and n_breaks <= n_lines:
+            size = min(BLOCK_SIZE, position)
+            position -= size
+            log_file.seek(position)
+            chunk = log_file.read(size)
+            n_breaks += chunk.count(b'\n')
+            chunks.append(chunk)
+    return b''.join(reversed(chunks)).splitlines(True)[-n_lines:]
@@ -0,0 +1,126 @@
+# Copyright 2016 Open Source Robotics Foundation, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Locks which only exclude each other when the paths they guard overlap.
+
+Each lock of a :py:class:`ConflictLockGroup` guards a set of paths, e.g. the
+files which a package installs. Locks with disjoint paths are held at the
+same time, and a lock whose paths are unknown excludes all other locks of
+its group. Locks are granted in the order in which they are requested, so a
+lock is also held back by earlier waiting locks which it overlaps with.
+"""
+
+import trollius as asyncio
+
+from osrf_pycommon.process_utils import get_loop
+
+
+class ConflictLock(asyncio.locks.Lock):
+
+    """A lock of a :py:class:`ConflictLockGroup`, used like an asyncio.Lock"""
+
+    def __init__(self, group, paths):
+        super(ConflictLock, self).__init__()
+        self.group = group
+        self.paths = None if paths is None else frozenset(paths)
+        self.held = False
+
+    def locked(self):
+        return self.held
+
+    @asyncio.coroutine
+    def acquire(self):
+        yield asyncio.From(self.group.request(self))
+        raise asyncio.Return(True)
+
+    def release(self):
+        self.group.release(self)
+
+
+class ConflictLockGroup(object):
+
+    """A group of locks which guard overlapping sets of paths."""
+
+    def __init__(self):
+        # The paths guarded by the locks which are held
+        self.held_paths = set()
+        # The number of locks with unknown paths which are held
+        self.n_held = 0
+        self.n_held_exclusive = 0
+        # List of (lock, future) tuples of the locks which are waiting, in order
+        self.waiting = []
+
+    def lock(self, paths):
+        """Create a lock in this group.
+
+        :param paths: The paths guarded by the lock, or None if they are unknown
+        """
+        return ConflictLock(self, paths)
+
+    def request(self, lock):
+        """Request a lock.
+
+        :returns: a future which is done once the lock is held
+        """
+        future = asyncio.Future(loop=get_loop())
+        self.waiting.append((lock, future))
+        self._grant()
+        return future
+
+    def release(self, lock):
+        if not lock.held:
+            raise RuntimeError('Lock is not acquired.')
+        lock.held = False
+        self.n_held -= 1
+        if lock.paths is None:
+            self.n_held_exclusive -= 1
+        else:
+            self.held_paths.difference_update(lock.paths)
+        self._grant()
+
+    def _grant(self):
+        # The paths of the earlier locks which are still waiting
+        blocked_paths = set()
+        blocked_exclusive = False
+
+        waiting = []
+        for lock, future in self.waiting:
+            if future.cancelled():
+                continue
+
+            if lock.paths is None:
+                can_hold = self.n_held == 0 and len(waiting) == 0
+            else:
+                can_hold = (
+                    self.n_held_exclusive == 0 and
+                    not blocked_exclusive and
+                    lock.paths.isdisjoint(self.held_paths) and
+                    lock.paths.isdisjoint(blocked_paths))
+
+            if can_hold:
+                lock.held = True
+                self.n_held += 1
+                if lock.paths is None:
+                    self.n_held_exclusive += 1
+                else:
+                    self.held_paths.update(lock.paths)
+                future.set_result(True)
+            else:
+                waiting.append((lock, future))
+                if lock.paths is None:
+                    blocked_exclusive = True
+                else:
+                    blocked_paths.update(lock.paths)
+
+        self.waiting = waiting
@@ -24,6 +24,7 @@ import sys
 import threading
 import time
 
+from ckx_tools.common import cache_terminal_width
 from ckx_tools.common import disable_wide_log
 from ckx_tools.common import format_time_delta
 from ckx_tools.common import format_time_delta_short
@@ -38,6 +39,8 @@ from ckx_tools.terminal_color import sanitize
 from ckx_tools.terminal_color import ColorMapper
 
 from ckx_tools.execution import job_server
+from ckx_tools.execution.events import ExecutionEvent
+from ckx_tools.execution.progress import EtaEstimator
 
 # This map translates more human reable format strings into colorized versions
 _color_translation_map = {
@@ -121,6 +124,9 @@ _color_translation_map = {
     "[{}] Skipped: {} {} skipped.":
     fmt("[{}]   @/@!@{yf}Skipped:@|   @/@!{}@| @/{} skipped.@|"),
 
+    "[{}] Up to date: {} {} did not need to be rebuilt.":
+    fmt("[{}]   @/@!@{kf}Up to date:@| @/@!{}@| @/{} did not need to be rebuilt.@|"),
+
     "[{}] Ignored: None.":
     fmt("[{}]   @/@!@{kf}Ignored:   None.@|"),
 
@@ -190,6 +196,10 @@ class ConsoleStatusController(threading.Thread):
             whitelisted_jobs,
             blacklisted_jobs,
             event_queue,
+            up_to_date_jobs=None,
+            summary_notes=None,
+            event_listeners=None,
+            stage_durations=None,
             show_notifications=False,
             show_stage_events=False,
             show_buffered_stdout=False,
@@ -207,6 +217,12 @@ class ConsoleStatusController(threading.Thread):
         :param label: The label for this task (build, clean, etc)
         :param job_labels: The labels to be used for the jobs (packages, tests, etc)
         :param event_queue: The event queue used by an Executor
+        :param up_to_date_jobs: Jobs which were skipped because they were already up to date
+        :param summary_notes: Additional lines to print at the end of the summary
+        :param event_listeners: Objects whose `handle_event` method is called with every event, which
+            subscribe to the events listed in their `subscribed_event_ids` attribute, or to all events
+        :param stage_durations: Map from job id to a map from stage label to its expected duration, used
+            to estimate the remaining time of the active stages and of all jobs
         :param show_notifications: Show a libnotify notification when the jobs are finished
         :param show_stage_events: Show events relating to stages in each job
         :param show_buffered_stdout: Show stdout from jobs as they finish
@@ -251,6 +267,35 @@ class ConsoleStatusController(threading.Thread):
         self.available_jobs = available_jobs
         self.blacklisted_jobs = blacklisted_jobs
         self.whitelisted_jobs = whitelisted_jobs
+        self.up_to_date_jobs = up_to_date_jobs or []
+        self.summary_notes = summary_notes or []
+        self.event_listeners = event_listeners or []
+
+        # Colorize the status line templates only once
+        self.status_templates = dict([(k, clr(v)) for k, v in [
+            ('status', '[{} {} s] [{}/{} complete] [{}/{} jobs] [{} queued]'),
+            ('failed', ' [@!@{rf}{}@| @{rf}failed@|]'),
+            ('high_load', ' [@!@{rf}High Load@|]'),
+            ('low_mem', ' [@!@{rf}Low Memory@|]'),
+            ('waiting', ' @/@!@{kf}Waiting for jobs...@|'),
+            ('stage', '[{}:{} - {}]'),
+            ('stage_progress', '[{}:{} ({}) - {}]'),
+            ('stage_eta', '[{}:{} (~{} left) - {}]'),
+            ('stage_progress_eta', '[{}:{} ({}, ~{} left) - {}]'),
+            ('eta', ' [~{} left]'),
+        ]])
+
+        self.eta_estimator = EtaEstimator(
+            jobs, stage_durations, max_toplevel_jobs or job_server.max_jobs())
+
+        # Only query the terminal width again when the terminal is resized,
+        # which needs a signal handler installed from the main thread
+        if self.show_active_status:
+            cache_terminal_width()
+
+        # Only let the producers generate the events which are consumed
+        if hasattr(self.event_queue, 'subscribe'):
+            self.event_queue.subscribe(self.get_subscribed_event_ids())
 
         # Compute the max job id length when combined with stage labels
         self.max_jid_length = 1
@@ -261,6 +306,97 @@ class ConsoleStatusController(threading.Thread):
                  in self.jobs.items()]
             )
 
+    def get_subscribed_event_ids(self):
+        """Get the ids of the events which are displayed or handled by the event listeners."""
+        event_ids = set([
+            'JOB_STATUS',
+            'QUEUED_JOB',
+            'STARTED_JOB',
+            'FINISHED_JOB',
+            'ABANDONED_JOB',
+            'STARTED_STAGE',
+            'FINISHED_STAGE',
+            'MESSAGE'])
+        if self.show_active_status:
+            event_ids.add('STAGE_PROGRESS')
+        if self.show_stage_events:
+            event_ids.add('SUBPROCESS')
+        if self.show_live_stdout:
+            event_ids.add('STDOUT')
+        if self.show_live_stderr:
+            event_ids.add('STDERR')
+        for listener in self.event_listeners:
+            event_ids.update(getattr(listener, 'subscribed_event_ids', ExecutionEvent.EVENT_IDS))
+        return event_ids
+
+    def format_status_line(
+            self, elapsed_time, queued_jobs, active_jobs, completed_jobs, failed_jobs, abandoned_jobs, active_stages,
+            cumulative_times):
+        """Format the status line which shows the progress and the active stages.
+
+        Times are shown in whole seconds, so that the status line doesn't
+        change with every update while nothing else happens.
+        """
+        templates = self.status_templates
+        status_line = templates['status'].format(
+            self.label,
+            format_time_delta_short(int(elapsed_time)),
+            len(completed_jobs),
+            len(self.jobs),
+            job_server.running_jobs(),
+            job_server.max_jobs(),
+            len(queued_jobs) + len(active_jobs) - len(active_stages)
+        )
+
+        # Estimate the remaining time of the active stages and of all jobs
+        now = time.time()
+        stage_remainings = {}
+        job_remainings = {}
+        for j, (s, t, p, n) in active_stages.items():
+            stage_remainings[j] = self.eta_estimator.stage_remaining(j, s, now - t, p, now)
+            job_remainings[j] = self.eta_estimator.job_remaining(j, s, stage_remainings[j])
+        pending_jobs = [
+            j for j in self.jobs
+            if j not in completed_jobs and j not in abandoned_jobs and j not in active_jobs]
+        total_remaining = self.eta_estimator.total_remaining(job_remainings, pending_jobs)
+        if total_remaining is not None and len(active_jobs) > 0:
+            status_line += templates['eta'].format(format_time_delta_short(round(total_remaining)))
+
+        # Show failed jobs
+        if len(failed_jobs) > 0:
+            status_line += templates['failed'].format(len(failed_jobs))
+
+        # Check load / mem
+        if not job_server.load_ok():
+            status_line += templates['high_load']
+        if not job_server.mem_ok():
+            status_line += templates['low_mem']
+
+        # Add active jobs
+        if len(active_jobs) == 0:
+            status_line += templates['waiting']
+        else:
+            active_labels = []
+
+            for j, (s, t, p, n) in active_stages.items():
+                d = format_time_delta_short(int(cumulative_times[j] + now - t))
+                r = stage_remainings[j]
+                if p != '':
+                    p = '{}%, {} objects'.format(p, n) if n else '{}%'.format(p)
+                if p == '' and r is None:
+                    active_labels.append(templates['stage'].format(j, s, d))
+                elif p == '':
+                    active_labels.append(templates['stage_eta'].format(j, s, format_time_delta_short(round(r)), d))
+                elif r is None:
+                    active_labels.append(templates['stage_progress'].format(j, s, p, d))
+                else:
+                    active_labels.append(templates['stage_progress_eta'].format(
+                        j, s, p, format_time_delta_short(round(r)), d))
+
+            status_line += ' ' + ' '.join(active_labels)
+
+        return status_line
+
     def print_exec_summary(self, completed_jobs, warned_jobs, failed_jobs):
         """
         Print verbose execution summary.
@@ -274,6 +410,7 @@ class ConsoleStatusController(threading.Thread):
             'warned':     clr(" [    @!@{yf}Warned@|] @{cf}{jid:<%d}@|" % max_jid_len),
             'failed':     clr(" [    @!@{rf}Failed@|] @{cf}{jid:<%d}@|" % max_jid_len),
             'ignored':    clr(" [   @!@{kf}Ignored@|] @{cf}{jid:<%d}@|" % max_jid_len),
+            'up_to_date': clr(" [@!@{kf}Up to date@|] @{cf}{jid:<%d}@|" % max_jid_len),
             'abandoned':  clr(" [ @!@{rf}Abandoned@|] @{cf}{jid:<%d}@|" % max_jid_len),
         }
 
@@ -299,6 +436,8 @@ class ConsoleStatusController(threading.Thread):
         for jid in self.available_jobs:
             if jid in self.blacklisted_jobs:
                 blacklisted[jid] = templates['ignored']
+            elif jid in self.up_to_date_jobs:
+                ignoreds[jid] = templates['up_to_date']
             elif jid not in self.jobs:
                 ignoreds[jid] = templates['ignored']
             elif len(self.whitelisted_jobs) > 0 and jid not in self.whitelisted_jobs:
@@ -380,8 +519,17 @@ class ConsoleStatusController(threading.Thread):
                 len(self.jobs),
                 self.jobs_label))
 
+        # Display number of jobs which didn't need to be run
+        if len(self.up_to_date_jobs) > 0:
+            wide_log(clr('[{}] Up to date: {} {} did not need to be rebuilt.').format(
+                self.label,
+                len(self.up_to_date_jobs),
+                self.jobs_label))
+
         # Display number of ignored jobs (jobs which shouldn't have been built)
-        all_ignored_jobs = [j for j in self.available_jobs if j not in self.jobs]
+        all_ignored_jobs = [
+            j for j in self.available_jobs
+            if j not in self.jobs and j not in self.up_to_date_jobs]
         if len(all_ignored_jobs) == 0:
             wide_log(clr('[{}] Ignored: None.').format(
                 self.label))
@@ -443,18 +591,20 @@ class ConsoleStatusController(threading.Thread):
                 notify(notification_title, "\n".join(notification_msg))
 
     def run(self):
-        queued_jobs = []
-        active_jobs = []
+        queued_jobs = set()
+        active_jobs = set()
         completed_jobs = {}
         failed_jobs = []
         warned_jobs = []
+        abandoned_jobs = set()
 
         cumulative_times = dict()
         start_times = dict()
         active_stages = dict()
 
         start_time = self.pre_start_time or time.time()
-        last_update_time = time.time()
+        next_update_time = time.time()
+        last_status_line = None
 
         # If the status rate is too low, just disable it
         if self.active_status_rate < 1E-3:
@@ -475,63 +625,33 @@ class ConsoleStatusController(threading.Thread):
             # Write a continuously-updated status line
             if self.show_active_status:
 
-                # Try to get an event from the queue (non-blocking)
+                # Block on the queue until the next status update is due
                 try:
-                    event = self.event_queue.get(False)
+                    event = self.event_queue.get(True, max(0.0, next_update_time - time.time()))
                 except Empty:
-                    # Determine if the status should be shown based on the desired
-                    # status rate
-                    elapsed_time = time.time() - last_update_time
-                    show_status_now = elapsed_time > update_duration
-
-                    if show_status_now:
-                        # Print live status (overwrites last line)
-                        status_line = clr('[{} {} s] [{}/{} complete] [{}/{} jobs] [{} queued]').format(
-                            self.label,
-                            format_time_delta_short(time.time() - start_time),
-                            len(completed_jobs),
-                            len(self.jobs),
-                            job_server.running_jobs(),
-                            job_server.max_jobs(),
-                            len(queued_jobs) + len(active_jobs) - len(active_stages)
-                        )
-
-                        # Show failed jobs
-                        if len(failed_jobs) > 0:
-                            status_line += clr(' [@!@{rf}{}@| @{rf}failed@|]').format(len(failed_jobs))
-
-                        # Check load / mem
-                        if not job_server.load_ok():
-                            status_line += clr(' [@!@{rf}High Load@|]')
-                        if not job_server.mem_ok():
-                            status_line += clr(' [@!@{rf}Low Memory@|]')
-
-                        # Add active jobs
-                        if len(active_jobs) == 0:
-                            status_line += clr(' @/@!@{kf}Waiting for jobs...@|')
-                        else:
-                            active_labels = []
-
-                            for j, (s, t, p) in active_stages.items():
-                                d = format_time_delta_short(cumulative_times[j] + time.time() - t)
-                                if p == '':
-                                    active_labels.append(clr('[{}:{} - {}]').format(j, s, d))
-                                else:
-                                    active_labels.append(clr('[{}:{} ({}%) - {}]').format(j, s, p, d))
-
-                            status_line += ' ' + ' '.join(active_labels)
-
-                        # Print the status line
-                        # wide_log(status_line)
+                    event = Empty
+
+                if time.time() >= next_update_time:
+                    status_line = self.format_status_line(
+                        time.time() - start_time,
+                        queued_jobs,
+                        active_jobs,
+                        completed_jobs,
+                        failed_jobs,
+                        abandoned_jobs,
+                        active_stages,
+                        cumulative_times)
+
+                    # Only redraw the status line if it changed (overwrites last line)
+                    if status_line != last_status_line:
                         wide_log(status_line, rhs='', end='\r')
                         sys.stdout.flush()
+                        last_status_line = status_line
 
-                        # Store this update time
-                        last_update_time = time.time()
-                    else:
-                        time.sleep(max(0.0, min(update_duration - elapsed_time, 0.01)))
+                    next_update_time = time.time() + update_duration
 
-                    # Only continue when no event was received
+                # Only continue when no event was received
+                if event is Empty:
                     continue
             else:
                 # Try to get an event from the queue (blocking)
@@ -544,25 +664,35 @@ class ConsoleStatusController(threading.Thread):
             if event is None:
                 break
 
+            for listener in self.event_listeners:
+                listener.handle_event(event)
+
             # Handle the received events
             eid = event.event_id
 
             if 'JOB_STATUS' == eid:
-                queued_jobs = event.data['queued']
-                active_jobs = event.data['active']
-                completed_jobs = event.data['completed']
+                queued_jobs = set(event.data['queued'])
+                active_jobs = set(event.data['active'])
+                completed_jobs = dict(event.data['completed'])
 
                 # Check if all jobs have finished in some way
                 if all([len(event.data[t]) == 0 for t in ['pending', 'queued', 'active']]):
                     break
 
+            elif 'QUEUED_JOB' == eid:
+                queued_jobs.add(event.data['job_id'])
+
             elif 'STARTED_JOB' == eid:
+                queued_jobs.discard(event.data['job_id'])
+                active_jobs.add(event.data['job_id'])
                 cumulative_times[event.data['job_id']] = 0.0
                 wide_log(clr('Starting >>> {:<{}}').format(
                     event.data['job_id'],
                     self.max_jid_length))
 
             elif 'FINISHED_JOB' == eid:
+                active_jobs.discard(event.data['job_id'])
+                completed_jobs[event.data['job_id']] = event.data['succeeded']
                 duration = format_time_delta(cumulative_times[event.data['job_id']])
 
                 if event.data['succeeded']:
@@ -578,6 +708,9 @@ class ConsoleStatusController(threading.Thread):
                         duration))
 
             elif 'ABANDONED_JOB' == eid:
+                queued_jobs.discard(event.data['job_id'])
+                abandoned_jobs.add(event.data['job_id'])
+
                 # Create a human-readable reason string
                 if 'DEP_FAILED' == event.data['reason']:
                     direct = event.data['dep_job_id'] == event.data['direct_dep_job_id']
@@ -599,7 +732,7 @@ class ConsoleStatusController(threading.Thread):
                     reason))
 
             elif 'STARTED_STAGE' == eid:
-                active_stages[event.data['job_id']] = [event.data['stage_label'], event.time, '']
+                active_stages[event.data['job_id']] = [event.data['stage_label'], event.time, '', 0]
                 start_times[event.data['job_id']] = event.time
 
                 if self.show_stage_events:
@@ -609,6 +742,7 @@ class ConsoleStatusController(threading.Thread):
 
             elif 'STAGE_PROGRESS' == eid:
                 active_stages[event.data['job_id']][2] = event.data['percent']
+                active_stages[event.data['job_id']][3] = event.data.get('units', 0)
 
             elif 'SUBPROCESS' == eid:
                 if self.show_stage_events:
@@ -624,6 +758,7 @@ class ConsoleStatusController(threading.Thread):
 
                 # This is no longer the active stage for this job
                 del active_stages[event.data['job_id']]
+                self.eta_estimator.forget(event.data['job_id'])
 
                 header_border = None
                 header_title = None
@@ -730,6 +865,11 @@ class ConsoleStatusController(threading.Thread):
             elif 'MESSAGE' == eid:
                 wide_log(event.data['msg'])
 
+            # Lines printed for an event overwrite the status line, so it is redrawn on the next update
+            if eid not in ['JOB_STATUS', 'QUEUED_JOB', 'STAGE_PROGRESS', 'STDOUT', 'STDERR'] or \
+                    (eid == 'STDOUT' and self.show_live_stdout) or (eid == 'STDERR' and self.show_live_stderr):
+                last_status_line = None
+
         # Print the full summary
         if self.show_full_summary:
             self.print_exec_summary(completed_jobs, warned_jobs, failed_jobs)
@@ -743,6 +883,9 @@ class ConsoleStatusController(threading.Thread):
             self.label,
             format_time_delta(time.time() - start_time)))
 
+        for note in self.summary_notes:
+            wide_log(clr('[{}] {}').format(self.label, note))
+
     def format_interleaved_lines(self, data):
         if self.max_toplevel_jobs != 1:
             prefix = clr('[{}:{}] ').format(
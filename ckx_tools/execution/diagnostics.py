@@ -0,0 +1,246 @@
+# Copyright 2016 Open Source Robotics Foundation, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Extraction and indexing of compiler and CMake diagnostics.
+
+The output of every stage is scanned for warnings and errors in the formats
+of gcc, clang and CMake while it is being received. The diagnostics of each
+stage are handed to the console controller with the `FINISHED_STAGE` event,
+and collected by a :py:class:`DiagnosticsRecorder`. At the end of a build,
+they replace the diagnostics of the same packages in a compact index in the
+log space, so that the index always holds the diagnostics of the last build
+of each package, and can be queried without reading any logs.
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import re
+
+from ckx_tools.common import mkdir_p
+
+DIAGNOSTICS_FILE_SUFFIX = '_diagnostics.json'
+
+# Bump this whenever the layout of the index changes
+DIAGNOSTICS_VERSION = 1
+
+SEVERITY_WARNING = 'warning'
+SEVERITY_ERROR = 'error'
+SEVERITIES = [SEVERITY_WARNING, SEVERITY_ERROR]
+
+# Output which doesn't contain any of these can't hold a diagnostic, and isn't parsed any further
+DIAGNOSTIC_MARKER_RE = re.compile(br'warning|error|CMake ')
+
+# Escape sequences of colorized output
+ANSI_ESCAPE_RE = re.compile(br'\x1b\[[0-9;]*[mK]')
+
+# gcc and clang diagnostics, e.g. `src/a.cpp:12:5: warning: unused variable 'x' [-Wunused-variable]`
+COMPILER_DIAGNOSTIC_RE = re.compile(
+    br'^(?P<path>[^:\s][^:]*):(?P<line>[0-9]+):(?:(?P<column>[0-9]+):)? '
+    br'(?P<severity>warning|error|fatal error): (?P<message>.*?)(?: \[(?P<flag>-W[^\]]+)\])?\s*$')
+
+# CMake diagnostics, e.g. `CMake Warning (dev) at CMakeLists.txt:3 (message):`, followed by indented message lines
+CMAKE_DIAGNOSTIC_RE = re.compile(
+    br'^CMake (?P<severity>Warning|Error|Deprecation Warning)(?: \((?P<flag>dev)\))?'
+    br'(?: (?:at|in) (?P<path>.+?)(?::(?P<line>[0-9]+))?(?: \([^)]*\))?)?:\s*$')
+
+# Incomplete lines are truncated to this length while waiting for their line break
+MAX_LINE_LENGTH = 4096
+
+
+def _decode(data):
+    return data.decode('utf-8', 'replace')
+
+
+class DiagnosticsExtractor(object):
+
+    """Extracts diagnostics from the streamed output of one stage.
+
+    Each stream is split into lines independently of how it is received. Each
+    diagnostic is reported once per stage, along with the number of times it
+    occurred, since diagnostics in headers are repeated for every translation
+    unit which includes them.
+    """
+
+    def __init__(self):
+        self.tails = {}
+        # The CMake diagnostic of each stream which is waiting for its message
+        self.pending = {}
+
+        self.diagnostics = []
+        self.counts = {}
+
+    def feed(self, stream, data):
+        """Parse the complete lines of a chunk of output.
+
+        :param stream: The name of the stream, e.g. 'stdout'
+        :type data: bytes
+        """
+        data = self.tails.pop(stream, b'') + data
+        end = 1 + data.rfind(b'\n')
+        if end < len(data):
+            self.tails[stream] = data[end:end + MAX_LINE_LENGTH]
+        self._parse(stream, data[:end])
+
+    def flush(self):
+        """Parse the incomplete last lines of all streams."""
+        for stream, tail in list(self.tails.items()):
+            self._parse(stream, tail)
+        self.tails = {}
+        for pending in self.pending.values():
+            self._add(pending)
+        self.pending = {}
+
+    def _parse(self, stream, data):
+        if len(data) == 0 or (stream not in self.pending and DIAGNOSTIC_MARKER_RE.search(data) is None):
+            return
+        if b'\x1b' in data:
+            data = ANSI_ESCAPE_RE.sub(b'', data)
+
+        for line in data.splitlines():
+            pending = self.pending.pop(stream, None)
+            if pending is not None and line.startswith(b'  ') and len(line.strip()) > 0:
+                self._add(pending[:-1] + (_decode(line.strip()),))
+                continue
+            elif pending is not None:
+                self._add(pending)
+
+            match = COMPILER_DIAGNOSTIC_RE.match(line)
+            if match is not None:
+                self._add((
+                    SEVERITY_WARNING if match.group('severity') == b'warning' else SEVERITY_ERROR,
+                    _decode(match.group('flag') or b''),
+                    _decode(match.group('path')),
+                    int(match.group('line')),
+                    int(match.group('column') or 0),
+                    _decode(match.group('message'))))
+                continue
+
+            match = CMAKE_DIAGNOSTIC_RE.match(line)
+            if match is not None:
+                # The message of CMake diagnostics is on the following lines
+                self.pending[stream] = (
+                    SEVERITY_ERROR if match.group('severity') == b'Error' else SEVERITY_WARNING,
+                    'cmake-deprecated' if match.group('severity').startswith(b'Deprecation') else
+                    'cmake-dev' if match.group('flag') else 'cmake',
+                    _decode(match.group('path') or b''),
+                    int(match.group('line') or 0),
+                    0,
+                    '')
+
+    def _add(self, diagnostic):
+        if diagnostic in self.counts:
+            self.counts[diagnostic] += 1
+        else:
+            self.counts[diagnostic] = 1
+            self.diagnostics.append(diagnostic)
+
+    def get_diagnostics(self):
+        """Get the diagnostics found so far.
+
+        :returns: list of [severity, flag, path, line, column, message, count] lists
+        """
+        return [list(d) + [self.counts[d]] for d in self.diagnostics]
+
+
+def get_diagnostics_path(log_path, verb):
+    """Get the path to the diagnostics index of a verb in a log space."""
+    return os.path.join(log_path, verb + DIAGNOSTICS_FILE_SUFFIX)
+
+
+class DiagnosticsRecorder(object):
+
+    """Collects the diagnostics of each stage from the events generated by the executor.
+
+    The recorder is handed every event consumed by a
+    :py:class:`ckx_tools.execution.controllers.ConsoleStatusController`.
+    """
+
+    subscribed_event_ids = ['STARTED_JOB', 'FINISHED_STAGE']
+
+    def __init__(self, verb):
+        self.verb = verb
+        # Map from jid -> list of [stage label, severity, flag, path, line, column, message, count] lists
+        self.jobs = {}
+
+    def handle_event(self, event):
+        eid = event.event_id
+        data = event.data
+
+        if 'STARTED_JOB' == eid:
+            self.jobs[data['job_id']] = []
+
+        elif 'FINISHED_STAGE' == eid:
+            self.jobs.setdefault(data['job_id'], []).extend(
+                [[data['stage_label']] + d for d in data.get('diagnostics') or []])
+
+
+def load_diagnostics(log_path, verb):
+    """Load the diagnostics index of a verb.
+
+    :returns: Map from job id to a list of [stage label, severity, flag, path,
+        line, column, message, count] lists
+    :rtype: dict
+    """
+    try:
+        with open(get_diagnostics_path(log_path, verb)) as index_file:
+            index = json.load(index_file)
+    except (IOError, OSError, ValueError):
+        return {}
+    if not isinstance(index, dict) or index.get('version') != DIAGNOSTICS_VERSION:
+        return {}
+    return index['jobs']
+
+
+def update_diagnostics(log_path, recorder):
+    """Replace the diagnostics of the jobs which have been recorded in the index of their verb."""
+    jobs = load_diagnostics(log_path, recorder.verb)
+    jobs.update(recorder.jobs)
+    jobs = dict([(jid, diagnostics) for jid, diagnostics in jobs.items() if len(diagnostics) > 0])
+
+    mkdir_p(log_path)
+    index_path = get_diagnostics_path(log_path, recorder.verb)
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'w') as index_file:
+        json.dump({'version': DIAGNOSTICS_VERSION, 'jobs': jobs}, index_file, separators=(',', ':'))
+    os.rename(tmp_path, index_path)
+
+
+def query_diagnostics(jobs, job_ids=None, stage_label=None, severity=None, flag=None, path=None):
+    """Select diagnostics from an index.
+
+    :param jobs: The index, from :py:func:`load_diagnostics`
+    :param job_ids: Only select the diagnostics of these jobs
+    :param stage_label: Only select the diagnostics of stages with this label
+    :param severity: Only select diagnostics with this severity
+    :param flag: Only select diagnostics with this flag, with or without the leading `-W`
+    :param path: Only select diagnostics in files whose path contains this string
+    :returns: list of (job id, [stage label, severity, flag, path, line, column, message, count]) tuples
+    :rtype: list
+    """
+    if flag is not None and not flag.startswith('-W') and not flag.startswith('cmake'):
+        flag = '-W' + flag
+
+    selected = []
+    for jid in sorted(jobs):
+        if job_ids and jid not in job_ids:
+            continue
+        for d in jobs[jid]:
+            if ((stage_label is None or d[0] == stage_label) and
+                    (severity is None or d[1] == severity) and
+                    (flag is None or d[2] == flag) and
+                    (path is None or path in d[3])):
+                selected.append((jid, d))
+    return selected
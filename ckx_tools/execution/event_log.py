@@ -0,0 +1,107 @@
+# Copyright 2016 Open Source Robotics Foundation, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Machine-readable log of the events generated by the executor.
+
+Each event is written as one line of JSON, as soon as it is consumed, so that
+the log can be followed while the jobs are running. Every line holds the
+event id, the verb, the wall-clock time of the event, the time in seconds
+since the log was opened on a monotonic clock, and the data of the event.
+The output of the stages is not included, only the names of their logfiles.
+"""
+
+import json
+import os
+
+from ckx_tools.common import mkdir_p
+
+from .events import monotonic
+
+# Bump this whenever the layout of the event lines changes
+EVENT_LOG_VERSION = 1
+
+# The prefix of event log targets which are file descriptors instead of paths
+FD_PREFIX = 'fd:'
+
+# Event data which isn't written to the event log, since it is large and available elsewhere
+OMITTED_DATA = ['stdout', 'stderr', 'interleaved', 'env']
+
+
+def get_event_log_fd(target):
+    """Get the file descriptor of an event log target of the form `fd:N`.
+
+    :returns: the file descriptor, or None if the target is a path
+    :raises: ValueError if the file descriptor isn't a non-negative integer
+    """
+    if not target.startswith(FD_PREFIX):
+        return None
+    fd = target[len(FD_PREFIX):]
+    if not fd.isdigit():
+        raise ValueError("Expected a file descriptor after '{}', not '{}'".format(FD_PREFIX, fd))
+    return int(fd)
+
+
+class EventLogWriter(object):
+
+    """Writes the events consumed by a
+    :py:class:`ckx_tools.execution.controllers.ConsoleStatusController` as JSON lines.
+
+    The subscribed events are logged regardless of which events are shown on
+    the console.
+    """
+
+    subscribed_event_ids = [
+        'JOB_STATUS',
+        'QUEUED_JOB',
+        'STARTED_JOB',
+        'FINISHED_JOB',
+        'ABANDONED_JOB',
+        'STARTED_STAGE',
+        'FINISHED_STAGE',
+        'STAGE_PROGRESS',
+        'SUBPROCESS',
+        'MESSAGE',
+    ]
+
+    def __init__(self, verb, target):
+        """
+        :param verb: The verb whose events are logged
+        :param target: The path of the file to write to, or `fd:N` to write to file descriptor N
+        """
+        self.verb = verb
+        self.target = target
+        fd = get_event_log_fd(target)
+        if fd is not None:
+            self.log_file = os.fdopen(fd, 'w')
+        else:
+            mkdir_p(os.path.dirname(os.path.abspath(target)))
+            self.log_file = open(target, 'w')
+        self.start_time = monotonic()
+
+    def handle_event(self, event):
+        if self.log_file.closed:
+            return
+        line = {
+            'version': EVENT_LOG_VERSION,
+            'event': event.event_id,
+            'verb': self.verb,
+            'time': round(event.time, 6),
+            'elapsed': round(event.monotonic_time - self.start_time, 6),
+        }
+        line['data'] = dict([(k, v) for k, v in event.data.items() if k not in OMITTED_DATA])
+        self.log_file.write(json.dumps(line, sort_keys=True, separators=(',', ':'), default=str) + '\n')
+        self.log_file.flush()
+
+    def close(self):
+        self.log_file.close()
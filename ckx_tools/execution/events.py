@@ -14,6 +14,16 @@
 
 import time
 
+try:
+    # Python3
+    from queue import Queue
+except ImportError:
+    # Python2
+    from Queue import Queue
+
+# A clock which isn't affected by changes of the system time, where available
+monotonic = getattr(time, 'monotonic', time.time)
+
 
 class ExecutionEvent(object):
 
@@ -48,6 +58,7 @@ class ExecutionEvent(object):
         """
         # Store the time this event was generated
         self.time = time.time()
+        self.monotonic_time = monotonic()
 
         # Make sure the event ID is valid
         if event_id not in ExecutionEvent.EVENT_IDS:
@@ -57,3 +68,37 @@ class ExecutionEvent(object):
         # Store the event data
         self.event_id = event_id
         self.data = kwargs
+
+
+class ExecutionEventQueue(Queue):
+
+    """A queue of execution events which only accepts the events its consumers subscribed to.
+
+    Until a consumer subscribes, all events are accepted. Producers of
+    frequent events like `STDOUT` can check :py:meth:`wants` to skip
+    generating events which would be dropped anyway. A `None` event, which
+    signals the consumers to terminate, is always accepted.
+    """
+
+    def __init__(self, maxsize=0):
+        Queue.__init__(self, maxsize)
+        self.subscribed_event_ids = None
+
+    def subscribe(self, event_ids):
+        """Subscribe to the given event ids, in addition to those subscribed to before."""
+        if self.subscribed_event_ids is None:
+            self.subscribed_event_ids = set()
+        self.subscribed_event_ids.update(event_ids)
+
+    def wants(self, event_id):
+        return self.subscribed_event_ids is None or event_id in self.subscribed_event_ids
+
+    def put(self, event, block=True, timeout=None):
+        if event is None or self.wants(event.event_id):
+            Queue.put(self, event, block, timeout)
+
+
+def wants_event(event_queue, event_id):
+    """Check if an event queue accepts an event, if it supports subscriptions at all."""
+    wants = getattr(event_queue, 'wants', None)
+    return wants is None or wants(event_id)
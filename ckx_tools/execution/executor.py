@@ -17,12 +17,12 @@ from __future__ import print_function
 import os
 import traceback
 
+from collections import deque
 from itertools import tee
 
 import trollius as asyncio
 
 from concurrent.futures import ThreadPoolExecutor
-from concurrent.futures import FIRST_COMPLETED
 
 from osrf_pycommon.process_utils import async_execute_process
 from osrf_pycommon.process_utils import get_loop
@@ -45,12 +45,13 @@ def split(values, cond):
 
 
 @asyncio.coroutine
-def async_job(verb, job, threadpool, locks, event_queue, log_path):
+def async_job(verb, job, threadpool, locks, event_queue, log_path, priority=0.0):
     """Run a sequence of Stages from a Job and collect their output.
 
     :param job: A Job instance
     :threadpool: A thread pool executor for blocking stages
     :event_queue: A queue for asynchronous events
+    :priority: The priority with which this job waits for job server tokens
     """
 
     # Initialize success flag
@@ -82,8 +83,7 @@ def async_job(verb, job, threadpool, locks, event_queue, log_path):
             # If the stage doesn't require a job token, release it temporarily
             if stage.occupy_job:
                 if not occupying_job:
-                    while job_server.try_acquire() is None:
-                        yield asyncio.From(asyncio.sleep(0.05))
+                    yield asyncio.From(job_server.async_acquire(get_loop(), priority))
                     occupying_job = True
             else:
                 if occupying_job:
@@ -161,6 +161,9 @@ def async_job(verb, job, threadpool, locks, event_queue, log_path):
             # Update success tracker from this stage
             all_stages_succeeded = all_stages_succeeded and stage_succeeded
 
+            # Write out the logfile on the log writer thread, without blocking the event loop
+            yield asyncio.From(logger.close_log())
+
             # Store the results from this stage
             event_queue.put(ExecutionEvent(
                 'FINISHED_STAGE',
@@ -171,6 +174,7 @@ def async_job(verb, job, threadpool, locks, event_queue, log_path):
                 stderr=logger.get_stderr_log(),
                 interleaved=logger.get_interleaved_log(),
                 logfile_filename=logger.unique_logfile_name,
+                diagnostics=logger.get_diagnostics(),
                 repro=stage.get_reproduction_cmd(verb, job.jid),
                 retcode=retcode))
 
@@ -192,63 +196,156 @@ def execute_jobs(
         log_path,
         max_toplevel_jobs=None,
         continue_on_failure=False,
-        continue_without_deps=False):
+        continue_without_deps=False,
+        priorities=None):
     """Process a number of jobs asynchronously.
 
+    Readiness is tracked with a count of the unfinished dependencies of each
+    job, which is decremented through the reverse dependency map whenever a
+    job finishes, and the executor only wakes up when a job finishes. The
+    state of the jobs is reported with a `JOB_STATUS` snapshot at the start
+    and the end, and with `QUEUED_JOB`, `STARTED_JOB`, `FINISHED_JOB` and
+    `ABANDONED_JOB` events for every change in between.
+
     :param jobs: A list of topologically-sorted Jobs with no circular dependencies.
     :param event_queue: A python queue for reporting events.
     :param log_path: The path in which logfiles can be written
     :param max_toplevel_jobs: Max number of top-level jobs
     :param continue_on_failure: Keep running jobs even if one fails.
     :param continue_without_deps: Run jobs even if their dependencies fail.
+    :param priorities: Map from job id to priority. If given, the ready job
+        with the highest priority is started first, otherwise ready jobs are
+        started in the order in which they became ready.
     """
 
     # Map of jid -> job
     job_map = dict([(j.jid, j) for j in jobs])
-    # Jobs which are not ready to be executed
-    pending_jobs = []
+    # Map of jid -> ids of the jobs which depend on it
+    dependents = dict([(j.jid, []) for j in jobs])
+    # Map of jid -> number of dependencies which haven't finished yet
+    n_pending_deps = {}
+    # Ids of jobs which are not ready to be executed
+    pending_job_ids = set()
     # Jobs which are ready to be executed once workers are available
     queued_jobs = []
-    # List of active jobs
-    active_jobs = []
-    # Set of active job futures
-    active_job_fs = set()
+    # Map of active jobs job_id -> job
+    active_jobs = {}
     # Dict of completd jobs job_id -> succeeded
     completed_jobs = {}
     # List of jobs whose deps failed
     abandoned_jobs = []
 
+    # Futures of jobs which have finished but haven't been handled yet
+    finished_job_fs = deque()
+    # Future of the job server token requested for the next queued job
+    token_f = None
+    # Set whenever a job finishes or a requested token is acquired
+    wakeup = asyncio.Event()
+
+    def on_job_finished(job_f):
+        finished_job_fs.append(job_f)
+        wakeup.set()
+
+    def on_token_acquired(token_f):
+        wakeup.set()
+
+    def give_up_token(token_f):
+        """Stop waiting for a token, or give it back if it has already been acquired."""
+        if not token_f.cancel():
+            job_server.release()
+
+    def abandon(job_id, failed_job_id, **reason):
+        """Abandon a job which hasn't been started, and all pending jobs which depend on it."""
+        unhandled_abandoned_job_ids = [job_id]
+
+        pending_job_ids.discard(job_id)
+        abandoned_jobs.append(job_map[job_id])
+        event_queue.put(ExecutionEvent('ABANDONED_JOB', job_id=job_id, **reason))
+
+        while len(unhandled_abandoned_job_ids) > 0:
+            abandoned_job_id = unhandled_abandoned_job_ids.pop(0)
+
+            for dependent_id in dependents[abandoned_job_id]:
+                if dependent_id not in pending_job_ids:
+                    continue
+                pending_job_ids.remove(dependent_id)
+                abandoned_jobs.append(job_map[dependent_id])
+                event_queue.put(ExecutionEvent(
+                    'ABANDONED_JOB',
+                    job_id=dependent_id,
+                    reason='DEP_FAILED',
+                    direct_dep_job_id=abandoned_job_id,
+                    dep_job_id=failed_job_id))
+                unhandled_abandoned_job_ids.append(dependent_id)
+
     # Make sure job server has been initialized
     if not job_server.initialized():
         raise RuntimeError('JobServer has not been initialized.')
 
+    # Throttling messages of the job server are printed by the status controller
+    job_server.set_event_queue(event_queue)
+
     # Create a thread pool executor for blocking python stages in the asynchronous jobs
     threadpool = ThreadPoolExecutor(max_workers=job_server.max_jobs())
 
-    # Immediately abandon jobs with bad dependencies
-    pending_jobs, new_abandoned_jobs = split(jobs, lambda j: all([d in job_map for d in j.deps]))
+    # Build the dependency counters and the reverse dependency map
+    for job in jobs:
+        deps = set(job.deps)
+        n_pending_deps[job.jid] = len(deps)
+        for dep_id in deps:
+            if dep_id in dependents:
+                dependents[dep_id].append(job.jid)
+
+        if len(deps) == 0:
+            queued_jobs.append(job)
+        else:
+            pending_job_ids.add(job.jid)
 
-    for abandoned_job in new_abandoned_jobs:
-        abandoned_jobs.append(abandoned_job)
-        event_queue.put(ExecutionEvent(
-            'ABANDONED_JOB',
-            job_id=abandoned_job.jid,
-            reason='MISSING_DEPS',
-            dep_ids=[d for d in abandoned_job.deps if d not in job_map]))
+    # Report the initial state of the jobs
+    event_queue.put(ExecutionEvent(
+        'JOB_STATUS',
+        pending=[j.jid for j in jobs if j.jid in pending_job_ids],
+        queued=[j.jid for j in queued_jobs],
+        active=[],
+        abandoned=[],
+        completed=dict(completed_jobs)
+    ))
 
-    # Initialize list of ready and pending jobs (jobs not ready to be executed)
-    queued_jobs, pending_jobs = split(pending_jobs, lambda j: len(j.deps) == 0)
+    # Immediately abandon jobs with bad dependencies
+    for job in jobs:
+        missing_dep_ids = [d for d in job.deps if d not in job_map]
+        if len(missing_dep_ids) > 0 and job.jid in pending_job_ids:
+            abandon(job.jid, job.jid, reason='MISSING_DEPS', dep_ids=missing_dep_ids)
 
     # Process all jobs asynchronously until there are none left
-    while len(active_job_fs) + len(queued_jobs) + len(pending_jobs) > 0:
+    while len(active_jobs) + len(queued_jobs) > 0:
+
+        # Don't hold on to a token if there's no job left to use it
+        if token_f is not None and len(queued_jobs) == 0:
+            give_up_token(token_f)
+            token_f = None
 
         # Activate jobs while the jobserver dispenses tokens
         while ((len(queued_jobs) > 0) and
-               ((max_toplevel_jobs is None) or (len(active_jobs) < max_toplevel_jobs)) and
-               (job_server.try_acquire() is not None)):
+               ((max_toplevel_jobs is None) or (len(active_jobs) < max_toplevel_jobs))):
+
+            # Request a token, the event loop wakes this up when one is returned
+            if token_f is None:
+                token_f = job_server.async_acquire(
+                    get_loop(),
+                    max([priorities.get(j.jid, 0.0) for j in queued_jobs]) if priorities else 0.0)
+                token_f.add_done_callback(on_token_acquired)
+            if not token_f.done():
+                break
+            token_f = None
 
             # Pop a job off of the job queue
-            job = queued_jobs.pop(0)
+            if priorities is None:
+                job = queued_jobs.pop(0)
+            else:
+                # Stable, so jobs with equal priorities are still started in order
+                job = max(queued_jobs, key=lambda j: priorities.get(j.jid, 0.0))
+                queued_jobs.remove(job)
 
             # Label it (for debugging)
             job_server.add_label(job.jid)
@@ -259,32 +356,24 @@ def execute_jobs(
                 job_id=job.jid))
 
             # Start the job coroutine
-            active_jobs.append(job)
-            active_job_fs.add(async_job(verb, job, threadpool, locks, event_queue, log_path))
-
-        # Report running jobs
-        event_queue.put(ExecutionEvent(
-            'JOB_STATUS',
-            pending=[j.jid for j in pending_jobs],
-            queued=[j.jid for j in queued_jobs],
-            active=[j.jid for j in active_jobs],
-            abandoned=[j.jid for j in abandoned_jobs],
-            completed=completed_jobs
-        ))
-
-        # Process jobs as they complete asynchronously
-        done_job_fs, active_job_fs = yield asyncio.From(asyncio.wait(
-            active_job_fs,
-            timeout=0.10,
-            return_when=FIRST_COMPLETED))
-
-        for done_job_f in done_job_fs:
+            active_jobs[job.jid] = job
+            job_f = asyncio.ensure_future(async_job(
+                verb, job, threadpool, locks, event_queue, log_path,
+                priorities.get(job.jid, 0.0) if priorities else 0.0))
+            job_f.add_done_callback(on_job_finished)
+
+        # Wait until a job finishes or a token is acquired for the next one
+        if len(finished_job_fs) == 0:
+            yield asyncio.From(wakeup.wait())
+        wakeup.clear()
+
+        while len(finished_job_fs) > 0:
             # Capture a result once the job has finished
-            job_id, succeeded = yield asyncio.From(done_job_f)
+            job_id, succeeded = finished_job_fs.popleft().result()
 
             # Release a jobserver token now that this job has succeeded
             job_server.release(job_id)
-            active_jobs = [j for j in active_jobs if j.jid != job_id]
+            del active_jobs[job_id]
 
             # Generate event with the results of this job
             event_queue.put(ExecutionEvent(
@@ -300,9 +389,9 @@ def execute_jobs(
                 # Handle different abandoning policies
                 if not continue_on_failure:
                     # Abort all pending jobs if any job fails
-                    new_abandoned_jobs = queued_jobs + pending_jobs
+                    new_abandoned_jobs = queued_jobs + [j for j in jobs if j.jid in pending_job_ids]
                     queued_jobs = []
-                    pending_jobs = []
+                    pending_job_ids.clear()
 
                     # Notify that jobs have been abandoned
                     for abandoned_job in new_abandoned_jobs:
@@ -312,53 +401,45 @@ def execute_jobs(
                             job_id=abandoned_job.jid,
                             reason='PEER_FAILED',
                             peer_job_id=job_id))
+                    continue
 
                 elif not continue_without_deps:
-                    unhandled_abandoned_job_ids = [job_id]
-
-                    # Abandon jobs which depend on abandoned jobs
-                    while len(unhandled_abandoned_job_ids) > 0:
-                        # Get the abandoned job
-                        abandoned_job_id = unhandled_abandoned_job_ids.pop(0)
-
-                        # Abandon all pending jobs which depend on this job_id
-                        unhandled_abandoned_jobs, pending_jobs = split(
-                            pending_jobs,
-                            lambda j: abandoned_job_id in j.deps)
-
-                        # Handle each new abandoned job
-                        for abandoned_job in unhandled_abandoned_jobs:
-                            abandoned_jobs.append(abandoned_job)
-                            # Notify if any jobs have been abandoned
-                            event_queue.put(ExecutionEvent(
-                                'ABANDONED_JOB',
-                                job_id=abandoned_job.jid,
+                    # Abandon jobs which depend on this job
+                    for dependent_id in dependents[job_id]:
+                        if dependent_id in pending_job_ids:
+                            abandon(
+                                dependent_id,
+                                job_id,
                                 reason='DEP_FAILED',
-                                direct_dep_job_id=abandoned_job_id,
-                                dep_job_id=job_id))
-
-                        # Add additional job ids to check
-                        unhandled_abandoned_job_ids.extend(
-                            [j.jid for j in unhandled_abandoned_jobs])
+                                direct_dep_job_id=job_id,
+                                dep_job_id=job_id)
+                    continue
+
+            # Queue the dependents of this job whose dependencies have all completed
+            for dependent_id in dependents[job_id]:
+                if dependent_id not in pending_job_ids:
+                    continue
+                n_pending_deps[dependent_id] -= 1
+                if n_pending_deps[dependent_id] == 0:
+                    pending_job_ids.remove(dependent_id)
+                    queued_jobs.append(job_map[dependent_id])
+
+                    # Notify of newly queued jobs
+                    event_queue.put(ExecutionEvent(
+                        'QUEUED_JOB',
+                        job_id=dependent_id))
 
-            # Update the list of ready jobs (based on completed job dependencies)
-            new_queued_jobs, pending_jobs = split(
-                pending_jobs,
-                lambda j: j.all_deps_completed(completed_jobs))
-            queued_jobs.extend(new_queued_jobs)
+    if token_f is not None:
+        give_up_token(token_f)
 
-            # Notify of newly queued jobs
-            for queued_job in new_queued_jobs:
-                event_queue.put(ExecutionEvent(
-                    'QUEUED_JOB',
-                    job_id=queued_job.jid))
+    job_server.set_event_queue(None)
 
-    # Report running jobs
+    # Report the final state of the jobs
     event_queue.put(ExecutionEvent(
         'JOB_STATUS',
-        pending=[j.jid for j in pending_jobs],
+        pending=[j.jid for j in jobs if j.jid in pending_job_ids],
         queued=[j.jid for j in queued_jobs],
-        active=[j.jid for j in active_jobs],
+        active=list(active_jobs.keys()),
         abandoned=[j.jid for j in abandoned_jobs],
         completed=completed_jobs
     ))
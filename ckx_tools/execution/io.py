@@ -12,19 +12,512 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import atexit
+import errno
+import json
 import os
+import re
 import shutil
+import threading
+import time
 
+from collections import deque
 from glob import glob
 
+try:
+    # Python3
+    from queue import Queue
+except ImportError:
+    # Python2
+    from Queue import Queue
+
+import trollius as asyncio
+
+from concurrent.futures import Future
+
 from osrf_pycommon.process_utils import AsyncSubprocessProtocol
+from osrf_pycommon.process_utils import get_loop
 
 from ckx_tools.common import mkdir_p
 
+from .compressed_log import BLOCK_INDEX_SUFFIX
+from .compressed_log import COMPRESSED_LOG_SUFFIX
+from .compressed_log import CompressedLogWriter
+from .compressed_log import iter_log
+from .compressed_log import read_log
+
+from .diagnostics import DiagnosticsExtractor
+
 from .events import ExecutionEvent
+from .events import wants_event
 
+# The number of previous logfiles which are kept for each verb and stage of a job
 MAX_LOGFILE_HISTORY = 10
 
+# The name of the file in each job's log directory which holds, for each verb
+# and stage, the indices of the oldest and the latest logfile
+LOG_INDEX_FILENAME = '.log_index'
+
+# Whether logfiles are written compressed, see :py:mod:`ckx_tools.execution.compressed_log`
+COMPRESS_LOGS = False
+
+LOGFILE_SUFFIX = '.log'
+STDERR_LOGFILE_SUFFIX = '.stderr'
+
+# Live output of subprocesses is emitted in batches of at most this many
+# bytes, which are held back for at most this many seconds
+OUTPUT_BATCH_SIZE = 64 * 1024
+OUTPUT_BATCH_INTERVAL = 0.1
+
+# The number of bytes of stdout or stderr which a buffer keeps in memory
+# before it spills the output of a stage to a file, this is also the most
+# output of each kind which is passed on once the stage has finished
+MAX_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Output is handed to the log writer thread in blocks of at least this many
+# bytes, or with the next output once it has been held back for this many seconds
+LOG_WRITE_SIZE = 64 * 1024
+LOG_WRITE_INTERVAL = 1.0
+
+# The number of blocks which can wait for the log writer thread before the
+# stages which write more output have to wait as well
+MAX_QUEUED_LOG_WRITES = 64
+
+# When logfiles are synced to the disk: never (left to the operating system),
+# when they are closed, or after every block which is written
+LOG_FSYNC_NEVER = 'never'
+LOG_FSYNC_CLOSE = 'close'
+LOG_FSYNC_ALWAYS = 'always'
+LOG_FSYNC_POLICIES = [LOG_FSYNC_NEVER, LOG_FSYNC_CLOSE, LOG_FSYNC_ALWAYS]
+LOG_FSYNC = LOG_FSYNC_NEVER
+
+
+def set_max_logfile_history(max_logfile_history):
+    """Set the number of previous logfiles which are kept for each verb and stage."""
+    global MAX_LOGFILE_HISTORY
+    if max_logfile_history is not None:
+        MAX_LOGFILE_HISTORY = max(1, int(max_logfile_history))
+
+
+def set_compress_logs(compress_logs):
+    """Set whether logfiles are written compressed."""
+    global COMPRESS_LOGS
+    if compress_logs is not None:
+        COMPRESS_LOGS = bool(compress_logs)
+
+
+def set_max_buffer_size(max_buffer_size):
+    """Set the number of MiB of stdout or stderr which are kept in memory for each stage."""
+    global MAX_BUFFER_SIZE
+    if max_buffer_size is not None:
+        MAX_BUFFER_SIZE = max(1, int(max_buffer_size)) * 1024 * 1024
+
+
+def set_log_fsync(log_fsync):
+    """Set when logfiles are synced to the disk, one of `LOG_FSYNC_POLICIES`."""
+    global LOG_FSYNC
+    if log_fsync is not None:
+        if log_fsync not in LOG_FSYNC_POLICIES:
+            raise ValueError("Unknown log fsync policy '{}', expected one of: {}".format(
+                log_fsync, ', '.join(LOG_FSYNC_POLICIES)))
+        LOG_FSYNC = log_fsync
+
+
+def _fsync(log_file):
+    log_file.flush()
+    if hasattr(log_file, 'fsync'):
+        log_file.fsync()
+    else:
+        os.fsync(log_file.fileno())
+
+
+class LogWriterThread(threading.Thread):
+
+    """A thread which runs the writes to the logfiles of all stages.
+
+    Logfiles are written on this thread instead of the event loop which runs
+    the jobs, so that a slow filesystem doesn't hold up the scheduling of jobs
+    and the processing of the output of other stages. The queue of the thread
+    is not bounded, the writers of each logfile limit how much they queue,
+    see :py:class:`ThreadedLogFile`.
+    """
+
+    def __init__(self):
+        super(LogWriterThread, self).__init__(name='log-writer')
+        self.daemon = True
+        self.queue = Queue()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            function, args = item
+            function(*args)
+
+    def put(self, function, *args):
+        """Run a function on the writer thread, without waiting for it."""
+        self.queue.put((function, args))
+
+    def submit(self, function, *args):
+        """Run a function on the writer thread.
+
+        :returns: a concurrent future which is done once the function and
+            everything before it has run
+        """
+        future = Future()
+
+        def run():
+            try:
+                future.set_result(function(*args))
+            except Exception as exc:
+                future.set_exception(exc)
+
+        self.put(run)
+        return future
+
+    def stop(self):
+        self.queue.put(None)
+        self.join()
+
+
+_log_writer = None
+_log_writer_lock = threading.Lock()
+
+
+def get_log_writer():
+    """Get the log writer thread, which is started when it's first needed.
+
+    :returns: the thread, or None if the interpreter is shutting down
+    """
+    global _log_writer
+    with _log_writer_lock:
+        if _log_writer is None:
+            _log_writer = LogWriterThread()
+            _log_writer.start()
+            atexit.register(_stop_log_writer)
+        return _log_writer if _log_writer.is_alive() else None
+
+
+def _stop_log_writer():
+    # Write out what is queued, and write directly from now on
+    _log_writer.stop()
+
+
+class ThreadedLogFile(object):
+
+    """A file-like object which writes to a logfile on the log writer thread.
+
+    Output is collected into large blocks before it is handed to the writer
+    thread. Errors of writes are raised by the next call to :py:meth:`flush`
+    or :py:meth:`close`.
+
+    At most `MAX_QUEUED_LOG_WRITES` blocks of a logfile wait for the writer
+    thread. Beyond that, a write waits on the calling thread, unless the
+    logfile is written from the event loop, in which case its flow control
+    is paused instead, see :py:meth:`set_flow_control`. The event loop waits
+    for :py:meth:`flush_async` and :py:meth:`close_async` instead of
+    :py:meth:`flush` and :py:meth:`close`.
+    """
+
+    def __init__(self, log_file, fsync=None):
+        """
+        :param log_file: The open file-like object to write to
+        :param fsync: When the logfile is synced to the disk, one of `LOG_FSYNC_POLICIES`
+        """
+        self.log_file = log_file
+        self.fsync = LOG_FSYNC if fsync is None else fsync
+
+        self.chunks = []
+        self.size = 0
+        self.buffered_since = None
+        self.error = None
+
+        # The blocks which have been handed off, have been written, and have been flushed
+        self.condition = threading.Condition()
+        self.n_handed_off = 0
+        self.n_written = 0
+        self.n_flushed = 0
+        self.close_future = None
+
+        self.flow_control = None
+        self.loop = None
+        self.paused = False
+
+    def set_flow_control(self, flow_control):
+        """Write this logfile from the event loop, without waiting for the writer thread.
+
+        :param flow_control: An object whose `pause_output` method is called
+            when too many blocks wait for the writer thread, and whose
+            `resume_output` method is called on the event loop once enough of
+            them have been written
+        """
+        self.flow_control = flow_control
+        self.loop = get_loop()
+
+    def write(self, data):
+        if len(data) == 0:
+            return
+        self.chunks.append(data)
+        self.size += len(data)
+        now = time.time()
+        if self.buffered_since is None:
+            self.buffered_since = now
+        if self.size >= LOG_WRITE_SIZE or now - self.buffered_since >= LOG_WRITE_INTERVAL:
+            self._hand_off()
+
+    def _hand_off(self):
+        if self.size == 0:
+            return
+        data = b''.join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        self.buffered_since = None
+
+        log_writer = get_log_writer()
+        if log_writer is None:
+            self._write(data)
+            with self.condition:
+                self.n_handed_off += 1
+                self.n_written += 1
+            return
+
+        with self.condition:
+            if self.flow_control is None:
+                while self.n_handed_off - self.n_written >= MAX_QUEUED_LOG_WRITES:
+                    self.condition.wait()
+            self.n_handed_off += 1
+            if self.flow_control is not None and not self.paused and \
+                    self.n_handed_off - self.n_written >= MAX_QUEUED_LOG_WRITES:
+                self.paused = True
+                self.flow_control.pause_output()
+        log_writer.put(self._write_queued, data)
+
+    def _submit(self, function, *args):
+        self._hand_off()
+        log_writer = get_log_writer()
+        if log_writer is not None:
+            return log_writer.submit(function, *args)
+        future = Future()
+        future.set_result(function(*args))
+        return future
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def flush_async(self):
+        """Write out everything which has been written.
+
+        :returns: a concurrent future which is done once it is in the logfile
+        """
+        if self.close_future is not None:
+            return self.close_future
+        return self._submit(self._flush, self.n_handed_off)
+
+    def close_async(self):
+        """Write out everything which has been written and close the logfile.
+
+        :returns: a concurrent future which is done once the logfile is closed
+        """
+        if self.close_future is None:
+            self.close_future = self._submit(self._close)
+        return self.close_future
+
+    def flush(self):
+        """Wait until everything which has been written is in the logfile."""
+        if self.size > 0 or self.n_flushed != self.n_handed_off:
+            self.flush_async().result()
+        self._raise_error()
+
+    def close(self):
+        self.close_async().result()
+        self._raise_error()
+
+    # The following methods run on the log writer thread
+
+    def _call(self, function, *args):
+        try:
+            function(*args)
+        except Exception as exc:
+            self.error = self.error or exc
+
+    def _write(self, data):
+        self._call(self.log_file.write, data)
+        if self.fsync == LOG_FSYNC_ALWAYS:
+            self._call(_fsync, self.log_file)
+
+    def _write_queued(self, data):
+        self._write(data)
+        with self.condition:
+            self.n_written += 1
+            self.condition.notify_all()
+            if self.paused and self.n_handed_off - self.n_written <= MAX_QUEUED_LOG_WRITES // 2:
+                self.paused = False
+                self.loop.call_soon_threadsafe(self.flow_control.resume_output)
+
+    def _flush(self, n_handed_off):
+        self._call(self.log_file.flush)
+        self.n_flushed = n_handed_off
+
+    def _close(self):
+        if self.fsync != LOG_FSYNC_NEVER:
+            self._call(_fsync, self.log_file)
+        self._call(self.log_file.close)
+        self.n_flushed = self.n_handed_off
+
+
+def get_logfile_paths(logfile_name):
+    """Get the files which make up a plain or compressed logfile."""
+    if logfile_name.endswith(COMPRESSED_LOG_SUFFIX):
+        return [logfile_name, logfile_name + BLOCK_INDEX_SUFFIX]
+    return [logfile_name]
+
+
+def _unlink_if_exists(path):
+    try:
+        os.unlink(path)
+    except OSError as exc:
+        if exc.errno != errno.ENOENT:
+            raise
+
+
+def load_log_index(logfile_dir_path):
+    """Load the logfile index of a job's log directory.
+
+    :returns: Map from `{VERB}.{STAGE}` to the (oldest, latest) logfile indices
+    :rtype: dict
+    """
+    try:
+        with open(os.path.join(logfile_dir_path, LOG_INDEX_FILENAME)) as index_file:
+            return dict([(k, tuple(v)) for k, v in json.load(index_file).items()])
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def store_log_index(logfile_dir_path, log_index):
+    """Atomically replace the logfile index of a job's log directory."""
+    index_path = os.path.join(logfile_dir_path, LOG_INDEX_FILENAME)
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'w') as index_file:
+        json.dump(log_index, index_file, sort_keys=True)
+    os.rename(tmp_path, index_path)
+
+
+def _scan_log_index(logfile_basename):
+    """Reconstruct the logfile indices of a verb and stage from the logfiles on disk."""
+    logfile_index_re = re.compile(r'\.([0-9]+)\.log(\.gz)?$')
+    existing_logfile_indices = sorted([
+        int(match.group(1))
+        for match in [logfile_index_re.search(lf) for lf in glob('{}.*.log*'.format(logfile_basename))]
+        if match is not None])
+    if len(existing_logfile_indices) == 0:
+        return None
+    return (existing_logfile_indices[0], existing_logfile_indices[-1])
+
+
+def _tail(data, size):
+    """Get the tail of some output, starting at a line or at least at a character.
+
+    :param data: The end of the output
+    :param size: The total size of the output
+    :returns: tuple of the number of bytes which are left out, and the tail
+    """
+    if len(data) < size:
+        newline = data.find(b'\n')
+        if newline >= 0:
+            data = data[newline + 1:]
+        else:
+            # Don't start in the middle of a UTF-8 sequence
+            start = 0
+            while start < len(data) and (bytearray(data[start:start + 1])[0] & 0xC0) == 0x80:
+                start += 1
+            data = data[start:]
+    return size - len(data), data
+
+
+class ChunkedBuffer(object):
+
+    """A bytes buffer which keeps a list of chunks in memory up to a cap.
+
+    Once more than `max_size` bytes have been written, the buffered chunks and
+    all further data are written to a spill file instead, so the memory used
+    by a buffer is bounded no matter how much output a stage produces.
+    """
+
+    def __init__(self, spill_path, max_size=None):
+        """
+        :param spill_path: The file to which the buffer spills when it overflows
+        :param max_size: The number of bytes kept in memory, defaults to `MAX_BUFFER_SIZE`
+        """
+        self.spill_path = spill_path
+        self.max_size = MAX_BUFFER_SIZE if max_size is None else max_size
+
+        self.chunks = []
+        self.size = 0
+        self.spill_file = None
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def spilled(self):
+        return self.spill_file is not None
+
+    def write(self, data):
+        if len(data) == 0:
+            return
+        self.size += len(data)
+        if self.spill_file is not None:
+            self.spill_file.write(data)
+            return
+        self.chunks.append(data)
+        if self.size > self.max_size:
+            self.spill_file = open(self.spill_path, 'wb')
+            self.spill_file.writelines(self.chunks)
+            self.chunks = []
+
+    def iter_chunks(self, chunk_size=None):
+        """Iterate over the buffered bytes without reading a spilled buffer into memory at once."""
+        if self.spill_file is None:
+            for chunk in self.chunks:
+                yield chunk
+            return
+        self.spill_file.flush()
+        with open(self.spill_path, 'rb') as spill_file:
+            while True:
+                chunk = spill_file.read(chunk_size or self.max_size)
+                if len(chunk) == 0:
+                    break
+                yield chunk
+
+    def getvalue(self):
+        """Get the bytes which are buffered in memory, see :py:meth:`get_tail` for spilled buffers."""
+        assert self.spill_file is None
+        # Join the chunks once, so repeated reads don't repeat the work
+        if len(self.chunks) > 1:
+            self.chunks = [b''.join(self.chunks)]
+        return self.chunks[0] if len(self.chunks) > 0 else b''
+
+    def get_tail(self):
+        """Get at most the last `max_size` buffered bytes, starting at a line.
+
+        Only the tail of a spilled buffer is read back from the spill file.
+
+        :returns: tuple of the number of bytes which are left out, and the tail
+        """
+        if self.spill_file is None:
+            return 0, self.getvalue()
+        self.spill_file.flush()
+        with open(self.spill_path, 'rb') as spill_file:
+            spill_file.seek(self.size - self.max_size)
+            return _tail(spill_file.read(self.max_size), self.size)
+
+    def close(self):
+        if self.spill_file is not None:
+            self.spill_file.close()
+
 
 class IOBufferContainer(object):
 
@@ -32,6 +525,19 @@ class IOBufferContainer(object):
 
     This class will open a logfile for a given job stage and write to it
     continuously while receiving stdout and stderr.
+
+    Stdout and stderr are kept in memory up to `MAX_BUFFER_SIZE` bytes each,
+    beyond which they are spilled to files next to the logfile. The
+    interleaved output is not buffered at all, since it is exactly what is
+    written to the logfile, and is read back from there when it is requested.
+    Of output which is larger than `MAX_BUFFER_SIZE`, only the tail is read
+    back, and the logfile holds the rest.
+
+    If `COMPRESS_LOGS` is set, the logfile and the saved stderr output are
+    written as compressed logfiles with a block index instead.
+
+    The logfile is written by the :py:class:`LogWriterThread`, see
+    :py:class:`ThreadedLogFile`.
     """
 
     def __init__(self, label, job_id, stage_label, event_queue, log_path):
@@ -41,69 +547,177 @@ class IOBufferContainer(object):
         self.event_queue = event_queue
         self.log_path = log_path
 
+        # Output events which nobody consumes aren't generated at all
+        self.emits_stdout = wants_event(event_queue, 'STDOUT')
+        self.emits_stderr = wants_event(event_queue, 'STDERR')
+
         self.is_open = False
-        self.stdout_buffer = b""
-        self.stderr_buffer = b""
-        self.interleaved_buffer = b""
 
         # Construct the logfile path for this job and stage
         logfile_dir_path = os.path.join(log_path, self.job_id)
         self.logfile_basename = os.path.join(logfile_dir_path, '.'.join([self.label, self.stage_label]))
-        self.logfile_name = '{}.log'.format(self.logfile_basename)
+        self.compress = COMPRESS_LOGS
+        self.logfile_suffix = LOGFILE_SUFFIX + (COMPRESSED_LOG_SUFFIX if self.compress else '')
+        self.logfile_name = self.logfile_basename + self.logfile_suffix
 
         # Create the logfile dir if it doesn't exist
         if not os.path.exists(logfile_dir_path):
             mkdir_p(logfile_dir_path)
 
-        # Get the existing number of logfiles
-        # TODO: Make this number global across all build stages
-        existing_logfile_indices = sorted([int(lf.split('.')[-2])
-                                           for lf in glob('{}.*.log'.format(self.logfile_basename))])
-        if len(existing_logfile_indices) == 0:
-            self.logfile_index = 0
+        # Get the index of the latest logfile from the job's log index, which
+        # is only reconstructed from the logfiles on disk if it is missing
+        self.logfile_dir_path = logfile_dir_path
+        self.log_index_key = '.'.join([self.label, self.stage_label])
+        log_index = load_log_index(logfile_dir_path) or {}
+        logfile_indices = log_index.get(self.log_index_key) or _scan_log_index(self.logfile_basename)
+        if logfile_indices is not None:
+            self.oldest_logfile_index, latest_logfile_index = logfile_indices
+            self.logfile_index = 1 + latest_logfile_index
         else:
-            self.logfile_index = 1 + existing_logfile_indices[-1]
+            self.oldest_logfile_index = 0
+            self.logfile_index = 0
 
         # Generate the logfile name
-        self.unique_logfile_name = '{}.{:0>{}}.log'.format(self.logfile_basename, self.logfile_index, 3)
+        self.unique_logfile_name = self.get_unique_logfile_name(self.logfile_index)
 
-        # Remove colliding file if necessary
-        if os.path.exists(self.logfile_name):
-            os.unlink(self.logfile_name)
+        # Remove the latest logfile, since it is a hard link to the previous unique logfile,
+        # in both formats so that a stale logfile in the other format isn't mistaken for it
+        for logfile_path in self._get_logfile_variants(self.logfile_basename):
+            _unlink_if_exists(logfile_path)
 
         # Open logfile
-        self.log_file = open(self.logfile_name, 'wb')
+        if self.compress:
+            self.log_file = ThreadedLogFile(CompressedLogWriter(self.logfile_name))
+        else:
+            self.log_file = ThreadedLogFile(open(self.logfile_name, 'wb'))
         self.is_open = True
 
+        # Uncompressed stderr is spilled straight to the file in which it is kept after the stage
+        self.stderr_logfile_name = self.unique_logfile_name[:-len(self.logfile_suffix)] + LOGFILE_SUFFIX + \
+            STDERR_LOGFILE_SUFFIX + (COMPRESSED_LOG_SUFFIX if self.compress else '')
+        self.stdout_buffer = ChunkedBuffer('{}.stdout'.format(self.logfile_name))
+        self.stderr_buffer = ChunkedBuffer(
+            '{}.stderr'.format(self.logfile_name) if self.compress else self.stderr_logfile_name)
+
+        # Warnings and errors are extracted while the output is received
+        self.diagnostics = DiagnosticsExtractor()
+
+    def write_stdout(self, data):
+        """Buffer and log encoded stdout data.
+        :type data: bytes
+        """
+        self.stdout_buffer.write(data)
+        self.log_file.write(data)
+        self.diagnostics.feed('stdout', data)
+
+    def write_stderr(self, data):
+        """Buffer and log encoded stderr data.
+        :type data: bytes
+        """
+        self.stderr_buffer.write(data)
+        self.log_file.write(data)
+        self.diagnostics.feed('stderr', data)
+
+    def flush_output(self):
+        """Emit any output events which have been held back."""
+        pass
+
     def close(self):
+        self.flush_output()
+
         # Close logfile
         self.log_file.close()
+        self.stdout_buffer.close()
+        self.stderr_buffer.close()
         self.is_open = False
 
-        # Copy logfile to unique name
-        shutil.copy(self.logfile_name, self.unique_logfile_name)
-
-        # Remove older logfiles
-        for logfile_name in glob('{}.*.log'.format(self.logfile_basename)):
-            if (self.logfile_index - int(logfile_name.split('.')[-2])) >= MAX_LOGFILE_HISTORY:
-                os.unlink(logfile_name)
+        # Spilled stdout is only needed while the stage is running
+        if self.stdout_buffer.spilled:
+            os.unlink(self.stdout_buffer.spill_path)
+
+        # Link logfile to unique name
+        for logfile_path, unique_logfile_path in zip(
+                get_logfile_paths(self.logfile_name), get_logfile_paths(self.unique_logfile_name)):
+            _unlink_if_exists(unique_logfile_path)
+            try:
+                os.link(logfile_path, unique_logfile_path)
+            except (AttributeError, OSError):
+                # Fall back to a copy where hard links aren't supported
+                shutil.copy(logfile_path, unique_logfile_path)
+
+        # Remove logfiles which have fallen out of the history
+        oldest_logfile_index = max(self.oldest_logfile_index, 1 + self.logfile_index - MAX_LOGFILE_HISTORY)
+        for logfile_index in range(self.oldest_logfile_index, oldest_logfile_index):
+            unique_logfile_basename = '{}.{:0>{}}'.format(self.logfile_basename, logfile_index, 3)
+            for logfile_path in self._get_logfile_variants(unique_logfile_basename):
+                _unlink_if_exists(logfile_path)
+
+        # Update the log index, which may have been updated by other stages in the meantime
+        log_index = load_log_index(self.logfile_dir_path) or {}
+        log_index[self.log_index_key] = (oldest_logfile_index, self.logfile_index)
+        store_log_index(self.logfile_dir_path, log_index)
 
         # Save output from stderr (these don't get deleted until cleaning the logfile directory)
-        if len(self.stderr_buffer) > 0:
-            with open(self.unique_logfile_name + '.stderr', 'wb') as logfile:
-                logfile.write(self.stderr_buffer)
+        if self.compress:
+            if len(self.stderr_buffer) > 0:
+                stderr_logfile = CompressedLogWriter(self.stderr_logfile_name)
+                for chunk in self.stderr_buffer.iter_chunks():
+                    stderr_logfile.write(chunk)
+                stderr_logfile.close()
+            if self.stderr_buffer.spilled:
+                os.unlink(self.stderr_buffer.spill_path)
+        elif len(self.stderr_buffer) > 0 and not self.stderr_buffer.spilled:
+            with open(self.stderr_logfile_name, 'wb') as logfile:
+                logfile.write(self.stderr_buffer.getvalue())
+
+    def _get_logfile_variants(self, logfile_basename):
+        """Get the files which make up a logfile in either format."""
+        return (get_logfile_paths(logfile_basename + LOGFILE_SUFFIX) +
+                get_logfile_paths(logfile_basename + LOGFILE_SUFFIX + COMPRESSED_LOG_SUFFIX))
+
+    def get_unique_logfile_name(self, logfile_index):
+        """Get the name of a previous logfile of this verb and stage."""
+        return '{}.{:0>{}}{}'.format(self.logfile_basename, logfile_index, 3, self.logfile_suffix)
+
+    def close_log(self):
+        """Close the logfile without blocking the event loop.
+
+        :returns: an asyncio future which is done once the logfile is closed,
+            after which reading it and :py:meth:`close` don't wait for the log
+            writer thread anymore
+        """
+        return asyncio.wrap_future(self.log_file.close_async(), loop=get_loop())
 
     def get_interleaved_log(self):
-        """Get decoded interleaved log."""
-        return self._decode(self.interleaved_buffer)
+        """Get decoded interleaved log, or its tail if it is larger than `MAX_BUFFER_SIZE`."""
+        if self.is_open:
+            self.log_file.flush()
+        size = len(self.stdout_buffer) + len(self.stderr_buffer)
+        if size <= MAX_BUFFER_SIZE:
+            return self._decode(read_log(self.logfile_name))
+
+        # Keep only the last chunks while reading the logfile
+        chunks = deque()
+        chunks_size = 0
+        for chunk in iter_log(self.logfile_name):
+            chunks.append(chunk)
+            chunks_size += len(chunk)
+            while chunks_size - len(chunks[0]) >= MAX_BUFFER_SIZE:
+                chunks_size -= len(chunks.popleft())
+        return self._decode_tail(*_tail(b''.join(chunks)[-MAX_BUFFER_SIZE:], size))
 
     def get_stdout_log(self):
-        """Get decoded stdout log."""
-        return self._decode(self.stdout_buffer)
+        """Get decoded stdout log, or its tail if it is larger than `MAX_BUFFER_SIZE`."""
+        return self._decode_tail(*self.stdout_buffer.get_tail())
 
     def get_stderr_log(self):
-        """Get decoded stderr log."""
-        return self._decode(self.stderr_buffer)
+        """Get decoded stderr log, or its tail if it is larger than `MAX_BUFFER_SIZE`."""
+        return self._decode_tail(*self.stderr_buffer.get_tail())
+
+    def get_diagnostics(self):
+        """Get the warnings and errors found in the output, see :py:class:`DiagnosticsExtractor`."""
+        self.diagnostics.flush()
+        return self.diagnostics.get_diagnostics()
 
     def _encode(self, data):
         """Encode a Python str into bytes.
@@ -117,6 +731,13 @@ class IOBufferContainer(object):
         """
         return data.decode('utf-8')
 
+    def _decode_tail(self, n_omitted, data):
+        """Decode the tail of some output, noting how much of it is left out."""
+        if n_omitted == 0:
+            return self._decode(data)
+        notice = '[{} bytes of output omitted, see {}]\n'.format(n_omitted, self.unique_logfile_name)
+        return notice + self._decode(data)
+
     def __del__(self):
         if self.is_open:
             self.close()
@@ -146,48 +767,43 @@ class IOBufferLogger(IOBufferContainer):
         """
         :type data: str
         """
-        # Buffer the encoded data
+        # Buffer and save the encoded data
         data += end
-        encoded_data = self._encode(data)
-        self.stdout_buffer += encoded_data
-        self.interleaved_buffer += encoded_data
-
-        # Save the encoded data
-        self.log_file.write(encoded_data)
+        self.write_stdout(self._encode(data))
 
         # Emit event with decoded Python str
-        self.event_queue.put(ExecutionEvent(
-            'STDOUT',
-            job_id=self.job_id,
-            stage_label=self.stage_label,
-            data=data))
+        if self.emits_stdout:
+            self.event_queue.put(ExecutionEvent(
+                'STDOUT',
+                job_id=self.job_id,
+                stage_label=self.stage_label,
+                data=data))
 
     def err(self, data, end='\n'):
         """
         :type data: str
         """
-        # Buffer the encoded data
+        # Buffer and save the encoded data
         data += end
-        encoded_data = self._encode(data)
-        self.stderr_buffer += encoded_data
-        self.interleaved_buffer += encoded_data
-
-        # Save the encoded data
-        self.log_file.write(encoded_data)
+        self.write_stderr(self._encode(data))
 
         # Emit event with decoded Python str
-        self.event_queue.put(ExecutionEvent(
-            'STDERR',
-            job_id=self.job_id,
-            stage_label=self.stage_label,
-            data=data))
+        if self.emits_stderr:
+            self.event_queue.put(ExecutionEvent(
+                'STDERR',
+                job_id=self.job_id,
+                stage_label=self.stage_label,
+                data=data))
 
 
 class IOBufferProtocol(IOBufferContainer, AsyncSubprocessProtocol):
 
     """An asyncio protocol that collects stdout and stderr.
 
-    This class also generates `stdout` and `stderr` events.
+    This class also generates `stdout` and `stderr` events. Consecutive output
+    from the same stream is coalesced into batches of at most
+    `OUTPUT_BATCH_SIZE` bytes, which are emitted after at most
+    `OUTPUT_BATCH_INTERVAL` seconds.
 
     Since the underlying asyncio API constructs the actual protocols, this
     class provides a factory method to inject the job and stage information
@@ -198,64 +814,166 @@ class IOBufferProtocol(IOBufferContainer, AsyncSubprocessProtocol):
         IOBufferContainer.__init__(self, label, job_id, stage_label, event_queue, log_path)
         AsyncSubprocessProtocol.__init__(self, *args, **kwargs)
 
-        self.intermediate_stdout_buffer = b''
-        self.intermediate_stderr_buffer = b''
-
-    def _split(self, data):
-        try:
-            last_break = data.rindex(b'\n') + 1
-            return data[0:last_break], data[last_break:]
-        except ValueError:
-            return b'', data
+        # The output is received on the event loop, which must not wait for the log writer thread
+        self.log_file.set_flow_control(self)
+        self.output_paused = False
+        # The streams of output which are still open, and whether the process
+        # exited while its output was paused
+        self.open_streams = set()
+        self.exited_while_paused = False
+
+        # Chunks of incomplete lines, which are held back until a line break is received
+        self.intermediate_stdout_chunks = []
+        self.intermediate_stderr_chunks = []
+
+        # The batch of output which hasn't been emitted yet
+        self.batch_event_id = None
+        self.batch_chunks = []
+        self.batch_size = 0
+        self.batch_timer = None
+
+    def _split(self, intermediate_chunks, data):
+        """Get the complete lines from the intermediate chunks and data.
+
+        The incomplete tail of the data is kept in the intermediate chunks, so
+        that output without line breaks isn't copied on every new chunk.
+        """
+        last_break = data.rfind(b'\n') + 1
+        if last_break == 0:
+            intermediate_chunks.append(data)
+            return b''
+        intermediate_chunks.append(data[0:last_break])
+        lines = b''.join(intermediate_chunks)
+        del intermediate_chunks[:]
+        if last_break < len(data):
+            intermediate_chunks.append(data[last_break:])
+        return lines
 
     def on_stdout_received(self, data):
         """
         :type data: encoded bytes
         """
 
-        data, self.intermediate_stdout_buffer = self._split(self.intermediate_stdout_buffer + data)
+        data = self._split(self.intermediate_stdout_chunks, data)
+        if len(data) == 0:
+            return
 
-        self.stdout_buffer += data
-        self.interleaved_buffer += data
-        self.log_file.write(data)
+        self.write_stdout(data)
 
-        # Get the decoded Python str
-        decoded_data = self._decode(data)
-
-        # Emit event with decoded Python str
-        self.event_queue.put(ExecutionEvent(
-            'STDOUT',
-            job_id=self.job_id,
-            stage_label=self.stage_label,
-            data=decoded_data))
+        if self.emits_stdout:
+            self._batch_output('STDOUT', data)
 
     def on_stderr_received(self, data):
         """
         :type data: encoded bytes
         """
 
-        data, self.intermediate_stderr_buffer = self._split(self.intermediate_stderr_buffer + data)
-
-        self.stderr_buffer += data
-        self.interleaved_buffer += data
-        self.log_file.write(data)
-
-        # Get the decoded Python str
-        decoded_data = self._decode(data)
+        data = self._split(self.intermediate_stderr_chunks, data)
+        if len(data) == 0:
+            return
+
+        self.write_stderr(data)
+
+        if self.emits_stderr:
+            self._batch_output('STDERR', data)
+
+    def _get_read_transports(self):
+        """Get the transports which read the output of the subprocess."""
+        # Output of emulated terminals is read by separate transports
+        transports = [getattr(self, name)[0] for name in ['stdout_tuple', 'stderr_tuple'] if hasattr(self, name)]
+        if len(transports) == 0 and getattr(self, 'transport', None) is not None:
+            transports = [self.transport.get_pipe_transport(fd) for fd in [1, 2]]
+        return [t for t in transports if t is not None]
+
+    def pause_output(self):
+        """Stop reading the output of the subprocess while too much of it waits to be logged."""
+        self.output_paused = True
+        for transport in self._get_read_transports():
+            transport.pause_reading()
+
+    def resume_output(self):
+        """Read the output of the subprocess again once enough of it has been logged."""
+        self.output_paused = False
+        for transport in self._get_read_transports():
+            if not getattr(transport, 'is_closing', lambda: False)():
+                transport.resume_reading()
+
+    def connection_made(self, transport):
+        AsyncSubprocessProtocol.connection_made(self, transport)
+        self.open_streams.update([fd for fd in [1, 2] if transport.get_pipe_transport(fd) is not None])
+
+    def on_stdout_open(self):
+        self.open_streams.add(1)
+
+    def on_stderr_open(self):
+        self.open_streams.add(2)
+
+    def on_stdout_close(self, exc):
+        self._on_stream_closed(1)
+
+    def on_stderr_close(self, exc):
+        self._on_stream_closed(2)
+
+    def pipe_connection_lost(self, fd, exc):
+        self._on_stream_closed(fd)
+
+    def _on_stream_closed(self, fd):
+        self.open_streams.discard(fd)
+        if self.exited_while_paused and len(self.open_streams) == 0:
+            self.exited_while_paused = False
+            AsyncSubprocessProtocol.process_exited(self)
+
+    def process_exited(self):
+        # Output which is held back while the logfile is behind is read before the stage completes
+        if self.output_paused and len(self.open_streams) > 0:
+            self.exited_while_paused = True
+            return
+        AsyncSubprocessProtocol.process_exited(self)
+
+    def _batch_output(self, event_id, data):
+        """Add output to the current batch, which is emitted when it is full or old enough."""
+        # Keep the order of stdout and stderr
+        if event_id != self.batch_event_id:
+            self.flush_output()
+            self.batch_event_id = event_id
+
+        self.batch_chunks.append(data)
+        self.batch_size += len(data)
+
+        if self.batch_size >= OUTPUT_BATCH_SIZE:
+            self.flush_output()
+        elif self.batch_timer is None:
+            self.batch_timer = get_loop().call_later(OUTPUT_BATCH_INTERVAL, self.flush_output)
+
+    def flush_output(self):
+        """Emit the current batch of output, if any."""
+        if self.batch_timer is not None:
+            self.batch_timer.cancel()
+            self.batch_timer = None
+        if self.batch_size == 0:
+            return
+
+        data = b''.join(self.batch_chunks)
+        self.batch_chunks = []
+        self.batch_size = 0
 
         # Emit event with decoded Python str
         self.event_queue.put(ExecutionEvent(
-            'STDERR',
+            self.batch_event_id,
             job_id=self.job_id,
             stage_label=self.stage_label,
-            data=decoded_data))
+            data=self._decode(data)))
+
+    def on_process_exited(self, returncode):
+        # Emit the last batch before the executor is notified about the end of the stage
+        self.flush_output()
 
     def on_process_exited2(self, returncode):
         """
         Dump anything remaining in the intermediate buffers.
         """
 
-        if len(self.intermediate_stdout_buffer) > 0:
-            self.on_stdout_received(self.intermediate_stdout_buffer + b'\n')
-        if len(self.intermediate_stderr_buffer) > 0:
-            self.on_stderr_received(self.intermediate_stderr_buffer + b'\n')
+        if len(self.intermediate_stdout_chunks) > 0:
+            self.on_stdout_received(b'\n')
+        if len(self.intermediate_stderr_chunks) > 0:
+            self.on_stderr_received(b'\n')
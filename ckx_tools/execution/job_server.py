@@ -21,16 +21,24 @@ from termios import FIONREAD
 import array
 import errno
 import fcntl
+import heapq
+import itertools
 import os
 import re
 import subprocess
+import threading
 import time
 
+import trollius as asyncio
+
 from ckx_tools.common import log
 from ckx_tools.common import version_tuple
+from ckx_tools.common import wide_log
 
 from ckx_tools.terminal_color import ColorMapper
 
+from .events import ExecutionEvent
+
 mapper = ColorMapper()
 clr = mapper.clr
 
@@ -88,6 +96,89 @@ def test_gnu_make_support():
     return (ret == 0)
 
 
+# Period in seconds after which tokens are offered to waiters again when the
+# load or memory limits prevented a token from being handed out
+CONDITIONS_RETRY_PERIOD = 0.1
+
+# Default period in seconds with which the system load and memory are sampled
+DEFAULT_SAMPLE_PERIOD = 1.0
+# Default low watermarks, relative to the high watermarks, below which jobs are
+# admitted again after the load or memory usage exceeded the high watermark
+DEFAULT_LOAD_LOW_RATIO = 0.9
+DEFAULT_MEM_LOW_MARGIN = 5.0
+
+
+def parse_watermarks(value, parse):
+    """Parse a limit given as 'HIGH' or 'HIGH:LOW'.
+
+    :param value: the limit
+    :type value: str
+    :param parse: function converting one watermark to a float
+    :returns: tuple of the high and the low watermark, the low watermark is
+    None if it was not given
+    :raises: ValueError if the limit is malformed or LOW is above HIGH
+    """
+    parts = str(value).split(':')
+    if len(parts) > 2:
+        raise ValueError("Expected 'HIGH' or 'HIGH:LOW', got '%s'" % value)
+    high = parse(parts[0])
+    low = parse(parts[1]) if len(parts) == 2 else None
+    if low is not None and low > high:
+        raise ValueError("The low watermark of '%s' is above the high watermark" % value)
+    return high, low
+
+
+def parse_load(value):
+    load = float(value)
+    if load <= 0:
+        raise ValueError("The load limit must be positive, got '%s'" % value)
+    return load
+
+
+def parse_mem(value):
+    """Convert a memory amount to a percentage of the total physical memory.
+
+    :param value: 'P%' for percentage or 'N' for absolute value in bytes, 'Nk'
+    for kilobytes, 'Nm' for megabytes, and 'Ng' for gigabytes.
+    :raises: ValueError if the amount is malformed
+    """
+    if type(value) is float or type(value) is int:
+        return max(0.0, min(100.0, float(value)))
+
+    m_percent = re.match(r'^\s*([0-9.]+)\s*%\s*$', value)
+    m_abs = re.match(r'^\s*([0-9.]+)\s*([kKmMgG]?)\s*$', value)
+
+    if m_percent:
+        mem_percent = float(m_percent.group(1))
+    elif m_abs:
+        val = float(m_abs.group(1))
+        mag = pow(1024.0, ' kmg'.index(m_abs.group(2).lower() or ' '))
+
+        _, total_mem = memory_usage()
+        if total_mem is None:
+            raise ValueError("psutil is required for absolute memory limits")
+
+        mem_percent = 100.0 * val * mag / total_mem
+    else:
+        raise ValueError("Invalid memory amount '%s'" % value)
+
+    return max(0.0, min(100.0, mem_percent))
+
+
+class ResourceSampler(threading.Thread):
+
+    """Thread which periodically samples the system load and memory usage."""
+
+    def __init__(self):
+        super(ResourceSampler, self).__init__()
+        self.daemon = True
+
+    def run(self):
+        while True:
+            time.sleep(JobServer._sample_period)
+            JobServer._sample()
+
+
 class JobServer(object):
     # Whether the job server has been initialized
     _initialized = False
@@ -100,10 +191,28 @@ class JobServer(object):
     _load_ok = True
     _mem_ok = True
     _internal_jobs = []
-    _max_load = 0
+    _max_load = None
+    _max_mem = None
     _max_jobs = 0
+
+    # Low watermarks, below which jobs are admitted again after throttling
+    _load_low = None
+    _mem_low = None
+    # Most recently sampled 5-minute load average and memory usage in percent
+    _load = None
+    _mem_percent = None
+    _sample_period = DEFAULT_SAMPLE_PERIOD
+    _sampler = None
+    # Queue of the executor which is running, to which throttling messages are put
+    _event_queue = None
     _job_pipe = os.pipe()
 
+    # Futures waiting for a token, as a heap of (-priority, sequence, future)
+    _token_waiters = []
+    _token_waiter_sequence = itertools.count()
+    # Event loop which is watching the job pipe for returned tokens, if any
+    _watching_loop = None
+
     # Setting fd inheritance is required in Python > 3.4
     # This is set by default in Python 2.7
     # For more info see: https://docs.python.org/3.4/library/os.html#fd-inheritance
@@ -134,6 +243,26 @@ class JobServer(object):
         for i in range(cls._max_jobs):
             os.write(cls._job_pipe[1], b'+')
 
+    @classmethod
+    def _set_max_load(cls, max_load, load_low=None):
+        """
+        Set the load average above which no more jobs are started.
+
+        :param max_load: the high watermark of the 5-minute load average
+        :param load_low: the load average below which jobs are started again
+        after throttling, defaults to 90% of max_load
+        """
+
+        cls._max_load = None if max_load is None else float(max_load)
+        if cls._max_load is None:
+            cls._load_low = None
+        elif load_low is None:
+            cls._load_low = DEFAULT_LOAD_LOW_RATIO * cls._max_load
+        else:
+            cls._load_low = min(float(load_low), cls._max_load)
+
+        cls._start_sampler()
+
     @classmethod
     def _set_max_mem(cls, max_mem):
         """
@@ -142,68 +271,99 @@ class JobServer(object):
         :param max_mem: String describing the maximum memory that can be used
         on the system. It can either describe memory percentage or absolute
         amount.  Use 'P%' for percentage or 'N' for absolute value in bytes,
-        'Nk' for kilobytes, 'Nm' for megabytes, and 'Ng' for gigabytes.
+        'Nk' for kilobytes, 'Nm' for megabytes, and 'Ng' for gigabytes. An
+        optional low watermark, below which jobs are started again after
+        throttling, can be appended as in 'HIGH:LOW'. It defaults to 5% of the
+        total memory below the high watermark.
         :type max_mem: str
+        :raises: ValueError if max_mem is malformed
         """
 
         if max_mem is None:
             cls._max_mem = None
+            cls._mem_low = None
+        else:
+            cls._max_mem, cls._mem_low = parse_watermarks(max_mem, parse_mem)
+            if cls._mem_low is None:
+                cls._mem_low = max(0.0, cls._max_mem - DEFAULT_MEM_LOW_MARGIN)
+
+        cls._start_sampler()
+
+    @classmethod
+    def _start_sampler(cls):
+        """Take a first sample and start sampling in the background, if there are limits."""
+        if cls._max_load is None and cls._max_mem is None:
+            cls._load_ok = True
+            cls._mem_ok = True
             return
-        elif type(max_mem) is float or type(max_mem) is int:
-            mem_percent = max_mem
-        elif type(max_mem) is str:
-            m_percent = re.search('([0-9]+)\%', max_mem)
-            m_abs = re.search('([0-9]+)([kKmMgG]{0,1})', max_mem)
 
-            if m_percent is None and m_abs is None:
-                cls._max_mem = None
-                return
+        cls._sample()
+        if cls._sampler is None:
+            cls._sampler = ResourceSampler()
+            cls._sampler.start()
 
-            if m_percent:
-                mem_percent = m_abs.group(1)
-            elif m_abs:
-                val = float(m_abs.group(1))
-                mag_symbol = m_abs.group(2)
+    @classmethod
+    def _sample(cls):
+        """Sample the load and memory usage and update the admission flags.
 
-                _, total_mem = memory_usage()
+        Once a high watermark has been exceeded, jobs are only admitted again
+        after dropping below the corresponding low watermark, so that admission
+        doesn't flap around a single threshold.
+        """
 
-                if mag_symbol == '':
-                    mag = 1.0
-                elif mag_symbol.lower() == 'k':
-                    mag = 1024.0
-                elif mag_symbol.lower() == 'm':
-                    mag = pow(1024.0, 2)
-                elif mag_symbol.lower() == 'g':
-                    mag = pow(1024.0, 3)
+        if cls._max_load is None:
+            cls._load_ok = True
+        else:
+            try:
+                cls._load = os.getloadavg()[1]
+            except (OSError, NotImplementedError):
+                cls._load = None
 
-                mem_percent = 100.0 * val * mag / total_mem
+            if cls._load is None:
+                cls._load_ok = True
+            elif cls._load_ok and cls._load > cls._max_load:
+                cls._load_ok = False
+                cls._log_throttling(
+                    'throttling, load average %.2f is above %.2f' % (cls._load, cls._max_load))
+            elif not cls._load_ok and cls._load < cls._load_low:
+                cls._load_ok = True
+                cls._log_throttling(
+                    'resuming, load average %.2f is below %.2f' % (cls._load, cls._load_low))
 
-        cls._max_mem = max(0.0, min(100.0, float(mem_percent)))
+        if cls._max_mem is None:
+            cls._mem_ok = True
+        else:
+            mem_used, mem_total = memory_usage()
+            if mem_used is None:
+                cls._mem_percent = None
+                cls._mem_ok = True
+            else:
+                cls._mem_percent = 100.0 * float(mem_used) / float(mem_total)
+                if cls._mem_ok and cls._mem_percent > cls._max_mem:
+                    cls._mem_ok = False
+                    cls._log_throttling(
+                        'throttling, memory usage %.1f%% is above %.1f%%' % (cls._mem_percent, cls._max_mem))
+                elif not cls._mem_ok and cls._mem_percent < cls._mem_low:
+                    cls._mem_ok = True
+                    cls._log_throttling(
+                        'resuming, memory usage %.1f%% is below %.1f%%' % (cls._mem_percent, cls._mem_low))
 
     @classmethod
-    def _check_load(cls):
-        if cls._max_load is not None:
-            try:
-                load = os.getloadavg()
-                if load[1] < cls._max_load:
-                    cls._load_ok = True
-                else:
-                    cls._load_ok = False
-            except NotImplementedError:
-                cls._load_ok = True
+    def _log_throttling(cls, reason):
+        msg = clr('[jobserver] @{yf}%s@| (%s)' % (reason, time.strftime('%H:%M:%S')))
+        # Messages are printed by the status controller, instead of by the sampler thread over its status line
+        event_queue = cls._event_queue
+        if event_queue is None:
+            wide_log(msg)
+        else:
+            event_queue.put(ExecutionEvent('MESSAGE', msg=msg))
 
+    @classmethod
+    def _check_load(cls):
         return cls._load_ok
 
     @classmethod
     def _check_mem(cls):
-        if cls._max_mem is not None:
-            mem_used, mem_total = memory_usage()
-            mem_percent_used = 100.0 * float(mem_used) / float(mem_total)
-            if mem_percent_used > cls._max_mem:
-                cls._mem_ok = False
-            else:
-                cls._mem_ok = True
-
         return cls._mem_ok
 
     @classmethod
@@ -233,6 +393,11 @@ class JobServer(object):
         """
         os.write(cls._job_pipe[1], b'+')
 
+    @classmethod
+    def _job_pipe_readable(cls):
+        """Check if there are tokens in the job pipe."""
+        return cls._running_jobs() < cls._max_jobs
+
     @classmethod
     def _running_jobs(cls):
 
@@ -253,7 +418,7 @@ def initialized():
     return JobServer._initialized
 
 
-def initialize(max_jobs=None, max_load=None, max_mem=None, gnu_make_enabled=False):
+def initialize(max_jobs=None, max_load=None, max_mem=None, gnu_make_enabled=False, sample_period=None):
     """
     Initialize the global GNU Make jobserver.
 
@@ -263,6 +428,8 @@ def initialize(max_jobs=None, max_load=None, max_mem=None, gnu_make_enabled=Fals
     :param max_mem: do not dispatch additional jobs if system physical
     memory usage exceeds this value (see _set_max_mem for additional
     documentation)
+    :param sample_period: period in seconds with which the system load and
+    memory usage are sampled
     """
 
     # Check initialization
@@ -291,7 +458,9 @@ def initialize(max_jobs=None, max_load=None, max_mem=None, gnu_make_enabled=Fals
         max_jobs = int(max_jobs)
 
     JobServer._set_max_jobs(max_jobs)
-    JobServer._max_load = max_load
+    if sample_period is not None:
+        set_sample_period(sample_period)
+    JobServer._set_max_load(max_load)
     JobServer._set_max_mem(max_mem)
 
     JobServer._initialized = True
@@ -305,6 +474,19 @@ def mem_ok():
     return JobServer._mem_ok
 
 
+def set_max_load(max_load):
+    """
+    Set the 5-minute load average above which no more jobs are started.
+
+    :param max_load: String 'HIGH' or 'HIGH:LOW', where jobs are started again
+    once the load average drops below LOW, which defaults to 90% of HIGH
+    :type max_load: str
+    :raises: ValueError if max_load is malformed
+    """
+
+    JobServer._set_max_load(*parse_watermarks(max_load, parse_load))
+
+
 def set_max_mem(max_mem):
     """
     Set the maximum memory to keep instantiating jobs.
@@ -312,13 +494,40 @@ def set_max_mem(max_mem):
     :param max_mem: String describing the maximum memory that can be used on
     the system. It can either describe memory percentage or absolute amount.
     Use 'P%' for percentage or 'N' for absolute value in bytes, 'Nk' for
-    kilobytes, 'Nm' for megabytes, and 'Ng' for gigabytes.
+    kilobytes, 'Nm' for megabytes, and 'Ng' for gigabytes. Append ':LOW' to
+    set the usage below which jobs are started again after throttling.
     :type max_mem: str
+    :raises: ValueError if max_mem is malformed
     """
 
     JobServer._set_max_mem(max_mem)
 
 
+def set_event_queue(event_queue):
+    """
+    Set the event queue to which throttling messages are put as MESSAGE events.
+
+    :param event_queue: the queue of the executor which is running, or None to
+    print the messages directly
+    """
+
+    JobServer._event_queue = event_queue
+
+
+def set_sample_period(sample_period):
+    """
+    Set the period with which the system load and memory usage are sampled.
+
+    :param sample_period: the period in seconds
+    :type sample_period: float
+    """
+
+    sample_period = float(sample_period)
+    if sample_period <= 0:
+        raise ValueError("The sample period must be positive, got '%s'" % sample_period)
+    JobServer._sample_period = sample_period
+
+
 def wait_acquire():
     """
     Block until a job server token is acquired, then return it.
@@ -353,6 +562,83 @@ def acquire():
     return token
 
 
+def async_acquire(loop, priority=0.0):
+    """
+    Get a future which is resolved with a job server token once one is available.
+
+    Instead of polling, the read end of the job pipe is watched by the event
+    loop, so waiters are woken up as soon as a token is returned. Waiters are
+    served in order of decreasing priority and, for equal priorities, in the
+    order in which they started waiting. Cancel the future to stop waiting.
+
+    :param loop: The event loop in which the future is resolved
+    :param priority: Waiters with higher priorities are served first
+    :returns: a future resolved with the token
+    """
+    token_f = asyncio.Future(loop=loop)
+
+    # Don't jump ahead of earlier waiters
+    if len(JobServer._token_waiters) == 0:
+        token = _try_acquire_nowait()
+        if token is not None:
+            token_f.set_result(token)
+            return token_f
+
+    heapq.heappush(
+        JobServer._token_waiters,
+        (-priority, next(JobServer._token_waiter_sequence), token_f))
+    _watch_job_pipe(loop)
+
+    return token_f
+
+
+def _try_acquire_nowait():
+    """Like try_acquire(), but never blocks on an empty job pipe."""
+    if not JobServer._job_pipe_readable():
+        return None
+    return try_acquire()
+
+
+def _watch_job_pipe(loop):
+    """Start handing out tokens to waiters whenever the job pipe is readable."""
+    if JobServer._watching_loop is None:
+        JobServer._watching_loop = loop
+        loop.add_reader(JobServer._job_pipe[0], _dispatch_tokens)
+
+
+def _unwatch_job_pipe():
+    if JobServer._watching_loop is not None:
+        JobServer._watching_loop.remove_reader(JobServer._job_pipe[0])
+        JobServer._watching_loop = None
+
+
+def _dispatch_tokens():
+    """Hand out available tokens to the waiters, in order."""
+    waiters = JobServer._token_waiters
+
+    while len(waiters) > 0:
+        # Drop waiters which have given up
+        if waiters[0][2].cancelled():
+            heapq.heappop(waiters)
+            continue
+
+        token = _try_acquire_nowait()
+        if token is None:
+            break
+
+        _, _, token_f = heapq.heappop(waiters)
+        token_f.set_result(token)
+
+    if len(waiters) == 0:
+        _unwatch_job_pipe()
+    elif JobServer._job_pipe_readable():
+        # Tokens are available but the load or memory limits are exceeded, so
+        # stop watching the pipe (it would stay readable) and retry later
+        loop = JobServer._watching_loop
+        _unwatch_job_pipe()
+        loop.call_later(CONDITIONS_RETRY_PERIOD, _watch_job_pipe, loop)
+
+
 def add_label(label):
     JobServer._internal_jobs.append(label)
 
@@ -0,0 +1,124 @@
+# Copyright 2016 Open Source Robotics Foundation, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Estimates of the time remaining until running stages and jobs finish.
+
+The remaining time of a stage is extrapolated from its reported progress,
+and from the durations of the same stage in previous runs. Early in a
+stage, the previous durations dominate the estimate, and the closer the
+stage gets to completion, the more its own progress is trusted.
+"""
+
+# The weight of each new estimate of the remaining time of a stage, the
+# previous estimates, counted down to the present, make up the rest
+SMOOTHING_FACTOR = 0.3
+
+
+def _parse_percent(percent):
+    try:
+        return min(100.0, max(0.0, float(percent)))
+    except (TypeError, ValueError):
+        return None
+
+
+class EtaEstimator(object):
+
+    """Estimates the remaining time of running stages and of all jobs."""
+
+    def __init__(self, jobs, stage_durations=None, max_jobs=None):
+        """
+        :param jobs: The Jobs which are executed
+        :param stage_durations: Map from job id to a map from stage label to its
+            expected duration in seconds, e.g. from
+            :py:func:`ckx_tools.build_history.get_stage_durations`
+        :param max_jobs: The number of jobs which can run at the same time
+        """
+        self.stage_labels = dict([(job.jid, [s.label for s in job.stages]) for job in jobs])
+        self.stage_durations = stage_durations or {}
+        self.max_jobs = max(1, max_jobs or 1)
+
+        # The duration of jobs without any history is estimated with the median of the known ones
+        job_durations = sorted([
+            sum(self.stage_durations[jid].values()) for jid in self.stage_labels if jid in self.stage_durations])
+        self.default_job_duration = job_durations[len(job_durations) // 2] if len(job_durations) > 0 else None
+
+        # Map from jid -> (stage label, estimated remaining time, time of the estimate)
+        self.estimates = {}
+
+    def has_history(self):
+        return self.default_job_duration is not None
+
+    def expected_stage_duration(self, jid, stage_label):
+        return self.stage_durations.get(jid, {}).get(stage_label)
+
+    def expected_job_duration(self, jid):
+        if jid in self.stage_durations:
+            return sum(self.stage_durations[jid].values())
+        return self.default_job_duration
+
+    def stage_remaining(self, jid, stage_label, elapsed, percent, now):
+        """Estimate the remaining time of a running stage.
+
+        :param elapsed: The time since the stage started
+        :param percent: The last reported progress of the stage, or ''
+        :param now: The current time
+        :returns: The remaining time in seconds, or None if it can't be estimated
+        """
+        percent = _parse_percent(percent)
+        expected = self.expected_stage_duration(jid, stage_label)
+
+        from_history = None if expected is None else max(0.0, expected - elapsed)
+        from_progress = None if not percent else elapsed * (100.0 - percent) / percent
+
+        if from_progress is None and from_history is None:
+            return None
+        elif from_progress is None:
+            remaining = from_history
+        elif from_history is None:
+            remaining = from_progress
+        else:
+            weight = percent / 100.0
+            remaining = weight * from_progress + (1.0 - weight) * from_history
+
+        # Smooth the estimate with the previous estimates of the same stage
+        previous = self.estimates.get(jid)
+        if previous is not None and previous[0] == stage_label:
+            counted_down = max(0.0, previous[1] - (now - previous[2]))
+            remaining = SMOOTHING_FACTOR * remaining + (1.0 - SMOOTHING_FACTOR) * counted_down
+        self.estimates[jid] = (stage_label, remaining, now)
+
+        return remaining
+
+    def job_remaining(self, jid, stage_label, stage_remaining):
+        """Estimate the remaining time of a running job from the remaining time of its running stage."""
+        labels = self.stage_labels.get(jid, [])
+        following = labels[labels.index(stage_label) + 1:] if stage_label in labels else []
+        return (stage_remaining or 0.0) + sum([self.expected_stage_duration(jid, s) or 0.0 for s in following])
+
+    def total_remaining(self, job_remainings, pending_jobs):
+        """Estimate the remaining time until all jobs have finished.
+
+        :param job_remainings: Map from the job id of each running job to its remaining time
+        :param pending_jobs: The ids of the jobs which haven't started yet
+        :returns: The remaining time in seconds, or None without any history
+        """
+        if not self.has_history():
+            return None
+        remaining = list(job_remainings.values()) + [self.expected_job_duration(jid) for jid in pending_jobs]
+        if len(remaining) == 0:
+            return 0.0
+        return max(max(remaining), sum(remaining) / float(self.max_jobs))
+
+    def forget(self, jid):
+        self.estimates.pop(jid, None)
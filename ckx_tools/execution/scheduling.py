@@ -0,0 +1,122 @@
+# Copyright 2016 Open Source Robotics Foundation, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Policies for choosing which ready job should be started next."""
+
+import heapq
+
+# Start ready jobs in the order in which they became ready
+SCHEDULE_FIFO = 'fifo'
+# Start the ready job with the longest chain of work depending on it
+SCHEDULE_CRITICAL_PATH = 'critical-path'
+
+SCHEDULES = [SCHEDULE_FIFO, SCHEDULE_CRITICAL_PATH]
+
+
+def get_job_weights(jobs, durations):
+    """Get the weight of each job from the durations of previous runs.
+
+    Jobs which have never been run are weighted with the mean recorded
+    duration. If there are no recorded durations at all, every job has a
+    weight of one, so that critical paths are measured in numbers of jobs.
+
+    :param jobs: List of Jobs
+    :param durations: Map from job id to its typical duration in seconds
+    :returns: tuple of a map from job id to weight, and whether the weights are
+        based on recorded durations
+    :rtype: tuple(dict, bool)
+    """
+    known = [durations[j.jid] for j in jobs if j.jid in durations]
+    if len(known) == 0:
+        return dict([(j.jid, 1.0) for j in jobs]), False
+
+    default_weight = sum(known) / float(len(known))
+    return dict([(j.jid, float(durations.get(j.jid, default_weight))) for j in jobs]), True
+
+
+def get_critical_path_priorities(jobs, weights):
+    """Compute the length of the longest chain of jobs which starts with each job.
+
+    :param jobs: List of topologically-sorted Jobs
+    :param weights: Map from job id to weight
+    :returns: Map from job id to the weight of its longest downstream path,
+        including its own weight
+    :rtype: dict
+    """
+    job_ids = set([j.jid for j in jobs])
+
+    # Build the reverse dependency adjacency
+    dependents = dict([(j.jid, []) for j in jobs])
+    for job in jobs:
+        for dep_id in job.deps:
+            if dep_id in job_ids:
+                dependents[dep_id].append(job.jid)
+
+    # Dependents always come after their dependencies, so visit jobs in reverse
+    priorities = {}
+    for job in reversed(jobs):
+        priorities[job.jid] = weights.get(job.jid, 1.0) + max(
+            [priorities[d] for d in dependents[job.jid]] or [0.0])
+
+    return priorities
+
+
+def estimate_wall_time(jobs, weights, max_jobs, priorities=None):
+    """Simulate running jobs on a fixed number of workers.
+
+    :param jobs: List of topologically-sorted Jobs
+    :param weights: Map from job id to its expected duration
+    :param max_jobs: The number of jobs which can run at the same time
+    :param priorities: Map from job id to priority, the ready job with the
+        highest priority is started first; if None, ready jobs are started in
+        the order in which they became ready
+    :returns: the estimated time until all jobs have finished
+    :rtype: float
+    """
+    job_ids = set([j.jid for j in jobs])
+    max_jobs = max(1, max_jobs or 1)
+
+    dependents = dict([(j.jid, []) for j in jobs])
+    n_pending_deps = {}
+    for job in jobs:
+        deps = [d for d in job.deps if d in job_ids]
+        n_pending_deps[job.jid] = len(deps)
+        for dep_id in deps:
+            dependents[dep_id].append(job.jid)
+
+    # Order of the jobs in the list, used to break ties like the executor does
+    order = dict([(j.jid, i) for i, j in enumerate(jobs)])
+
+    ready = [j.jid for j in jobs if n_pending_deps[j.jid] == 0]
+    running = []
+    now = 0.0
+
+    while ready or running:
+        # Start as many ready jobs as there are free workers
+        while ready and len(running) < max_jobs:
+            if priorities is None:
+                jid = ready.pop(0)
+            else:
+                jid = max(ready, key=lambda j: (priorities.get(j, 0.0), -order[j]))
+                ready.remove(jid)
+            heapq.heappush(running, (now + weights.get(jid, 1.0), order[jid], jid))
+
+        # Advance to the next job completion
+        now, _, jid = heapq.heappop(running)
+        for dependent_id in dependents[jid]:
+            n_pending_deps[dependent_id] -= 1
+            if n_pending_deps[dependent_id] == 0:
+                ready.append(dependent_id)
+
+    return now
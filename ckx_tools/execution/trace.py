@@ -0,0 +1,239 @@
+# Copyright 2016 Open Source Robotics Foundation, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Export of the execution of jobs in the Chrome trace event format.
+
+The resulting files can be opened with ``chrome://tracing`` or the Perfetto
+UI. Stages which hold a job server token are drawn on one lane per token, so
+that idle workers show up as gaps, and stages which run without a token, like
+install steps, are drawn on separate lanes. Each job also gets a span on the
+job lanes, where the time spent waiting for a token or a locked resource
+before a stage is marked.
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import time
+
+from ckx_tools.common import mkdir_p
+
+# Trace event process ids of the lane groups
+WORKERS_PID = 1
+UNTOKENED_PID = 2
+JOBS_PID = 3
+
+LANE_GROUP_NAMES = {
+    WORKERS_PID: 'Workers (job server tokens)',
+    UNTOKENED_PID: 'Stages without a token',
+    JOBS_PID: 'Jobs',
+}
+
+LANE_NAMES = {
+    WORKERS_PID: 'token',
+    UNTOKENED_PID: 'lane',
+    JOBS_PID: 'job',
+}
+
+
+class _Lanes(object):
+
+    """Assigns the lowest free lane to each new occupant."""
+
+    def __init__(self):
+        self.occupants = {}
+
+    def acquire(self, occupant):
+        busy = set(self.occupants.values())
+        lane = 0
+        while lane in busy:
+            lane += 1
+        self.occupants[occupant] = lane
+        return lane
+
+    def release(self, occupant):
+        return self.occupants.pop(occupant, None)
+
+    def get(self, occupant):
+        return self.occupants.get(occupant)
+
+
+class TraceRecorder(object):
+
+    """Collects trace events from the events generated by the executor.
+
+    The recorder is handed every event consumed by a
+    :py:class:`ckx_tools.execution.controllers.ConsoleStatusController`.
+    """
+
+    subscribed_event_ids = ['STARTED_JOB', 'STARTED_STAGE', 'FINISHED_STAGE', 'FINISHED_JOB', 'ABANDONED_JOB']
+
+    def __init__(self, verb, jobs, start_time=None):
+        """
+        :param verb: The verb whose jobs are traced
+        :param jobs: The Jobs which are executed
+        :param start_time: The time from which the trace starts
+        """
+        self.verb = verb
+        self.start_time = time.time() if start_time is None else start_time
+
+        # Map from (jid, stage label) -> stage
+        self.stages = dict([((job.jid, stage.label), stage) for job in jobs for stage in job.stages])
+
+        self.trace_events = []
+        self.lanes = dict([(pid, _Lanes()) for pid in LANE_GROUP_NAMES])
+        self.used_lanes = dict([(pid, set()) for pid in LANE_GROUP_NAMES])
+
+        # Map from jid -> start time of the running stage and its lane group
+        self.active_stages = {}
+        # Map from jid -> time at which the job started or its last stage finished
+        self.idle_since = {}
+        self.job_start_times = {}
+
+    def _ts(self, t):
+        return int(round((t - self.start_time) * 1e6))
+
+    def _acquire_lane(self, pid, occupant):
+        lane = self.lanes[pid].acquire(occupant)
+        self.used_lanes[pid].add(lane)
+        return lane
+
+    def _add_span(self, pid, tid, name, start, end, category, args=None):
+        self.trace_events.append({
+            'ph': 'X',
+            'pid': pid,
+            'tid': tid,
+            'name': name,
+            'cat': category,
+            'ts': self._ts(start),
+            'dur': max(0, self._ts(end) - self._ts(start)),
+            'args': args or {},
+        })
+
+    def _add_busy_workers_counter(self, t):
+        self.trace_events.append({
+            'ph': 'C',
+            'pid': WORKERS_PID,
+            'name': 'busy workers',
+            'ts': self._ts(t),
+            'args': {'tokens': len(self.lanes[WORKERS_PID].occupants)},
+        })
+
+    def handle_event(self, event):
+        eid = event.event_id
+        data = event.data
+
+        if 'STARTED_JOB' == eid:
+            jid = data['job_id']
+            self._acquire_lane(JOBS_PID, jid)
+            self.job_start_times[jid] = event.time
+            self.idle_since[jid] = event.time
+            # Jobs hold a token from the start
+            self._acquire_lane(WORKERS_PID, jid)
+            self._add_busy_workers_counter(event.time)
+
+        elif 'STARTED_STAGE' == eid:
+            jid = data['job_id']
+            stage = self.stages.get((jid, data['stage_label']))
+            occupies_token = stage is None or stage.occupy_job
+
+            # Mark the time spent waiting for a token or a lock
+            idle_since = self.idle_since.pop(jid, event.time)
+            if event.time > idle_since and stage is not None:
+                waiting_for = []
+                if stage.locked_resource is not None:
+                    waiting_for.append('lock `{}`'.format(stage.locked_resource))
+                if occupies_token and self.lanes[WORKERS_PID].get(jid) is None:
+                    waiting_for.append('job server token')
+                if len(waiting_for) > 0:
+                    self._add_span(
+                        JOBS_PID, self.lanes[JOBS_PID].get(jid), 'waiting for ' + ' and '.join(waiting_for),
+                        idle_since, event.time, 'wait', {'job': jid, 'stage': stage.label})
+
+            # Stages without a token give back the token of the job
+            if occupies_token:
+                if self.lanes[WORKERS_PID].get(jid) is None:
+                    self._acquire_lane(WORKERS_PID, jid)
+                    self._add_busy_workers_counter(event.time)
+                pid = WORKERS_PID
+            else:
+                if self.lanes[WORKERS_PID].release(jid) is not None:
+                    self._add_busy_workers_counter(event.time)
+                self._acquire_lane(UNTOKENED_PID, jid)
+                pid = UNTOKENED_PID
+
+            self.active_stages[jid] = (event.time, pid)
+
+        elif 'FINISHED_STAGE' == eid:
+            jid = data['job_id']
+            if jid not in self.active_stages:
+                return
+            start_time, pid = self.active_stages.pop(jid)
+            tid = self.lanes[pid].get(jid)
+            if pid == UNTOKENED_PID:
+                self.lanes[pid].release(jid)
+            self._add_span(
+                pid, tid, '{}:{}'.format(jid, data['stage_label']), start_time, event.time, 'stage',
+                {'job': jid, 'stage': data['stage_label'], 'retcode': data['retcode']})
+            self.idle_since[jid] = event.time
+
+        elif 'FINISHED_JOB' == eid:
+            jid = data['job_id']
+            if jid not in self.job_start_times:
+                return
+            self._add_span(
+                JOBS_PID, self.lanes[JOBS_PID].release(jid), jid, self.job_start_times.pop(jid), event.time,
+                'job', {'succeeded': data['succeeded']})
+            self.idle_since.pop(jid, None)
+            if self.lanes[WORKERS_PID].release(jid) is not None:
+                self._add_busy_workers_counter(event.time)
+
+        elif 'ABANDONED_JOB' == eid:
+            self.trace_events.append({
+                'ph': 'i',
+                's': 'g',
+                'pid': JOBS_PID,
+                'tid': 0,
+                'name': 'abandoned {}'.format(data['job_id']),
+                'ts': self._ts(event.time),
+                'args': {'reason': data['reason']},
+            })
+
+    def get_trace(self):
+        """Get the trace as a JSON-serializable object."""
+        metadata = []
+        for pid, name in sorted(LANE_GROUP_NAMES.items()):
+            metadata.append({
+                'ph': 'M', 'pid': pid, 'name': 'process_name',
+                'args': {'name': '{} {}'.format(self.verb, name)}})
+            metadata.append({
+                'ph': 'M', 'pid': pid, 'name': 'process_sort_index', 'args': {'sort_index': pid}})
+            for lane in sorted(self.used_lanes[pid]):
+                metadata.append({
+                    'ph': 'M', 'pid': pid, 'tid': lane, 'name': 'thread_name',
+                    'args': {'name': '{} {}'.format(LANE_NAMES[pid], lane)}})
+
+        return {
+            'traceEvents': metadata + self.trace_events,
+            'displayTimeUnit': 'ms',
+            'otherData': {'verb': self.verb, 'start': self.start_time},
+        }
+
+    def write(self, path):
+        """Write the trace to a file."""
+        dirname = os.path.dirname(os.path.abspath(path))
+        mkdir_p(dirname)
+        with open(path, 'w') as trace_file:
+            json.dump(self.get_trace(), trace_file, separators=(',', ':'))
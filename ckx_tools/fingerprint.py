@@ -0,0 +1,327 @@
+# Copyright 2014 Open Source Robotics Foundation, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Fingerprints of the inputs to a package build.
+
+A package fingerprint combines the contents of its source tree, the arguments
+with which it is configured and built, and the fingerprints of the workspace
+packages it depends on. The fingerprint of the last successful build of each
+package is stored in the profile metadata directory, and a package whose
+current fingerprint matches the stored one does not need to be built again.
+
+Hashing a source tree only reads the files whose mtime or size has changed
+since the last successful build, so checking an unchanged workspace only costs
+a stat pass over the source space.
+"""
+
+from __future__ import print_function
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    from md5 import md5
+except ImportError:
+    from hashlib import md5
+
+import os
+import re
+import sys
+import tempfile
+
+from .common import get_build_type
+from .common import mkdir_p
+
+FINGERPRINTS_DIR_NAME = 'fingerprints'
+
+# Bump this whenever the contents of a fingerprint change
+FINGERPRINT_VERSION = 1
+
+# Make options whose value can be given as the next argument
+MAKE_OPTIONS_WITH_VALUE = [
+    '-C', '--directory', '-f', '--file', '--makefile', '-I', '--include-dir', '-o', '--old-file',
+    '--assume-old', '-W', '--what-if', '--new-file', '--assume-new', '-E', '--eval']
+# Make options whose numeric value can be given as the next argument, but which can also be given without one
+MAKE_OPTIONS_WITH_OPTIONAL_VALUE = ['-j', '--jobs', '-l', '--load-average', '--max-load']
+
+# Files in the source tree which are never considered build inputs
+IGNORED_SUFFIXES = ('.pyc', '.pyo', '~')
+
+# Size of the blocks in which source files are read when hashing them
+HASH_BLOCK_SIZE = 1 << 16
+
+
+def get_fingerprint_path(context, package_name):
+    """Get the path to the stored fingerprint of a package.
+
+    :param context: Workspace context
+    :type context: :py:class:`ckx_tools.context.Context`
+    :param package_name: The name of the package
+    :type package_name: str
+    :returns: path to the fingerprint file
+    :rtype: str
+    """
+    return os.path.join(context.metadata_path(), FINGERPRINTS_DIR_NAME, package_name + '.pickle')
+
+
+def load_fingerprint(fingerprint_path):
+    """Load the stored fingerprint of a package.
+
+    :returns: the stored fingerprint dict, or None if there isn't a usable one
+    :rtype: dict
+    """
+    if not os.path.exists(fingerprint_path):
+        return None
+
+    try:
+        with open(fingerprint_path, 'rb') as fingerprint_file:
+            fingerprint = pickle.load(fingerprint_file)
+    except Exception:
+        return None
+
+    if not isinstance(fingerprint, dict) or fingerprint.get('version') != FINGERPRINT_VERSION:
+        return None
+
+    return fingerprint
+
+
+def store_fingerprint(logger, event_queue, fingerprint_path, fingerprint):
+    """FunctionStage functor that atomically stores the fingerprint of a package."""
+
+    fingerprint_dir = os.path.dirname(fingerprint_path)
+    mkdir_p(fingerprint_dir)
+
+    # Create a temporary file in the same directory, so os.rename cannot fail
+    tmp_handle, tmp_path = tempfile.mkstemp(dir=fingerprint_dir, prefix=os.path.basename(fingerprint_path) + '.')
+    try:
+        with os.fdopen(tmp_handle, 'wb') as tmp_file:
+            pickle.dump(fingerprint, tmp_file, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, fingerprint_path)
+    except (IOError, OSError) as exc:
+        # Failing to store the fingerprint just means the package is rebuilt next time
+        logger.err('Warning: Could not store package fingerprint: {}'.format(exc))
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+    return 0
+
+
+def _hash_file(path):
+    digest = md5()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(HASH_BLOCK_SIZE)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hash_source_tree(source_path, cached_files=None):
+    """Hash the contents of a package source tree.
+
+    Files whose mtime and size match the entries in `cached_files` are not
+    read again, and their cached content digests are used instead.
+
+    :param source_path: The root of the source tree
+    :type source_path: str
+    :param cached_files: Map from relative path to (mtime, size, digest)
+    :type cached_files: dict
+    :returns: the digest of the tree and the updated map of file digests
+    :rtype: tuple(str, dict)
+    """
+    cached_files = cached_files or {}
+    files = {}
+
+    for dirpath, dirnames, filenames in os.walk(source_path, followlinks=True):
+        # Skip hidden directories (VCS metadata, editor state, etc.)
+        dirnames[:] = sorted([d for d in dirnames if not d.startswith('.')])
+
+        for filename in filenames:
+            if filename.startswith('.') or filename.endswith(IGNORED_SUFFIXES):
+                continue
+            path = os.path.join(dirpath, filename)
+            try:
+                st = os.stat(path)
+            except OSError:
+                # Dangling symlinks aren't inputs
+                continue
+
+            rel_path = os.path.relpath(path, source_path)
+            cached = cached_files.get(rel_path)
+            if cached is not None and cached[0] == st.st_mtime and cached[1] == st.st_size:
+                files[rel_path] = cached
+            else:
+                try:
+                    files[rel_path] = (st.st_mtime, st.st_size, _hash_file(path))
+                except (IOError, OSError):
+                    continue
+
+    tree_digest = md5()
+    for rel_path in sorted(files):
+        tree_digest.update('{}\0{}\n'.format(rel_path, files[rel_path][2]).encode('utf-8'))
+
+    return tree_digest.hexdigest(), files
+
+
+def get_make_targets(make_args):
+    """Get the explicit targets from a list of make arguments.
+
+    The values of options given as separate arguments, like `-j 4` or
+    `-C dir`, aren't targets.
+    """
+    targets = []
+    skip_next = False
+    for i, a in enumerate(make_args):
+        if skip_next:
+            skip_next = False
+        elif a in MAKE_OPTIONS_WITH_VALUE:
+            skip_next = True
+        elif a in MAKE_OPTIONS_WITH_OPTIONAL_VALUE:
+            skip_next = i + 1 < len(make_args) and re.match(r'^[0-9]+(\.[0-9]*)?$', make_args[i + 1]) is not None
+        elif not a.startswith('-') and '=' not in a:
+            targets.append(a)
+    return targets
+
+
+def _stat_signature(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size)
+
+
+def get_build_config_digest(context, package):
+    """Get a digest of everything which configures how a package is built.
+
+    :param context: Workspace context
+    :type context: :py:class:`ckx_tools.context.Context`
+    :param package: The package which would be built
+    :type package: :py:class:`catkin_pkg.package.Package`
+    :returns: the digest of the build configuration
+    :rtype: str
+    """
+    config = [
+        ('python', sys.version_info[0]),
+        ('build_type', get_build_type(package)),
+        ('cmake_args', list(context.cmake_args)),
+        ('make_args', list(context.make_args)),
+        ('catkin_make_args', list(context.catkin_make_args)),
+        ('devel_layout', context.devel_layout),
+        ('build_space', context.package_build_space(package)),
+        ('devel_space', context.package_devel_space(package)),
+        ('install', context.install),
+        ('install_space', context.package_install_space(package) if context.install else None),
+        ('destdir', context.destdir),
+        ('underlays', context.underlays),
+        ('cmake_prefix_path', os.environ.get('CMAKE_PREFIX_PATH')),
+        ('config.cmake', _stat_signature(os.path.join(context.build_root_abs, 'config.cmake'))),
+        ('toolchain.cmake', _stat_signature(os.path.join(context.build_root_abs, 'toolchain.cmake'))),
+    ]
+    return md5(repr(config).encode('utf-8')).hexdigest()
+
+
+def compute_package_fingerprint(context, package_path, package, dep_fingerprints, stored=None):
+    """Compute the fingerprint of a package from its current build inputs.
+
+    :param context: Workspace context
+    :type context: :py:class:`ckx_tools.context.Context`
+    :param package_path: The path of the package relative to the source space
+    :type package_path: str
+    :param package: The package
+    :type package: :py:class:`catkin_pkg.package.Package`
+    :param dep_fingerprints: Map from each workspace dependency name to its fingerprint
+    :type dep_fingerprints: dict
+    :param stored: The stored fingerprint of the package, used to avoid re-reading files
+    :type stored: dict
+    :returns: a fingerprint dict which can be compared and stored
+    :rtype: dict
+    """
+    source_digest, files = hash_source_tree(
+        os.path.join(context.source_space_abs, package_path),
+        stored.get('files') if stored else None)
+
+    return {
+        'version': FINGERPRINT_VERSION,
+        'source': source_digest,
+        'config': get_build_config_digest(context, package),
+        'deps': sorted(dep_fingerprints.items()),
+        'files': files,
+    }
+
+
+def fingerprint_digest(fingerprint):
+    """Get a single digest for a fingerprint, used when it's a dependency of another package."""
+    if fingerprint is None:
+        return None
+    return md5(repr((
+        fingerprint['source'],
+        fingerprint['config'],
+        fingerprint['deps'])).encode('utf-8')).hexdigest()
+
+
+def fingerprints_match(current, stored):
+    """Check if a package's current fingerprint matches its stored one."""
+    return (
+        stored is not None and
+        current['source'] == stored.get('source') and
+        current['config'] == stored.get('config') and
+        current['deps'] == stored.get('deps'))
+
+
+def get_up_to_date_packages(context, packages, workspace_deps):
+    """Determine which of a set of packages don't need to be built.
+
+    :param context: Workspace context
+    :type context: :py:class:`ckx_tools.context.Context`
+    :param packages: topologically-ordered list of (path, package) tuples to be built
+    :type packages: list
+    :param workspace_deps: Map from each package name to the names of its
+        workspace build dependencies
+    :type workspace_deps: dict
+    :returns: the set of up-to-date package names, and a map from every
+        package name to its current fingerprint
+    :rtype: tuple(set, dict)
+    """
+    up_to_date = set()
+    fingerprints = {}
+    digests = {}
+
+    for pkg_path, pkg in packages:
+        stored = load_fingerprint(get_fingerprint_path(context, pkg.name))
+
+        # Dependencies which aren't being built are described by their stored fingerprint
+        dep_fingerprints = {}
+        for dep_name in workspace_deps.get(pkg.name, []):
+            if dep_name not in digests:
+                digests[dep_name] = fingerprint_digest(load_fingerprint(get_fingerprint_path(context, dep_name)))
+            dep_fingerprints[dep_name] = digests[dep_name]
+
+        fingerprint = compute_package_fingerprint(context, pkg_path, pkg, dep_fingerprints, stored)
+        fingerprints[pkg.name] = fingerprint
+        digests[pkg.name] = fingerprint_digest(fingerprint)
+
+        # The products of the last build must still be there
+        products_exist = (
+            os.path.isdir(context.package_build_space(pkg)) and
+            os.path.isdir(context.package_devel_space(pkg)) and
+            (not context.install or os.path.isdir(context.package_install_space(pkg))))
+
+        if products_exist and fingerprints_match(fingerprint, stored):
+            up_to_date.add(pkg.name)
+
+    return up_to_date, fingerprints
@@ -13,7 +13,9 @@
 # limitations under the License.
 
 import csv
+import errno
 import os
+import sqlite3
 
 try:
     from md5 import md5
@@ -36,6 +38,7 @@ from .commands.make import MAKE_EXEC
 
 from .utils import copyfiles
 from .utils import get_env_loader
+from .utils import get_install_lock_name
 from .utils import makedirs
 from .utils import rmfiles
 
@@ -73,6 +76,45 @@ def get_prebuild_package(build_space_abs, devel_space_abs, force):
     return prebuild_path
 
 
+def open_devel_collisions(metadata_path):
+    """Open the database of the collision counts of the files in a merged devel space.
+
+    The count of each dest file is kept in its own row, so that the link and
+    unlink stages of different packages only hold the database for the short
+    transactions which update their own files. Counts from a
+    `devel_collisions.txt` file of an older version are imported once.
+
+    :param metadata_path: The path to the profile metadata directory
+    :returns: a connection in autocommit mode, transactions are begun explicitly
+    """
+    mkdir_p(metadata_path)
+    db = sqlite3.connect(
+        os.path.join(metadata_path, DEVEL_COLLISIONS_FILENAME),
+        timeout=DEVEL_COLLISIONS_TIMEOUT,
+        isolation_level=None)
+    db.execute('CREATE TABLE IF NOT EXISTS collisions (path TEXT PRIMARY KEY, count INTEGER NOT NULL)')
+
+    legacy_collisions_file_path = os.path.join(metadata_path, LEGACY_DEVEL_COLLISIONS_FILENAME)
+    if os.path.exists(legacy_collisions_file_path):
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            # Check again, now that no other stage can write to the database
+            if os.path.exists(legacy_collisions_file_path):
+                with open(legacy_collisions_file_path, 'r') as collisions_file:
+                    collisions_reader = csv.reader(collisions_file, delimiter=' ', quotechar='"')
+                    db.executemany(
+                        'INSERT OR REPLACE INTO collisions (path, count) VALUES (?, ?)',
+                        [(path, int(count)) for path, count in collisions_reader])
+                os.remove(legacy_collisions_file_path)
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            db.close()
+            raise
+
+    return db
+
+
 def clean_linked_files(
         logger,
         event_queue,
@@ -82,70 +124,74 @@ def clean_linked_files(
         dry_run):
     """Removes a list of files and adjusts collison counts for colliding files.
 
-    This function synchronizes access to the devel collisions file.
+    The collision counts are updated and the files are removed in a single
+    transaction, so this function can be called by several stages at the same
+    time. Colliding files which have been removed by another stage since they
+    were checked are linked again instead of being counted.
 
-    :param devel_space_abs: absolute path to merged devel space
-    :param files_that_collide: list of absolute paths to files that collide
+    :param metadata_path: absolute path to the profile metadata directory
+    :param files_that_collide: list of (source, dest) tuples of absolute paths to files that collide
     :param files_to_clean: list of absolute paths to files to clean
     """
 
-    # Get paths
-    devel_collisions_file_path = os.path.join(metadata_path, 'devel_collisions.txt')
-
-    # Map from dest files to number of collisions
-    dest_collisions = dict()
-
-    # Load destination collisions file
-    if os.path.exists(devel_collisions_file_path):
-        with open(devel_collisions_file_path, 'r') as collisions_file:
-            collisions_reader = csv.reader(collisions_file, delimiter=' ', quotechar='"')
-            dest_collisions = dict([(path, int(count)) for path, count in collisions_reader])
-
-    # Add collisions
-    for dest_file in files_that_collide:
-        if dest_file in dest_collisions:
-            dest_collisions[dest_file] += 1
-        else:
-            dest_collisions[dest_file] = 1
-
-    # Remove files that no longer collide
-    for dest_file in files_to_clean:
-        # Get the collisions
-        n_collisions = dest_collisions.get(dest_file, 0)
-
-        # Check collisions
-        if n_collisions == 0:
-            logger.out('Unlinking: {}'.format(dest_file))
-            # Remove this link
-            if not dry_run:
-                if os.path.exists(dest_file):
-                    try:
-                        os.unlink(dest_file)
-                    except OSError:
-                        logger.err('Could not unlink: {}'.format(dest_file))
-                        raise
-                    # Remove any non-empty directories containing this file
-                    try:
-                        os.removedirs(os.path.split(dest_file)[0])
-                    except OSError:
-                        pass
-                else:
-                    logger.out('Already unlinked: {}')
-
-        # Update collisions
-        if n_collisions > 1:
-            # Decrement the dest collisions dict
-            dest_collisions[dest_file] -= 1
-        elif n_collisions == 1:
-            # Remove it from the dest collisions dict
-            del dest_collisions[dest_file]
+    # The files whose collision count dropped to zero, so no other package links them
+    files_to_unlink = []
 
-    # Load destination collisions file
-    if not dry_run:
-        with open(devel_collisions_file_path, 'w') as collisions_file:
-            collisions_writer = csv.writer(collisions_file, delimiter=' ', quotechar='"')
-            for dest_file, count in dest_collisions.items():
-                collisions_writer.writerow([dest_file, count])
+    db = open_devel_collisions(metadata_path)
+    try:
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            # Add collisions
+            for source_file, dest_file in files_that_collide:
+                # The link which this collides with has been removed by another stage in the meantime
+                if not dry_run and not os.path.lexists(dest_file) and _symlink(logger, source_file, dest_file):
+                    continue
+                db.execute('INSERT OR IGNORE INTO collisions (path, count) VALUES (?, 0)', (dest_file,))
+                db.execute('UPDATE collisions SET count = count + 1 WHERE path = ?', (dest_file,))
+
+            # Remove files that no longer collide
+            for dest_file in files_to_clean:
+                # Get the collisions
+                row = db.execute('SELECT count FROM collisions WHERE path = ?', (dest_file,)).fetchone()
+                n_collisions = 0 if row is None else row[0]
+
+                # Check collisions
+                if n_collisions == 0:
+                    files_to_unlink.append(dest_file)
+                elif n_collisions > 1:
+                    # Decrement the dest collisions count
+                    db.execute('UPDATE collisions SET count = count - 1 WHERE path = ?', (dest_file,))
+                else:
+                    # Remove it from the dest collisions
+                    db.execute('DELETE FROM collisions WHERE path = ?', (dest_file,))
+
+            # Remove the links before the counts are committed, so that no
+            # other stage counts a collision with a link which is removed
+            for dest_file in files_to_unlink:
+                logger.out('Unlinking: {}'.format(dest_file))
+                # Remove this link
+                if not dry_run:
+                    # Links to removed files are dangling, so they don't exist but still need to be removed
+                    if os.path.lexists(dest_file):
+                        try:
+                            os.unlink(dest_file)
+                        except OSError:
+                            logger.err('Could not unlink: {}'.format(dest_file))
+                            raise
+                        # Remove any non-empty directories containing this file
+                        try:
+                            os.removedirs(os.path.split(dest_file)[0])
+                        except OSError:
+                            pass
+                    else:
+                        logger.out('Already unlinked: {}'.format(dest_file))
+
+            db.execute('ROLLBACK' if dry_run else 'COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+    finally:
+        db.close()
 
 
 def unlink_devel_products(
@@ -185,7 +231,8 @@ def unlink_devel_products(
         manifest_reader = csv.reader(devel_manifest, delimiter=' ', quotechar='"')
 
         # Remove all listed symlinks and empty directories
-        for source_file, dest_file in manifest_reader:
+        for row in manifest_reader:
+            source_file, dest_file = row[:2]
             if not os.path.exists(dest_file):
                 logger.err("Warning: Dest file doesn't exist, so it can't be removed: " + dest_file)
             elif not os.path.islink(dest_file):
@@ -199,12 +246,140 @@ def unlink_devel_products(
                 files_to_clean.append(dest_file)
 
     # Remove all listed symli and empty directories which have been removed
-    # after this build, and update the collision file
+    # after this build, and update the collision counts
     clean_linked_files(logger, event_queue, metadata_path, [], files_to_clean, dry_run)
 
     return 0
 
 
+def _stat_signature(path):
+    """Get the (mtime, size) signature of a path or None if it doesn't exist."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size)
+
+
+# Map from (real path, stat signature) -> md5 hex digest of files which have been hashed
+_file_digests = {}
+
+
+def get_file_digest(path):
+    """Get the md5 hex digest of the file which a path refers to.
+
+    The file is read in blocks, and the digest is cached with the stat
+    signature of the file, since the same colliding files tend to be hashed
+    by many packages.
+    """
+    real_path = os.path.realpath(path)
+    key = (real_path, _stat_signature(real_path))
+    if key not in _file_digests:
+        digest = md5()
+        with open(real_path, 'rb') as f:
+            for block in iter(lambda: f.read(DIGEST_BLOCK_SIZE), b''):
+                digest.update(block)
+        _file_digests[key] = digest.hexdigest()
+    return _file_digests[key]
+
+
+def read_devel_manifest(devel_manifest_file_path):
+    """Read the products which were linked by the last build of a package.
+
+    :returns: Map from dest file to a (source file, stat signature of the
+        source file) tuple, which is empty if there is no manifest. The
+        signature is None for manifests without stat signatures.
+    :rtype: dict
+    """
+    products = {}
+    if not os.path.exists(devel_manifest_file_path):
+        return products
+    with open(devel_manifest_file_path, 'r') as devel_manifest:
+        # Skip the package source directory
+        devel_manifest.readline()
+        for row in csv.reader(devel_manifest, delimiter=' ', quotechar='"'):
+            signature = (float(row[2]), int(row[3])) if len(row) >= 4 else None
+            products[row[1]] = (row[0], signature)
+    return products
+
+
+def _check_collision(logger, source_file, dest_file):
+    """Check if an existing dest file is a link to a different file, and warn if the contents differ.
+
+    :returns: True if the dest file collides with the source file
+    """
+    if os.path.realpath(dest_file) == os.path.realpath(source_file):
+        return False
+    source_hash = get_file_digest(source_file)
+    dest_hash = get_file_digest(dest_file)
+    # If the link links to a different file, report a warning
+    if dest_hash != source_hash:
+        logger.err('Warning: Cannot symlink from %s to existing file %s' % (source_file, dest_file))
+        logger.err('Warning: Source hash: {}'.format(source_hash))
+        logger.err('Warning: Dest hash: {}'.format(dest_hash))
+    return True
+
+
+def _mkdir_devel(path):
+    """Create a directory in a merged devel space, whose empty parents other stages may be removing."""
+    while True:
+        try:
+            mkdir_p(path)
+            return
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+
+
+def _symlink(logger, source_file, dest_file):
+    """Create a symlink to a source file.
+
+    :returns: False if the dest file has been created by another package in the meantime
+    """
+    logger.out('Symlinking %s' % (dest_file))
+    while True:
+        try:
+            os.symlink(source_file, dest_file)
+        except OSError as exc:
+            if exc.errno == errno.EEXIST:
+                return False
+            if exc.errno == errno.ENOENT and os.path.exists(source_file):
+                # The empty dest directory has been removed by another stage unlinking its files
+                _mkdir_devel(os.path.dirname(dest_file))
+                continue
+            logger.err('Could not create symlink `{}` referencing `{}`'.format(dest_file, source_file))
+            raise
+        return True
+
+
+def _link(logger, source_file, dest_file):
+    """Link a file, or check if it collides with the file which is already linked.
+
+    :returns: True if the dest file collides with the source file
+    """
+    while True:
+        if os.path.lexists(dest_file) and not os.path.exists(dest_file):
+            # The file which the dest file links to has been removed
+            logger.err('Warning: Replacing dangling symlink: {}'.format(dest_file))
+            try:
+                os.unlink(dest_file)
+            except OSError as exc:
+                if exc.errno != errno.ENOENT:
+                    raise
+        if not os.path.exists(dest_file) and _symlink(logger, source_file, dest_file):
+            return False
+        try:
+            if _check_collision(logger, source_file, dest_file):
+                return True
+        except (IOError, OSError) as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+            # The dest file has been unlinked by another stage while it was checked
+            continue
+        logger.out('Linked: ({}, {})'.format(source_file, dest_file))
+        return False
+
+
 def link_devel_products(
         logger, event_queue,
         package,
@@ -218,6 +393,12 @@ def link_devel_products(
 
     This creates directories and symlinks in a merged devel space to a
     package's linked devel space.
+
+    The files in the linked devel space are compared with the devel manifest
+    of the previous build of the package by path and stat signature. Only
+    files which have been added are linked and checked for collisions, and
+    only files which have been removed are cleaned. Files which haven't
+    changed are only checked for their link still being there.
     """
 
     # Create the devel manifest path if necessary
@@ -226,12 +407,17 @@ def link_devel_products(
     # Construct manifest file path
     devel_manifest_file_path = os.path.join(devel_manifest_path, DEVEL_MANIFEST_FILENAME)
 
-    # Pair of source/dest files or directories
+    # Map from dest file to the source file and signature of the previous build
+    previous_products = read_devel_manifest(devel_manifest_file_path)
+
+    # Source/dest file pairs and the signatures of the source files
     products = list()
     # List of files to clean
     files_to_clean = []
     # List of files that collide
     files_that_collide = []
+    # Number of files which haven't changed since the previous build
+    n_unchanged = 0
 
     # Select the blacklist
     blacklist = DEVEL_LINK_PREBUILD_BLACKLIST if prebuild else DEVEL_LINK_BLACKLIST
@@ -239,15 +425,16 @@ def link_devel_products(
     # Gather all of the files in the devel space
     for source_path, dirs, files in os.walk(source_devel_path):
         # compute destination path
-        dest_path = os.path.join(dest_devel_path, os.path.relpath(source_path, source_devel_path))
+        rel_path = os.path.relpath(source_path, source_devel_path)
+        dest_path = os.path.join(dest_devel_path, rel_path)
 
         # create directories in the destination develspace
         for dirname in dirs:
             dest_dir = os.path.join(dest_path, dirname)
 
             if not os.path.exists(dest_dir):
-                # Create the dest directory if it doesn't exist
-                os.mkdir(dest_dir)
+                # Create the dest directory if it doesn't exist, other packages may create it at the same time
+                _mkdir_devel(dest_dir)
             elif not os.path.isdir(dest_dir):
                 logger.err('Error: Cannot create directory: ' + dest_dir)
                 return -1
@@ -256,70 +443,62 @@ def link_devel_products(
         for filename in files:
 
             # Don't link files on the blacklist unless this is a prebuild package
-            if os.path.relpath(os.path.join(source_path, filename), source_devel_path) in blacklist:
+            if os.path.normpath(os.path.join(rel_path, filename)) in blacklist:
                 continue
 
             source_file = os.path.join(source_path, filename)
             dest_file = os.path.join(dest_path, filename)
+            signature = _stat_signature(source_file)
 
             # Store the source/dest pair
-            products.append((source_file, dest_file))
-
-            # Check if the symlink exists
-            if os.path.exists(dest_file):
-                if os.path.realpath(dest_file) != os.path.realpath(source_file):
-                    # Compute hashes for colliding files
-                    source_hash = md5(open(os.path.realpath(source_file)).read().encode('utf-8')).hexdigest()
-                    dest_hash = md5(open(os.path.realpath(dest_file)).read().encode('utf-8')).hexdigest()
-                    # If the link links to a different file, report a warning and increment
-                    # the collision counter for this path
-                    if dest_hash != source_hash:
-                        logger.err('Warning: Cannot symlink from %s to existing file %s' % (source_file, dest_file))
-                        logger.err('Warning: Source hash: {}'.format(source_hash))
-                        logger.err('Warning: Dest hash: {}'.format(dest_hash))
+            products.append((source_file, dest_file, signature))
+
+            previous = previous_products.pop(dest_file, None)
+            if previous is not None and previous[0] != source_file:
+                # The dest file was linked from somewhere else
+                files_to_clean.append(dest_file)
+                previous = None
+
+            if previous is None:
+                if _link(logger, source_file, dest_file):
                     # Increment link collision counter
-                    files_that_collide.append(dest_file)
-                else:
-                    logger.out('Linked: ({}, {})'.format(source_file, dest_file))
+                    files_that_collide.append((source_file, dest_file))
+            # The file was linked by the previous build, and its collisions have been counted
+            elif os.path.exists(dest_file) and previous[1] == signature:
+                n_unchanged += 1
             else:
-                # Create the symlink
-                logger.out('Symlinking %s' % (dest_file))
-                try:
-                    os.symlink(source_file, dest_file)
-                except OSError:
-                    logger.err('Could not create symlink `{}` referencing `{}`'.format(dest_file, source_file))
-                    raise
+                _link(logger, source_file, dest_file)
+
+    # The files which were linked by the previous build, but aren't there anymore
+    for dest_file, (source_file, _) in sorted(previous_products.items()):
+        # Clean the file or decrement the collision count
+        logger.out('Cleaning: (%s, %s)' % (source_file, dest_file))
+        files_to_clean.append(dest_file)
 
-    # Load the old list of symlinked files for this package
-    if os.path.exists(devel_manifest_file_path):
-        with open(devel_manifest_file_path, 'r') as devel_manifest:
-            manifest_reader = csv.reader(devel_manifest, delimiter=' ', quotechar='"')
-            # Skip the package source directory
-            devel_manifest.readline()
-            # Read the previously-generated products
-            for source_file, dest_file in manifest_reader:
-                # print('Checking (%s, %s)' % (source_file, dest_file))
-                if (source_file, dest_file) not in products:
-                    # Clean the file or decrement the collision count
-                    logger.out('Cleaning: (%s, %s)' % (source_file, dest_file))
-                    files_to_clean.append(dest_file)
+    if n_unchanged > 0:
+        logger.out('Unchanged: {} linked files'.format(n_unchanged))
 
     # Remove all listed symlinks and empty directories which have been removed
-    # after this build, and update the collision file
-    try:
-        clean_linked_files(logger, event_queue, metadata_path, files_that_collide, files_to_clean, dry_run=False)
-    except:
-        logger.err('Could not clean linked files.')
-        raise
+    # after this build, and update the collision counts
+    if len(files_that_collide) > 0 or len(files_to_clean) > 0:
+        try:
+            clean_linked_files(logger, event_queue, metadata_path, files_that_collide, files_to_clean, dry_run=False)
+        except:
+            logger.err('Could not clean linked files.')
+            raise
 
     # Save the list of symlinked files
     with open(devel_manifest_file_path, 'w') as devel_manifest:
         # Write the path to the package source directory
         devel_manifest.write('%s\n' % package_path)
-        # Write all the products
+        # Write all the products along with the signatures of their source files
         manifest_writer = csv.writer(devel_manifest, delimiter=' ', quotechar='"')
-        for source_file, dest_file in products:
-            manifest_writer.writerow([source_file, dest_file])
+        for source_file, dest_file, signature in products:
+            if signature is None:
+                manifest_writer.writerow([source_file, dest_file])
+            else:
+                # The repr of the mtime is written, since str() rounds floats on Python 2
+                manifest_writer.writerow([source_file, dest_file, repr(signature[0]), signature[1]])
 
     return 0
 
@@ -464,7 +643,6 @@ def create_catkin_build_job(context, package, package_path, dependencies, force_
         stages.append(FunctionStage(
             'symlink',
             link_devel_products,
-            locked_resource='symlink-collisions-file',
             package=package,
             package_path=package_path,
             devel_manifest_path=context.package_metadata_path(package),
@@ -481,7 +659,7 @@ def create_catkin_build_job(context, package, package_path, dependencies, force_
             [MAKE_EXEC, 'install'],
             cwd=build_space,
             logger_factory=CMakeMakeIOBufferProtocol.factory,
-            locked_resource='installspace'
+            locked_resource=get_install_lock_name(package.name)
         ))
 
     return Job(
@@ -499,7 +677,8 @@ def create_catkin_clean_job(
         dry_run,
         clean_build,
         clean_devel,
-        clean_install):
+        clean_install,
+        trash_path=None):
     """Generate a Job that cleans a catkin package"""
 
     stages = []
@@ -534,7 +713,6 @@ def create_catkin_clean_job(
             stages.append(FunctionStage(
                 'unlink',
                 unlink_devel_products,
-                locked_resource='symlink-collisions-file',
                 devel_space_abs=context.devel_space_abs,
                 private_devel_path=context.package_private_devel_path(package),
                 metadata_path=context.metadata_path(),
@@ -547,14 +725,16 @@ def create_catkin_clean_job(
                 'rmdevel',
                 rmfiles,
                 paths=[context.package_private_devel_path(package)],
-                dry_run=dry_run))
+                dry_run=dry_run,
+                trash_path=trash_path))
         elif context.isolate_devel:
             # Remove devel space
             stages.append(FunctionStage(
                 'rmdevel',
                 rmfiles,
                 paths=[context.package_devel_space(package)],
-                dry_run=dry_run))
+                dry_run=dry_run,
+                trash_path=trash_path))
 
     # Remove build space
     if clean_build:
@@ -562,7 +742,8 @@ def create_catkin_clean_job(
             'rmbuild',
             rmfiles,
             paths=[build_space],
-            dry_run=dry_run))
+            dry_run=dry_run,
+            trash_path=trash_path))
 
     # Remove cached metadata
     if clean_build and clean_devel and clean_install:
@@ -570,7 +751,8 @@ def create_catkin_clean_job(
             'rmmetadata',
             rmfiles,
             paths=[metadata_path],
-            dry_run=dry_run))
+            dry_run=dry_run,
+            trash_path=trash_path))
 
     return Job(
         jid=package.name,
@@ -595,6 +777,15 @@ unset ROS_TEST_RESULTS_DIR
 
 DEVEL_MANIFEST_FILENAME = 'devel_manifest.txt'
 
+DEVEL_COLLISIONS_FILENAME = 'devel_collisions.db'
+LEGACY_DEVEL_COLLISIONS_FILENAME = 'devel_collisions.txt'
+
+# Seconds to wait for other stages which are updating the collision counts
+DEVEL_COLLISIONS_TIMEOUT = 60.0
+
+# Colliding files are hashed in blocks of this many bytes
+DIGEST_BLOCK_SIZE = 64 * 1024
+
 # List of files which shouldn't be copied
 DEVEL_LINK_PREBUILD_BLACKLIST = [
     '.catkin',
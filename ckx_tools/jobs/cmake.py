@@ -32,6 +32,7 @@ from .commands.make import MAKE_EXEC
 
 from .utils import copyfiles
 from .utils import get_env_loader
+from .utils import get_install_lock_name
 from .utils import makedirs
 from .utils import rmfiles
 
@@ -301,7 +302,7 @@ def create_cmake_build_job(context, package, package_path, dependencies, force_c
         [MAKE_EXEC, 'install'],
         cwd=build_space,
         logger_factory=CMakeMakeIOBufferProtocol.factory,
-        locked_resource='installspace'
+        locked_resource=get_install_lock_name(package.name)
     ))
 
     # Copy install manifest
@@ -342,7 +343,8 @@ def create_cmake_clean_job(
         dry_run,
         clean_build,
         clean_devel,
-        clean_install):
+        clean_install,
+        trash_path=None):
     """Generate a Job to clean a cmake package"""
 
     # Package build space path
@@ -377,7 +379,8 @@ def create_cmake_clean_job(
             'rmbuild',
             rmfiles,
             paths=[build_space],
-            dry_run=dry_run))
+            dry_run=dry_run,
+            trash_path=trash_path))
 
     # Remove cached metadata
     if clean_build and clean_devel and clean_install:
@@ -385,7 +388,8 @@ def create_cmake_clean_job(
             'rmmetadata',
             rmfiles,
             paths=[metadata_path],
-            dry_run=dry_run))
+            dry_run=dry_run,
+            trash_path=trash_path))
 
     return Job(
         jid=package.name,
@@ -19,9 +19,10 @@ import re
 
 from ckx_tools.execution.io import IOBufferProtocol
 from ckx_tools.execution.events import ExecutionEvent
+from ckx_tools.execution.events import wants_event
 
 from ckx_tools.terminal_color import fmt
-from ckx_tools.terminal_color import sanitize
+from ckx_tools.terminal_color import is_color_on
 
 from ckx_tools.utils import which
 
@@ -37,6 +38,38 @@ def split_to_last_line_break(data):
     return data[:last_break_index], data[last_break_index:]
 
 
+# The lines of CMake output which are colorized, as alternatives of a single
+# regular expression so that each line is classified in one pass. The last
+# group of each alternative identifies it in `CMAKE_LINE_FORMATS`.
+CMAKE_LINE_RE = re.compile('|'.join([
+    r'-- :(?P<note>.+)',
+    r'-- (?P<status>.+)',
+    r'CMake Error at (?P<error_path>.+):(?P<error_location>.+)',
+    r'CMake Warning at (?P<warning_path>.+):(?P<warning_location>.+)',
+    r'CMake Warning \(dev\) at (?P<dev_warning_path>.+):(?P<dev_warning_location>.+)',
+    r'(?P<warning>[Ww][Aa][Rr][Nn][Ii][Nn][Gg].*)',
+    r'[Ee][Rr][Rr][Oo][Rr]:(?P<error>.*)',
+    r'Call Stack \(most recent call first\):(?P<call_stack>.*)',
+]))
+
+# Map from the last group of each alternative of `CMAKE_LINE_RE` to:
+#  - output formatting line (subs captured groups)
+#  - whether the first captured group is a source-relative path
+CMAKE_LINE_FORMATS = {
+    'note': ('@{cf}--@| :@{yf}{}@|', False),
+    'status': ('@{cf}--@| {}', False),
+    'error_location': ('@{rf}@!CMake Error@| at {}:{}', True),
+    'warning_location': ('@{yf}@!CMake Warning@| at {}:{}', True),
+    'dev_warning_location': ('@{yf}@!CMake Warning (dev)@| at {}:{}', True),
+    'warning': ('@{yf}{}@|', False),
+    'error': ('@!@{rf}ERROR:@|{}@|', False),
+    'call_stack': ('@{cf}Call Stack (most recent call first):@|{}', False),
+}
+
+# CMake output which contains none of these can't contain a path which needs to be made absolute
+CMAKE_PATH_MARKERS = (b'CMake Error at ', b'CMake Warning')
+
+
 class CMakeIOBufferProtocol(IOBufferProtocol):
 
     """An asyncio protocol that collects stdout and stderr.
@@ -46,6 +79,11 @@ class CMakeIOBufferProtocol(IOBufferProtocol):
     Since the underlying asyncio API constructs the actual protocols, this
     class provides a factory method to inject the job and stage information
     into the created protocol.
+
+    Each line of output is classified with a single regular expression. When
+    color is disabled, only lines with source-relative paths are rewritten,
+    keeping their line breaks, and chunks of output without such lines are
+    passed through untouched.
     """
 
     def abspath(self, groups):
@@ -61,23 +99,9 @@ class CMakeIOBufferProtocol(IOBufferProtocol):
         self.stdout_tail = b''
         self.stderr_tail = b''
 
-        # Line formatting filters
-        # Each is a 3-tuple:
-        #  - regular expression (with captured groups)
-        #  - output formatting line (subs captured groups)
-        #  - functor which filters captured groups
-        filters = [
-            ('^-- :(.+)', '@{cf}--@| :@{yf}{}@|', None),
-            ('^-- (.+)', '@{cf}--@| {}', None),
-            ('CMake Error at (.+):(.+)', '@{rf}@!CMake Error@| at {}:{}', self.abspath),
-            ('CMake Warning at (.+):(.+)', '@{yf}@!CMake Warning@| at {}:{}', self.abspath),
-            ('CMake Warning (dev) at (.+):(.+)', '@{yf}@!CMake Warning (dev)@| at {}:{}', self.abspath),
-            ('(?i)(warning.*)', '@(yf){}@|', None),
-            ('(?i)ERROR:(.*)', '@!@(rf)ERROR:@|{}@|', None),
-            ('Call Stack \(most recent call first\):(.*)', '@{cf}Call Stack (most recent call first):@|{}', None),
-        ]
-
-        self.filters = [(re.compile(p), r, f) for (p, r, f) in filters]
+        # Line formatting templates, colorized with the current color setting
+        self.color = is_color_on()
+        self.formats = dict([(k, (fmt(r, reset=False), is_path)) for k, (r, is_path) in CMAKE_LINE_FORMATS.items()])
 
     def on_stdout_received(self, data):
         data_head, self.stdout_tail = split_to_last_line_break(self.stdout_tail + data)
@@ -87,7 +111,7 @@ class CMakeIOBufferProtocol(IOBufferProtocol):
     def on_stderr_received(self, data):
         # older versions of cmake erroneously printed the cache file load on stderr, skip these
         #    see https://gitlab.kitware.com/cmake/cmake/commit/6cc0f6b512d08caabf088d22f3f25432e6307b6a?view=parallel
-        if "loading initial cache file" in data:
+        if b"loading initial cache file" in data:
             return
         data_head, self.stderr_tail = split_to_last_line_break(self.stderr_tail + data)
         colored = self.color_lines(data_head)
@@ -111,10 +135,11 @@ class CMakeIOBufferProtocol(IOBufferProtocol):
 
     def color_lines(self, data):
         """Apply colorization rules to each line in data"""
+        # Raw fast path, when there is nothing to colorize or to rewrite
+        if not self.color and not any(marker in data for marker in CMAKE_PATH_MARKERS):
+            return data
+
         decoded_data = self._decode(data)
-        # TODO: This will only work if all lines are received at once. Instead
-        # of direclty splitting lines, we should buffer the data lines until
-        # the last character is a line break
         lines = decoded_data.splitlines(True)  # Keep line breaks
         colored_lines = [self.colorize_cmake(l) for l in lines]
         colored_data = ''.join(colored_lines)
@@ -140,42 +165,96 @@ class CMakeIOBufferProtocol(IOBufferProtocol):
         :param line: one, new line terminated, line from `cmake` which needs coloring.
         :type line: str
         """
-        # return line
-        cline = sanitize(line).rstrip()
+        if self.color:
+            line_break = '\r\n'
+        else:
+            # Keep the line breaks of the lines which aren't colorized
+            line_break = line[len(line.rstrip('\r\n')):]
+        cline = line.rstrip()
+
+        match = CMAKE_LINE_RE.match(cline)
+        if match is not None:
+            template, is_path = self.formats[match.lastgroup]
+            groups = tuple(g for g in match.groups() if g is not None)
+            if is_path:
+                groups = self.abspath(groups)
+            cline = template.format(*groups)
+
+        return cline + line_break
+
+
+# Matches the progress prefix of each line of the output of Makefiles generated
+# by CMake, and whether the line reports the compilation of a translation unit
+MAKE_PROGRESS_RE = re.compile(br'^\[\s*([0-9]+)%\] (Building \S+ object )?', re.MULTILINE)
+
+# Only the beginning of a line can hold a progress prefix, so incomplete lines
+# are truncated to this length while waiting for their line break
+MAX_PROGRESS_TAIL = 256
+
+
+class MakeProgressTracker(object):
+
+    """Tracks the progress of Makefiles generated by CMake from their streamed output.
+
+    Every line is parsed, regardless of how the output is split into chunks.
+    Since the percentages of targets which are built in parallel interleave,
+    only the highest percentage seen so far is reported.
+    """
+
+    def __init__(self):
+        self.tail = b''
+        self.percent = None
+        self.units = 0
+
+    def feed(self, data):
+        """Parse the complete lines in a chunk of output.
+
+        :returns: True if the reported percentage has increased
+        """
+        head, self.tail = split_to_last_line_break(self.tail + data)
+        self.tail = self.tail[:MAX_PROGRESS_TAIL]
 
-        if len(cline.strip()) > 0:
-            for p, r, f in self.filters:
-                match = p.match(cline)
-                if match is not None:
-                    cline = fmt(r, reset=False)
-                    if f is not None:
-                        cline = cline.format(*f(match.groups()))
-                    else:
-                        cline = cline.format(*match.groups())
-                    break
+        percent = self.percent
+        for match in MAKE_PROGRESS_RE.finditer(head):
+            if percent is None or int(match.group(1)) > percent:
+                percent = int(match.group(1))
+            if match.group(2) is not None:
+                self.units += 1
 
-        return cline + '\r\n'
+        if percent == self.percent:
+            return False
+        self.percent = percent
+        return True
 
 
 class CMakeMakeIOBufferProtocol(IOBufferProtocol):
 
-    """An IOBufferProtocol which parses CMake's progree prefixes and emits corresponding STAGE_PROGRESS events."""
+    """An IOBufferProtocol which parses CMake's progress prefixes and emits corresponding STAGE_PROGRESS events.
+
+    The events hold the percentage of the build, as a string, and the number
+    of translation units which have been compiled so far.
+    """
 
     def __init__(self, label, job_id, stage_label, event_queue, log_path, *args, **kwargs):
         super(CMakeMakeIOBufferProtocol, self).__init__(
             label, job_id, stage_label, event_queue, log_path, *args, **kwargs)
+        self.emits_progress = wants_event(event_queue, 'STAGE_PROGRESS')
+        self.progress = MakeProgressTracker()
 
     def on_stdout_received(self, data):
         super(CMakeMakeIOBufferProtocol, self).on_stdout_received(data)
 
+        if not self.emits_progress:
+            return
+
         # Parse CMake Make completion progress
-        progress_matches = re.match('\[\s*([0-9]+)%\]', self._decode(data))
-        if progress_matches is not None:
+        if self.progress.feed(data):
             self.event_queue.put(ExecutionEvent(
                 'STAGE_PROGRESS',
                 job_id=self.job_id,
                 stage_label=self.stage_label,
-                percent=str(progress_matches.groups()[0])))
+                percent=str(self.progress.percent),
+                units=self.progress.units))
 
 
 def get_installed_files(path):
@@ -14,23 +14,82 @@
 
 from __future__ import print_function
 
+import errno
 import os
 import shutil
+import subprocess
+import sys
+import tempfile
 
 from ckx_tools.common import mkdir_p
 from ckx_tools.common import get_cached_recursive_build_depends_in_workspace
 
+from ckx_tools.resultspace import apply_composable_env_delta
+from ckx_tools.resultspace import get_base_env_digest
+from ckx_tools.resultspace import get_composable_env_delta
 from ckx_tools.resultspace import get_resultspace_environment
+from ckx_tools.resultspace import get_resultspace_stamps
 
 from ckx_tools.execution.events import ExecutionEvent
 
+from .commands.cmake import CMAKE_INSTALL_MANIFEST_FILENAME
+from .commands.cmake import get_installed_files
+
+
+# Changes made to the environment by sourcing each isolated resultspace on top
+# of the environments of its dependencies
+# Maps (resultspace path, base environment digest) to 2-tuples: (stamps, env delta)
+_isolated_env_deltas = {}
+
+# The prefix of the names of the locks of the install stages of each package
+INSTALL_LOCK_PREFIX = 'installspace:'
+
+# Files which every catkin package installs into the root of the install space,
+# generated from the same templates for the same install space, so installing
+# them at the same time doesn't conflict
+SHARED_INSTALL_FILES = [
+    '.catkin',
+    '.rosinstall',
+    '_setup_util.py',
+    'env.sh',
+    'local_setup.bash',
+    'local_setup.sh',
+    'local_setup.zsh',
+    'setup.bash',
+    'setup.sh',
+    'setup.zsh',
+    os.path.join('etc', 'catkin', 'profile.d', '05.catkin_make.bash'),
+    os.path.join('etc', 'catkin', 'profile.d', '05.catkin_make_isolated.bash'),
+]
+
+# The directory in the workspace which removed directories are moved into,
+# before they are deleted in the background
+TRASH_DIR_NAME = '.ckx_trash'
+
+# Run by a detached Python interpreter to delete everything in a trash directory
+EMPTY_TRASH_SCRIPT = """\
+import os, shutil, sys
+trash_path = sys.argv[1]
+for name in os.listdir(trash_path):
+    shutil.rmtree(os.path.join(trash_path, name), ignore_errors=True)
+try:
+    os.rmdir(trash_path)
+except OSError:
+    pass
+"""
+
+
+def uses_isolated_envs(context):
+    """Check if each package is built in the environments of all of its dependencies' resultspaces."""
+    return (context.install and context.isolate_install) or (not context.install and context.isolate_devel)
+
 
 def get_env_loaders(package, context):
     """Get a list of env loaders required to build this package."""
 
     sources = []
     # If installing to isolated folders or not installing, but devel spaces are not merged
-    if (context.install and context.isolate_install) or (not context.install and context.isolate_devel):
+    if uses_isolated_envs(context):
         # Source each package's install or devel space
         space = context.install_space_abs if context.install else context.devel_space_abs
         # Get the recursive dependcies
@@ -50,6 +109,62 @@ def get_env_loaders(package, context):
     return sources
 
 
+def get_isolated_env(package, context, base_env):
+    """Compose the environment of the isolated resultspaces of a package's dependencies.
+
+    Instead of sourcing the resultspace of every dependency in turn, the
+    changes made by each resultspace are computed once, by sourcing it on
+    top of the environment of its own dependencies, and the environment of
+    the package is then assembled in-process from those changes. Path lists
+    like ``PATH`` are merged, so entries added by each dependency are kept.
+
+    :param package: package whose dependencies' environments are composed
+    :param context: context of the workspace, using isolated result spaces
+    :param base_env: environment on top of which the dependencies are loaded
+    :returns: the composed environment
+    :rtype: dict
+    """
+    space = context.install_space_abs if context.install else context.devel_space_abs
+    base_digest = get_base_env_digest(base_env)
+    cache_path = context.env_cache_path()
+
+    deltas = {}
+    for _, dep in get_cached_recursive_build_depends_in_workspace(package, context.packages):
+        resultspace_path = os.path.join(space, dep.name)
+        key = (resultspace_path, base_digest)
+        stamps = get_resultspace_stamps(resultspace_path)
+
+        cached_delta = _isolated_env_deltas.get(key)
+        if context.use_env_cache and cached_delta is not None and cached_delta[0] == stamps:
+            deltas[dep.name] = cached_delta[1]
+            continue
+
+        # Load the resultspace on top of the environment of its own dependencies
+        dep_env = dict(base_env)
+        for _, dep_dep in get_cached_recursive_build_depends_in_workspace(dep, context.packages):
+            dep_env = apply_composable_env_delta(dep_env, deltas[dep_dep.name])
+        resultspace_env = get_resultspace_environment(
+            resultspace_path,
+            base_env=dep_env,
+            quiet=True,
+            cached=context.use_env_cache,
+            strict=False,
+            cache_path=cache_path)
+
+        # Resultspaces which can't be loaded don't change the environment
+        if len(resultspace_env) > 0:
+            deltas[dep.name] = get_composable_env_delta(dep_env, resultspace_env)
+        else:
+            deltas[dep.name] = {}
+        _isolated_env_deltas[key] = (stamps, deltas[dep.name])
+
+    env = dict(base_env)
+    for _, dep in get_cached_recursive_build_depends_in_workspace(package, context.packages):
+        env = apply_composable_env_delta(env, deltas[dep.name])
+
+    return env
+
+
 def get_env_loader(package, context):
     """This function returns a function object which extends a base environment
     based on a set of environments to load."""
@@ -57,12 +172,17 @@ def get_env_loader(package, context):
     def load_env(base_env):
         # Copy the base environment to extend
         job_env = dict(base_env)
-        # Get the paths to the env loaders
-        env_loader_paths = get_env_loaders(package, context)
         # If DESTDIR is set, set _CATKIN_SETUP_DIR as well
         if context.destdir is not None:
             job_env['_CATKIN_SETUP_DIR'] = context.package_dest_path(package)
 
+        # Compose the environments of isolated dependencies in-process
+        if uses_isolated_envs(context):
+            return get_isolated_env(package, context, job_env)
+
+        # Get the paths to the env loaders
+        env_loader_paths = get_env_loaders(package, context)
+
         for env_loader_path in env_loader_paths:
             # print(' - Loading resultspace env from: {}'.format(env_loader_path))
             resultspace_env = get_resultspace_environment(
@@ -70,7 +190,8 @@ def get_env_loader(package, context):
                 base_env=job_env,
                 quiet=True,
                 cached=context.use_env_cache,
-                strict=False)
+                strict=False,
+                cache_path=context.env_cache_path())
             job_env.update(resultspace_env)
 
         return job_env
@@ -78,6 +199,81 @@ def get_env_loader(package, context):
     return load_env
 
 
+def get_install_lock_name(package_name):
+    """Get the name of the lock which the install stage of a package holds."""
+    return INSTALL_LOCK_PREFIX + package_name
+
+
+def get_previous_installed_files(context, package):
+    """Get the files which were installed by the previous build of a package.
+
+    The files are read from the install manifest in the build space of the
+    package, and exclude the setup files which every catkin package installs.
+
+    :returns: set of absolute paths, or None if the package hasn't been installed yet
+    """
+    build_space = context.package_build_space(package)
+    if not os.path.exists(os.path.join(build_space, CMAKE_INSTALL_MANIFEST_FILENAME)):
+        return None
+    install_space = os.path.join(context.destdir, context.install_space_abs.lstrip(os.sep)) \
+        if context.destdir else context.install_space_abs
+    shared_files = set([os.path.join(install_space, f) for f in SHARED_INSTALL_FILES])
+    return get_installed_files(build_space) - shared_files
+
+
+def get_trash_path(workspace):
+    """Get the path to the trash directory of a workspace."""
+    return os.path.join(workspace, TRASH_DIR_NAME)
+
+
+def move_to_trash(path, trash_path):
+    """Atomically move a file or directory into a trash directory, from which it can be deleted later.
+
+    :returns: True if the path was moved, False if the trash directory is on a different filesystem
+    """
+    for retry in [True, False]:
+        mkdir_p(trash_path)
+        try:
+            # Each path is moved into a unique directory, so paths with the same name don't collide
+            batch_path = tempfile.mkdtemp(prefix=os.path.basename(path) + '.', dir=trash_path)
+            break
+        except OSError as exc:
+            # The trash directory may have just been removed by a background process which emptied it
+            if exc.errno != errno.ENOENT or not retry:
+                raise
+
+    try:
+        os.rename(path, os.path.join(batch_path, os.path.basename(path)))
+    except OSError as exc:
+        os.rmdir(batch_path)
+        if exc.errno == errno.EXDEV:
+            return False
+        raise
+    return True
+
+
+def empty_trash_in_background(trash_path):
+    """Start a detached process which deletes everything in a trash directory, and the directory itself.
+
+    :returns: the process, or None if there is no trash directory
+    """
+    if not os.path.isdir(trash_path):
+        return None
+    if sys.version_info[0] >= 3:
+        detach = dict(start_new_session=True)
+    else:
+        detach = dict(preexec_fn=os.setsid)
+    with open(os.devnull, 'r+b') as devnull:
+        return subprocess.Popen(
+            [sys.executable, '-c', EMPTY_TRASH_SCRIPT, trash_path],
+            cwd=os.path.dirname(trash_path),
+            stdin=devnull,
+            stdout=devnull,
+            stderr=devnull,
+            close_fds=True,
+            **detach)
+
+
 def makedirs(logger, event_queue, path):
     """FunctionStage functor that makes a path of directories."""
     mkdir_p(path)
@@ -103,74 +299,122 @@ def rmdirs(logger, event_queue, paths):
     return rmfiles(logger, event_queue, paths, remove_empty=False)
 
 
-def rmfiles(logger, event_queue, paths, dry_run, remove_empty=False, empty_root='/'):
+def find_empty_dirs(paths, empty_root):
+    """Find the directories which become empty when a set of paths is removed.
+
+    The ancestors of the paths below `empty_root` are collected, stopping at
+    the first ancestor which has already been seen, and then visited deepest
+    first, so every directory is listed once, and a directory becomes empty
+    if all of its entries are removed or become empty themselves.
+
+    :param paths: set of absolute paths which are removed
+    :param empty_root: directories above this path are never removed
+    :returns: list of the directories which become empty, deepest first
+    :rtype: list
+    """
+    empty_root = os.path.normpath(empty_root)
+    prefix = os.path.join(empty_root, '')
+
+    # The directories which may become empty after cleaning
+    dirs_to_check = set()
+    for path in paths:
+        # Make sure the file is given by an absolute path and it exists
+        if not os.path.isabs(path) or not os.path.lexists(path):
+            continue
+
+        # Only look in the empty root, which can become empty itself
+        path = os.path.dirname(path)
+        while (path == empty_root or path.startswith(prefix)) and path not in dirs_to_check:
+            dirs_to_check.add(path)
+            path = os.path.dirname(path)
+
+    # Visit the directories depth-first, so the removed entries include the subdirectories which become empty
+    removed = set(paths)
+    empty_dirs = []
+    for path in sorted(dirs_to_check, key=lambda k: -k.count(os.path.sep)):
+        try:
+            entries = os.listdir(path)
+        except OSError:
+            continue
+        if all([os.path.join(path, entry) in removed for entry in entries]):
+            removed.add(path)
+            empty_dirs.append(path)
+
+    return empty_dirs
+
+
+class _ProgressReporter(object):
+
+    """Reports the progress of a stage, but only when the percentage changes."""
+
+    def __init__(self, logger, event_queue, total):
+        self.logger = logger
+        self.event_queue = event_queue
+        self.total = max(1, total)
+        self.percent = None
+
+    def update(self, done):
+        percent = (100 * done) // self.total
+        if percent != self.percent:
+            self.percent = percent
+            self.event_queue.put(ExecutionEvent(
+                'STAGE_PROGRESS',
+                job_id=self.logger.job_id,
+                stage_label=self.logger.stage_label,
+                percent=str(percent)))
+
+
+def rmfiles(logger, event_queue, paths, dry_run, remove_empty=False, empty_root='/', trash_path=None):
     """FunctionStage functor that removes a list of files and directories.
 
     If remove_empty is True, then this will also remove directories which
-    become emprt after deleting the files in `paths`. It will delete files up
+    become empty after deleting the files in `paths`. It will delete files up
     to the path specified by `empty_root`.
+
+    If `trash_path` is given, directories are moved into that trash directory
+    instead of being deleted, see :py:func:`move_to_trash`.
     """
 
+    paths = [os.path.normpath(path) if os.path.isabs(path) else path for path in paths]
+
     # Determine empty directories
-    if remove_empty:
-        # First get a list of directories to check
-        dirs_to_check = set()
-
-        for path in paths:
-            # Make sure the file is given by an absolute path and it exists
-            if not os.path.isabs(path) or not os.path.exists(path):
-                continue
-
-            # Only look in the devel space
-            while empty_root.find(path) != 0:
-                # Pop up a directory
-                path, dirname = os.path.split(path)
-
-                # Skip if this path isn't a directory
-                if not os.path.isdir(path):
-                    continue
-
-                dirs_to_check.add(path)
-
-        # For each directory which may be empty after cleaning, visit them
-        # depth-first and count their descendants
-        dir_descendants = dict()
-        for path in sorted(dirs_to_check, key=lambda k: -len(k.split(os.path.sep))):
-            # Get the absolute path to all the files currently in this directory
-            files = [os.path.join(path, f) for f in os.listdir(path)]
-            # Filter out the files which we intend to remove
-            files = [f for f in files if f not in paths]
-            # Compute the minimum number of files potentially contained in this path
-            dir_descendants[path] = sum([
-                (dir_descendants.get(f, 1) if os.path.isdir(f) else 1)
-                for f in files
-            ])
-
-            # Schedule the directory for removal if removal of the given files will make it empty
-            if dir_descendants[path] == 0:
-                paths.append(path)
-
-    # REmove the paths
+    empty_dirs = find_empty_dirs(set(paths), empty_root) if remove_empty else []
+
+    progress = _ProgressReporter(logger, event_queue, len(paths) + len(empty_dirs))
+
+    # Remove the paths
     for index, path in enumerate(paths):
 
         # Remove the path
-        if os.path.exists(path):
-            if os.path.isdir(path):
-                logger.out('Removing directory: {}'.format(path))
-                if not dry_run:
-                    shutil.rmtree(path)
-            else:
-                logger.out('     Removing file: {}'.format(path))
-                if not dry_run:
-                    os.remove(path)
+        if os.path.isdir(path) and not os.path.islink(path) and trash_path is not None:
+            logger.out('Trashing directory: {}'.format(path))
+            if not dry_run and not move_to_trash(path, trash_path):
+                shutil.rmtree(path)
+        elif os.path.isdir(path) and not os.path.islink(path):
+            logger.out('Removing directory: {}'.format(path))
+            if not dry_run:
+                shutil.rmtree(path)
+        elif os.path.lexists(path):
+            logger.out('     Removing file: {}'.format(path))
+            if not dry_run:
+                os.remove(path)
         else:
             logger.err('Warning: File {} could not be deleted because it does not exist.'.format(path))
 
-        # Report progress
-        event_queue.put(ExecutionEvent(
-            'STAGE_PROGRESS',
-            job_id=logger.job_id,
-            stage_label=logger.stage_label,
-            percent=str(index / float(len(paths)))))
+        progress.update(index + 1)
+
+    # Remove the directories which are empty now, deepest first
+    for index, path in enumerate(empty_dirs):
+        logger.out('Removing directory: {}'.format(path))
+        if not dry_run:
+            try:
+                os.rmdir(path)
+            except OSError as exc:
+                # Other jobs may add files to the directory or remove it at the same time
+                if exc.errno not in (errno.ENOENT, errno.ENOTEMPTY, errno.EEXIST):
+                    raise
+                logger.err('Warning: Directory {} could not be deleted: {}'.format(path, exc.strerror))
+
+        progress.update(len(paths) + index + 1)
 
     return 0
@@ -0,0 +1,279 @@
+# Copyright 2014 Open Source Robotics Foundation, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Persistent index of the packages found under a path.
+
+Crawling a source space and parsing every ``package.xml`` is the dominant
+startup cost of most verbs on large workspaces. This module keeps the parsed
+packages in a pickled index in the profile metadata directory, keyed by the
+relative path of each manifest along with its mtime and size. On subsequent
+calls, the index is revalidated with a stat pass over the directories which
+were crawled and the manifests which were found, and only manifests which
+have changed are parsed again.
+"""
+
+from __future__ import print_function
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    from md5 import md5
+except ImportError:
+    from hashlib import md5
+
+import os
+import sys
+import tempfile
+
+from catkin_pkg.package import PACKAGE_MANIFEST_FILENAME
+from catkin_pkg.package import parse_package
+
+from .common import mkdir_p
+from .metadata import get_metadata_root_path
+
+PACKAGE_INDEX_DIR_NAME = 'package_index'
+
+# Bump this whenever the layout of the pickled index changes
+PACKAGE_INDEX_VERSION = 1
+
+# Files which prevent a directory from being crawled
+IGNORE_MARKERS = ('CATKIN_IGNORE', 'AMENT_IGNORE', 'COLCON_IGNORE')
+
+
+def _stat_signature(path):
+    """Get the (mtime, size) signature of a path or None if it doesn't exist."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size)
+
+
+def crawl_package_paths(basepath, exclude_subspaces=False):
+    """Find the directories containing package manifests under a path.
+
+    This mirrors :py:func:`catkin_pkg.packages.find_package_paths`, but it also
+    returns the stat signature of every directory which was listed so that the
+    crawl can be revalidated without listing the directories again.
+
+    :param basepath: The path to search in
+    :type basepath: str
+    :param exclude_subspaces: Don't search directories containing a ``.catkin`` file
+    :type exclude_subspaces: bool
+    :returns: tuple of the relative package paths and a dict mapping each
+        crawled directory to its stat signature
+    :rtype: tuple(list, dict)
+    """
+    package_paths = []
+    # The base path is always recorded so that it appearing later is noticed
+    crawled_dirs = {basepath: _stat_signature(basepath)}
+
+    for dirpath, dirnames, filenames in os.walk(basepath, followlinks=True):
+        crawled_dirs[dirpath] = _stat_signature(dirpath)
+
+        if (any([m in filenames for m in IGNORE_MARKERS]) or
+                (exclude_subspaces and '.catkin' in filenames)):
+            del dirnames[:]
+            continue
+        elif PACKAGE_MANIFEST_FILENAME in filenames:
+            package_paths.append(os.path.relpath(dirpath, basepath))
+            del dirnames[:]
+            continue
+
+        # Filter out hidden directories in-place
+        dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+
+    return package_paths, crawled_dirs
+
+
+def get_package_index_path(metadata_path, basepath, exclude_subspaces=False):
+    """Get the path to the index file for packages found under a given path.
+
+    :param metadata_path: The profile metadata directory
+    :type metadata_path: str
+    :param basepath: The path which is crawled for packages
+    :type basepath: str
+    :param exclude_subspaces: Whether the index excludes subspaces
+    :type exclude_subspaces: bool
+    :returns: path to the index file
+    :rtype: str
+    """
+    key = '{}:{}'.format(os.path.abspath(basepath), bool(exclude_subspaces))
+    return os.path.join(
+        metadata_path,
+        PACKAGE_INDEX_DIR_NAME,
+        '{}.pickle'.format(md5(key.encode('utf-8')).hexdigest()))
+
+
+def load_package_index(index_path):
+    """Load a package index from disk.
+
+    :returns: the index dict, or None if it doesn't exist or can't be used
+    :rtype: dict
+    """
+    if index_path is None or not os.path.exists(index_path):
+        return None
+
+    try:
+        with open(index_path, 'rb') as index_file:
+            index = pickle.load(index_file)
+    except Exception:
+        # A corrupted or incompatible index is simply rebuilt
+        return None
+
+    if not isinstance(index, dict):
+        return None
+    if index.get('version') != PACKAGE_INDEX_VERSION or index.get('python') != sys.version_info[0]:
+        return None
+
+    return index
+
+
+def save_package_index(index_path, index):
+    """Atomically write a package index to disk."""
+
+    index_dir = os.path.dirname(index_path)
+    mkdir_p(index_dir)
+
+    # Create a temporary file in the index directory, so os.rename cannot fail
+    tmp_handle, tmp_path = tempfile.mkstemp(dir=index_dir, prefix=os.path.basename(index_path) + '.')
+    try:
+        with os.fdopen(tmp_handle, 'wb') as tmp_file:
+            pickle.dump(index, tmp_file, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, index_path)
+    except (IOError, OSError):
+        # Failing to persist the index only costs time on the next invocation
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+
+def _crawl_is_valid(index):
+    """Check if none of the directories crawled for an index have changed."""
+    for dirpath, signature in index['dirs'].items():
+        if _stat_signature(dirpath) != signature:
+            return False
+    return True
+
+
+def find_packages(basepath, index_path=None, exclude_subspaces=False, warnings=None):
+    """Find and parse the packages under a path, re-using a persistent index.
+
+    This is a drop-in replacement for :py:func:`catkin_pkg.packages.find_packages`.
+
+    :param basepath: The path to search in
+    :type basepath: str
+    :param index_path: The path to the index file, no index is used if None
+    :type index_path: str
+    :param exclude_subspaces: Don't search directories containing a ``.catkin`` file
+    :type exclude_subspaces: bool
+    :param warnings: Print warnings if None or return them in the given list
+    :type warnings: list
+    :returns: A dict mapping relative paths to ``Package`` objects
+    :rtype: dict
+    :raises: RuntimeError if multiple packages have the same name
+    """
+
+    index = load_package_index(index_path)
+    if index is not None and index.get('basepath') != os.path.abspath(basepath):
+        index = None
+
+    # Re-use the crawl if none of the crawled directories have changed
+    if index is not None and _crawl_is_valid(index):
+        package_paths = list(index['packages'].keys())
+        crawled_dirs = index['dirs']
+    else:
+        package_paths, crawled_dirs = crawl_package_paths(basepath, exclude_subspaces)
+
+    cached_packages = index['packages'] if index is not None else {}
+    indexed_packages = {}
+    index_changed = index is None or crawled_dirs is not index['dirs']
+
+    packages = {}
+    for path in package_paths:
+        manifest_path = os.path.join(basepath, path, PACKAGE_MANIFEST_FILENAME)
+        signature = _stat_signature(manifest_path)
+
+        cached = cached_packages.get(path)
+        if cached is not None and signature is not None and cached[0] == signature:
+            _, package, package_warnings = cached
+        else:
+            package_warnings = []
+            package = parse_package(os.path.join(basepath, path), warnings=package_warnings)
+            index_changed = True
+
+        if warnings is None:
+            for warning in package_warnings:
+                print('WARNING: ' + warning, file=sys.stderr)
+        else:
+            warnings.extend(package_warnings)
+
+        packages[path] = package
+        indexed_packages[path] = (signature, package, package_warnings)
+
+    # Packages which were removed also invalidate the index
+    if len(indexed_packages) != len(cached_packages):
+        index_changed = True
+
+    # Check for duplicate package names
+    package_paths_by_name = {}
+    for path, package in packages.items():
+        package_paths_by_name.setdefault(package.name, set()).add(path)
+    duplicates = [
+        'Multiple packages found with the same name "%s":%s' % (
+            name, ''.join(['\n- %s' % p for p in sorted(paths)]))
+        for name, paths in sorted(package_paths_by_name.items())
+        if len(paths) > 1]
+    if duplicates:
+        raise RuntimeError('\n'.join(duplicates))
+
+    if index_path is not None and index_changed:
+        save_package_index(index_path, {
+            'version': PACKAGE_INDEX_VERSION,
+            'python': sys.version_info[0],
+            'basepath': os.path.abspath(basepath),
+            'dirs': crawled_dirs,
+            'packages': indexed_packages})
+
+    return packages
+
+
+def find_workspace_packages(context, basepath=None, exclude_subspaces=False, warnings=None):
+    """Find the packages under a path in a workspace, using the profile's package index.
+
+    The index is only persisted if the workspace has been initialized, so
+    read-only verbs never create metadata directories in arbitrary paths.
+
+    :param context: Workspace context
+    :type context: :py:class:`ckx_tools.context.Context`
+    :param basepath: The path to search in, defaults to the source space
+    :type basepath: str
+    :returns: A dict mapping relative paths to ``Package`` objects
+    :rtype: dict
+    """
+
+    basepath = basepath or context.source_space_abs
+
+    index_path = None
+    metadata_root_path = get_metadata_root_path(context.workspace)
+    if metadata_root_path and os.path.isdir(metadata_root_path) and context.profile:
+        index_path = get_package_index_path(context.metadata_path(), basepath, exclude_subspaces)
+
+    return find_packages(
+        basepath,
+        index_path=index_path,
+        exclude_subspaces=exclude_subspaces,
+        warnings=warnings)
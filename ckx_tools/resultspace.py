@@ -14,13 +14,20 @@
 
 from __future__ import print_function
 
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
 try:
     from md5 import md5
 except ImportError:
     from hashlib import md5
+import glob
 import os
 import subprocess
 import sys
+import tempfile
 
 try:
     from shlex import quote as cmd_quote
@@ -29,21 +36,258 @@ except ImportError:
 
 from osrf_pycommon.process_utils import execute_process
 
+from .common import mkdir_p
 from .common import parse_env_str
 from .common import string_type
 
 DEFAULT_SHELL = '/bin/bash'
 
+ENV_CACHE_DIR_NAME = 'env_cache'
+
+# Bump this whenever the layout of the cached environments changes
+ENV_CACHE_VERSION = 2
+
+# Files in a resultspace which determine the environment it sets up
+# TODO: the env hooks path should be defined somewhere
+RESULTSPACE_SETUP_FILES = ('.catkin', 'env.sh', 'setup.sh', '_setup_util.py')
+RESULTSPACE_ENV_HOOKS_PATH = os.path.join('etc', 'catkin', 'profile.d')
+
+# Subfolders of a prefix which its setup files add to the environment if they exist
+# TODO: these mirror ENV_VAR_SUBFOLDERS in catkin's _setup_util.py
+ENV_VAR_SUBFOLDERS = ('bin', 'lib', os.path.join('lib', 'pkgconfig'))
+PYTHON_SUBFOLDERS_PATTERN = os.path.join('lib', 'python*', 'dist-packages')
+
+# Variables which are never taken from a sourced environment
+BLACKLISTED_ENV_KEYS = ('_', 'PWD')
+
+# Variables which differ between shells without affecting the environment
+# resulting from sourcing a resultspace
+VOLATILE_ENV_KEYS = BLACKLISTED_ENV_KEYS + (
+    'OLDPWD', 'SHLVL', 'COLUMNS', 'LINES', 'WINDOWID', 'TERM_SESSION_ID', 'XDG_SESSION_ID',
+    'SSH_AUTH_SOCK', 'SSH_AGENT_PID', 'SSH_CLIENT', 'SSH_CONNECTION', 'SSH_TTY')
+
 # Cache for result-space environments
-# Maps absolute paths to 3-tuples: (base_env, hooks, result_env}
+# Maps (absolute path, base environment digest) to 2-tuples: (stamps, env delta)
 _resultspace_env_cache = {}
 
 
-def get_resultspace_environment(result_space_path, base_env=None, quiet=False, cached=True, strict=True):
+def _stat_signature(path):
+    """Get the (mtime, size) signature of a path or None if it doesn't exist."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size)
+
+
+def get_prefix_stamps(prefix_path):
+    """Get the stat signatures of the files and folders of a prefix which affect its environment.
+
+    These are the setup files, the env hooks, and the subfolders which the
+    setup files add to variables like ``PATH`` only if they exist.
+
+    :returns: list of (relative path, signature) tuples
+    :rtype: list
+    """
+    names = list(RESULTSPACE_SETUP_FILES + ENV_VAR_SUBFOLDERS)
+    names.extend(sorted([
+        os.path.relpath(path, prefix_path)
+        for path in glob.glob(os.path.join(prefix_path, PYTHON_SUBFOLDERS_PATTERN))]))
+    stamps = [(name, _stat_signature(os.path.join(prefix_path, name))) for name in names]
+
+    env_hooks_path = os.path.join(prefix_path, RESULTSPACE_ENV_HOOKS_PATH)
+    if os.path.isdir(env_hooks_path):
+        for name in sorted(os.listdir(env_hooks_path)):
+            stamps.append((
+                os.path.join(RESULTSPACE_ENV_HOOKS_PATH, name),
+                _stat_signature(os.path.join(env_hooks_path, name))))
+
+    return stamps
+
+
+def get_resultspace_stamps(result_space_path, prefix_paths=()):
+    """Get the stat signatures of a resultspace and of the workspaces it extends.
+
+    :param prefix_paths: the prefixes of the underlays of the resultspace, see
+        :py:func:`get_prefix_paths`
+    :returns: list of (prefix path, stamps from :py:func:`get_prefix_stamps`) tuples
+    :rtype: list
+    """
+    result_space_path = os.path.abspath(result_space_path)
+    paths = [result_space_path]
+    for prefix_path in map(os.path.abspath, prefix_paths):
+        if prefix_path not in paths:
+            paths.append(prefix_path)
+    return [(path, get_prefix_stamps(path)) for path in paths]
+
+
+def get_prefix_paths(env):
+    """Get the prefixes of the workspaces which make up an environment."""
+    return _split_path_list(env.get('CMAKE_PREFIX_PATH', ''))
+
+
+def get_base_env_digest(base_env):
+    """Get a digest of the variables of an environment which can affect sourcing a resultspace."""
+    return md5(repr(sorted([
+        (k, v) for k, v in base_env.items()
+        if k not in VOLATILE_ENV_KEYS])).encode('utf-8')).hexdigest()
+
+
+def get_env_delta(base_env, result_env):
+    """Get the changes which turn one environment into another.
+
+    :returns: tuple of a dict of the variables which are set or changed, and a
+        list of the variables which are removed
+    :rtype: tuple(dict, list)
+    """
+    set_vars = dict([(k, v) for k, v in result_env.items() if base_env.get(k) != v])
+    unset_vars = [k for k in base_env if k not in result_env and k not in BLACKLISTED_ENV_KEYS]
+    return set_vars, unset_vars
+
+
+def apply_env_delta(base_env, env_delta):
+    """Apply changes from :py:func:`get_env_delta` to an environment.
+
+    :returns: a new environment, without the blacklisted variables
+    :rtype: dict
+    """
+    set_vars, unset_vars = env_delta
+    unset_vars = set(unset_vars)
+    env = dict([
+        (k, v) for k, v in base_env.items()
+        if k not in unset_vars and k not in BLACKLISTED_ENV_KEYS])
+    env.update(set_vars)
+    return env
+
+
+def _is_path_list(key):
+    """Check if a variable holds a list of paths, like ``PATH`` or ``CMAKE_PREFIX_PATH``."""
+    return key.endswith('PATH')
+
+
+def _split_path_list(value):
+    return [e for e in value.split(os.pathsep) if e]
+
+
+def get_composable_env_delta(base_env, result_env):
+    """Get the changes which turn one environment into another, in a form
+    which can be applied on top of a different environment.
+
+    Unlike :py:func:`get_env_delta`, changes to path lists like ``PATH`` are
+    described by the entries which were removed, prepended and appended, so
+    that applying them to another environment keeps its additional entries.
+
+    :returns: dict from each changed variable to None if it is removed, its
+        new value, or a (removed, prepended, appended) tuple for path lists
+    :rtype: dict
+    """
+    delta = {}
+    for k, v in result_env.items():
+        base_v = base_env.get(k)
+        if base_v == v:
+            continue
+        if not _is_path_list(k):
+            delta[k] = v
+            continue
+
+        base_entries = _split_path_list(base_v or '')
+        entries = _split_path_list(v)
+        kept = set(base_entries).intersection(entries)
+        kept_indices = [i for i, e in enumerate(entries) if e in kept]
+        if len(kept_indices) == 0:
+            prepended, appended = entries, []
+        else:
+            # New entries between kept ones are moved to the front
+            prepended = [e for e in entries[:kept_indices[-1] + 1] if e not in kept]
+            appended = [e for e in entries[kept_indices[-1] + 1:] if e not in kept]
+        delta[k] = ([e for e in base_entries if e not in kept], prepended, appended)
+
+    for k in base_env:
+        if k not in result_env and k not in BLACKLISTED_ENV_KEYS:
+            delta[k] = None
+
+    return delta
+
+
+def apply_composable_env_delta(env, delta):
+    """Apply changes from :py:func:`get_composable_env_delta` to an environment.
+
+    :returns: a new environment
+    :rtype: dict
+    """
+    env = dict(env)
+    for k, change in delta.items():
+        if change is None:
+            env.pop(k, None)
+        elif isinstance(change, tuple):
+            removed, prepended, appended = change
+            skipped = set(removed + prepended + appended)
+            entries = [e for e in _split_path_list(env.get(k, '')) if e not in skipped]
+            env[k] = os.pathsep.join(prepended + entries + appended)
+        else:
+            env[k] = change
+    return env
+
+
+def get_env_cache_path(metadata_path):
+    """Get the directory in which resultspace environments are cached for a profile."""
+    return os.path.join(metadata_path, ENV_CACHE_DIR_NAME)
+
+
+def _get_env_cache_file(cache_path, cache_key):
+    return os.path.join(cache_path, md5(repr(cache_key).encode('utf-8')).hexdigest() + '.pickle')
+
+
+def _load_cached_env(cache_path, cache_key):
+    """Load a cached environment from disk.
+
+    :returns: a (stamps, env delta) tuple, or None if there is no usable entry
+    """
+    try:
+        with open(_get_env_cache_file(cache_path, cache_key), 'rb') as cache_file:
+            entry = pickle.load(cache_file)
+    except Exception:
+        # Missing, corrupted or incompatible entries are simply re-generated
+        return None
+
+    if not isinstance(entry, dict) or entry.get('version') != ENV_CACHE_VERSION or entry.get('key') != cache_key:
+        return None
+
+    return entry['stamps'], entry['delta']
+
+
+def _store_cached_env(cache_path, cache_key, stamps, env_delta):
+    """Atomically write a cached environment to disk."""
+    cache_file_path = _get_env_cache_file(cache_path, cache_key)
+    entry = {'version': ENV_CACHE_VERSION, 'key': cache_key, 'stamps': stamps, 'delta': env_delta}
+
+    try:
+        mkdir_p(cache_path)
+        tmp_handle, tmp_path = tempfile.mkstemp(dir=cache_path, prefix=os.path.basename(cache_file_path) + '.')
+    except (IOError, OSError):
+        return
+    try:
+        with os.fdopen(tmp_handle, 'wb') as tmp_file:
+            pickle.dump(entry, tmp_file, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, cache_file_path)
+    except (IOError, OSError):
+        # Failing to persist the environment only costs time on the next invocation
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+
+def get_resultspace_environment(
+        result_space_path, base_env=None, quiet=False, cached=True, strict=True, cache_path=None):
     """Get the environemt variables which result from sourcing another catkin
     workspace's setup files as the string output of `cmake -E environment`.
     This cmake command is used to be as portable as possible.
 
+    Cached environments are stored as changes to the base environment, keyed
+    on the resultspace path and a digest of the base environment, and they
+    are only re-used while the stat signatures of the setup files, env hooks
+    and environment subfolders of the resultspace and of the workspaces in
+    the ``CMAKE_PREFIX_PATH`` it sets up are unchanged.
+
     :param result_space_path: path to a Catkin result-space whose environment should be loaded, ``str``
     :type result_space_path: str
     :param quiet: don't throw exceptions, ``bool``
@@ -52,6 +296,9 @@ def get_resultspace_environment(result_space_path, base_env=None, quiet=False, c
     :type cached: bool
     :param strict: require the ``.catkin`` file exists in the resultspace
     :type strict: bool
+    :param cache_path: directory in which environments are cached across
+        invocations, see :py:func:`get_env_cache_path`
+    :type cache_path: str
 
     :returns: a dictionary of environment variables and their values
     """
@@ -60,21 +307,19 @@ def get_resultspace_environment(result_space_path, base_env=None, quiet=False, c
     if base_env is None:
         base_env = dict(os.environ)
 
-    # Get the MD5 checksums for the current env hooks
-    # TODO: the env hooks path should be defined somewhere
-    env_hooks_path = os.path.join(result_space_path, 'etc', 'catkin', 'profile.d')
-    if os.path.exists(env_hooks_path):
-        env_hooks = [
-            md5(open(os.path.join(env_hooks_path, path)).read().encode('utf-8')).hexdigest()
-            for path in os.listdir(env_hooks_path)]
-    else:
-        env_hooks = []
+    cache_key = (os.path.abspath(result_space_path), get_base_env_digest(base_env))
 
     # Check the cache first, if desired
-    if cached and result_space_path in _resultspace_env_cache:
-        (cached_base_env, cached_env_hooks, result_env) = _resultspace_env_cache.get(result_space_path)
-        if env_hooks == cached_env_hooks and cached_base_env == base_env:
-            return dict(result_env)
+    if cached:
+        cache_entry = _resultspace_env_cache.get(cache_key)
+        if cache_entry is None and cache_path is not None:
+            cache_entry = _load_cached_env(cache_path, cache_key)
+        if cache_entry is not None:
+            env = apply_env_delta(base_env, cache_entry[1])
+            # Re-use it while the resultspace and its underlays are unchanged
+            if cache_entry[0] == get_resultspace_stamps(result_space_path, get_prefix_paths(env)):
+                _resultspace_env_cache[cache_key] = cache_entry
+                return env
 
     # Check to make sure result_space_path is a valid directory
     if not os.path.isdir(result_space_path):
@@ -136,8 +381,6 @@ def get_resultspace_environment(result_space_path, base_env=None, quiet=False, c
         '"typeset -px"'
     ])
 
-    # Define some "blacklisted" environment variables which shouldn't be copied
-    blacklisted_keys = ('_', 'PWD')
     env_dict = {}
 
     try:
@@ -158,13 +401,17 @@ def get_resultspace_environment(result_space_path, base_env=None, quiet=False, c
         env_dict = {
             k: v
             for k, v in parse_env_str(lines).items()
-            if k not in blacklisted_keys
+            if k not in BLACKLISTED_ENV_KEYS
         }
 
         # Check to make sure we got some kind of environment
         if len(env_dict) > 0:
             # Cache the result
-            _resultspace_env_cache[result_space_path] = (base_env, env_hooks, env_dict)
+            stamps = get_resultspace_stamps(result_space_path, get_prefix_paths(env_dict))
+            env_delta = get_env_delta(base_env, env_dict)
+            _resultspace_env_cache[cache_key] = (stamps, env_delta)
+            if cache_path is not None:
+                _store_cached_env(cache_path, cache_key, stamps, env_delta)
         else:
             print("WARNING: Sourced environment from `{}` has no environment variables. Something is wrong.".format(
                 setup_file_path))
@@ -177,7 +424,7 @@ def get_resultspace_environment(result_space_path, base_env=None, quiet=False, c
     return dict(env_dict)
 
 
-def load_resultspace_environment(underlays, base_env=None, cached=True):
+def load_resultspace_environment(underlays, base_env=None, cached=True, cache_path=None):
     """Load the environemt variables which result from sourcing another
     workspace path into this process's environment.
 
@@ -185,10 +432,13 @@ def load_resultspace_environment(underlays, base_env=None, cached=True):
     :type underlays: str
     :param cached: use the cached environment
     :type cached: bool
+    :param cache_path: directory in which environments are cached across invocations
+    :type cache_path: str
     """
     for underlay_path in underlays.split(";"):
         try:
-            env_dict = get_resultspace_environment(underlay_path, base_env=base_env, cached=cached)
+            env_dict = get_resultspace_environment(
+                underlay_path, base_env=base_env, cached=cached, cache_path=cache_path)
             try:
                 os.environ.update(env_dict)
             except TypeError:
@@ -108,6 +108,11 @@ def set_color(state):
         _color_on = False
 
 
+def is_color_on():
+    """Returns the global colorization setting."""
+    return _color_on
+
+
 class ColorTemplate(string.Template):
     delimiter = '@'
 
@@ -22,17 +22,7 @@ import time
 import traceback
 import yaml
 
-import trollius as asyncio
-
-try:
-    # Python3
-    from queue import Queue
-except ImportError:
-    # Python2
-    from Queue import Queue
-
 try:
-    from catkin_pkg.packages import find_packages
     from catkin_pkg.topological_order import topological_order_packages
 except ImportError as e:
     sys.exit(
@@ -42,6 +32,12 @@ except ImportError as e:
 
 from catkin_pkg.package import parse_package
 
+from ckx_tools.build_history import append_history
+from ckx_tools.build_history import get_median_job_durations
+from ckx_tools.build_history import get_stage_durations
+from ckx_tools.build_history import HistoryRecorder
+from ckx_tools.build_history import load_history
+
 from ckx_tools.common import FakeLock
 from ckx_tools.common import format_time_delta
 from ckx_tools.common import get_build_type
@@ -50,13 +46,41 @@ from ckx_tools.common import get_recursive_run_depends_in_workspace
 from ckx_tools.common import log
 from ckx_tools.common import wide_log
 
+import ckx_tools.execution.job_server as job_server
+
+from ckx_tools.execution.conflict_locks import ConflictLockGroup
 from ckx_tools.execution.controllers import ConsoleStatusController
+from ckx_tools.execution.diagnostics import DiagnosticsRecorder
+from ckx_tools.execution.diagnostics import update_diagnostics
+from ckx_tools.execution.event_log import EventLogWriter
+from ckx_tools.execution.events import ExecutionEventQueue
 from ckx_tools.execution.executor import execute_jobs
 from ckx_tools.execution.executor import run_until_complete
+from ckx_tools.execution.io import set_compress_logs
+from ckx_tools.execution.io import set_log_fsync
+from ckx_tools.execution.io import set_max_buffer_size
+from ckx_tools.execution.io import set_max_logfile_history
+from ckx_tools.execution.scheduling import estimate_wall_time
+from ckx_tools.execution.scheduling import get_critical_path_priorities
+from ckx_tools.execution.scheduling import get_job_weights
+from ckx_tools.execution.scheduling import SCHEDULE_CRITICAL_PATH
+from ckx_tools.execution.scheduling import SCHEDULE_FIFO
+from ckx_tools.execution.stages import FunctionStage
+from ckx_tools.execution.trace import TraceRecorder
+
+from ckx_tools.fingerprint import fingerprint_digest
+from ckx_tools.fingerprint import get_fingerprint_path
+from ckx_tools.fingerprint import get_make_targets
+from ckx_tools.fingerprint import get_up_to_date_packages
+from ckx_tools.fingerprint import store_fingerprint
 
 from ckx_tools.jobs.catkin import create_catkin_build_job
 from ckx_tools.jobs.catkin import create_catkin_clean_job
 from ckx_tools.jobs.catkin import get_prebuild_package
+from ckx_tools.jobs.utils import get_install_lock_name
+from ckx_tools.jobs.utils import get_previous_installed_files
+
+from ckx_tools.package_index import find_workspace_packages
 
 from .color import clr
 
@@ -148,7 +172,7 @@ def get_built_unbuilt_packages(context, workspace_packages):
     # Get the names of all packages which have already been built
     built_packages = set([
         pkg.name for (path, pkg) in
-        find_packages(context.package_metadata_path(), warnings=[]).items()])
+        find_workspace_packages(context, context.package_metadata_path(), warnings=[]).items()])
 
     # Get names of all unbuilt packages
     unbuilt_pkgs = set()
@@ -178,6 +202,9 @@ def build_isolated_workspace(
     no_notify=False,
     continue_on_failure=False,
     summarize_build=None,
+    schedule=SCHEDULE_FIFO,
+    trace_path=None,
+    event_log_path=None,
 ):
     """Builds a catkin workspace in isolation
 
@@ -209,7 +236,8 @@ def build_isolated_workspace(
     :type no_status: bool
     :param limit_status_rate: rate to which status updates are limited; the default 0, places no limit.
     :type limit_status_rate: float
-    :param lock_install: causes executors to synchronize on access of install commands
+    :param lock_install: causes executors to synchronize the install commands of packages whose installed files
+        overlap, or which haven't been installed yet
     :type lock_install: bool
     :param no_notify: suppresses system notifications
     :type no_notify: bool
@@ -218,6 +246,13 @@ def build_isolated_workspace(
     :param summarize_build: if True summarizes the build at the end, if None and continue_on_failure is True and the
         the build fails, then the build will be summarized, but if False it never will be summarized.
     :type summarize_build: bool
+    :param schedule: the order in which ready packages are started, either 'fifo' or 'critical-path'
+    :type schedule: str
+    :param trace_path: if given, write a Chrome trace of the execution of the jobs to this file
+    :type trace_path: str
+    :param event_log_path: if given, write the events of the execution of the jobs to this file as JSON lines,
+        or to file descriptor N if it is `fd:N`
+    :type event_log_path: str
 
     :raises: SystemExit if buildspace is a file or no packages were found in the source space
         or if the provided options are invalid
@@ -280,7 +315,7 @@ def build_isolated_workspace(
 
     # Get all the packages in the context source space
     # Suppress warnings since this is a utility function
-    workspace_packages = find_packages(context.source_space_abs, exclude_subspaces=True, warnings=[])
+    workspace_packages = find_workspace_packages(context, exclude_subspaces=True, warnings=[])
 
     # Get packages which have not been built yet
     built_packages, unbuilt_pkgs = get_built_unbuilt_packages(context, workspace_packages)
@@ -368,6 +403,23 @@ def build_isolated_workspace(
             else:
                 break
 
+    # Determine which packages haven't changed since they were last built
+    # NOTE: Explicit make targets are actions which have to be run every time
+    up_to_date_packages = set()
+    package_fingerprints = {}
+    if not get_make_targets(context.make_args + context.catkin_make_args):
+        workspace_deps = dict([
+            (pkg.name, [p.name for _, p in get_cached_recursive_build_depends_in_workspace(pkg, all_packages)])
+            for _, pkg in packages_to_be_built])
+        up_to_date_packages, package_fingerprints = get_up_to_date_packages(
+            context, packages_to_be_built, workspace_deps)
+        # Forcing CMake or pre-cleaning rebuilds everything, but still records the fingerprints
+        if force_cmake or pre_clean:
+            up_to_date_packages = set()
+        for path, pkg in packages_to_be_built:
+            if pkg.name in up_to_date_packages and 'metapackage' not in [e.tagname for e in pkg.exports]:
+                wide_log(clr("@!@{kf}Up to date@| @{gf}---@| @{cf}{}@|").format(pkg.name))
+
     # Get the names of all packages to be built
     packages_to_be_built_names = [p.name for _, p in packages_to_be_built]
     packages_to_be_built_deps_names = [p.name for _, p in packages_to_be_built_deps]
@@ -429,7 +481,7 @@ def build_isolated_workspace(
                 prebuild_pkg_path = get_prebuild_package(context.build_space_abs, context.devel_space_abs, force_cmake)
                 prebuild_pkg = parse_package(prebuild_pkg_path)
 
-        if prebuild_pkg is not None:
+        if prebuild_pkg is not None and prebuild_pkg.name not in up_to_date_packages:
             # Create the prebuild job
             prebuild_job = create_catkin_build_job(
                 context,
@@ -440,6 +492,14 @@ def build_isolated_workspace(
                 pre_clean=pre_clean,
                 prebuild=True)
 
+            # Store the fingerprint of the prebuild package once it has been built
+            if prebuild_job.jid in package_fingerprints:
+                prebuild_job.stages.append(FunctionStage(
+                    'fingerprint',
+                    store_fingerprint,
+                    fingerprint_path=get_fingerprint_path(context, prebuild_job.jid),
+                    fingerprint=package_fingerprints[prebuild_job.jid]))
+
             # Add the prebuld job
             prebuild_jobs[prebuild_job.jid] = prebuild_job
 
@@ -470,11 +530,15 @@ def build_isolated_workspace(
         if 'metapackage' in [e.tagname for e in pkg.exports]:
             continue
 
+        # Ignore packages which haven't changed since they were last built
+        if pkg.name in up_to_date_packages:
+            continue
+
         # Get actual execution deps
         deps = [
             p.name for _, p
             in get_cached_recursive_build_depends_in_workspace(pkg, packages_to_be_built)
-            if p.name not in prebuild_jobs
+            if p.name not in prebuild_jobs and p.name not in up_to_date_packages
         ]
         # All jobs depend on the prebuild jobs if they're defined
         if not no_deps:
@@ -494,7 +558,17 @@ def build_isolated_workspace(
         build_type = get_build_type(pkg)
 
         if build_type in build_job_creators:
-            jobs.append(build_job_creators[build_type](**build_job_kwargs))
+            job = build_job_creators[build_type](**build_job_kwargs)
+
+            # Store the fingerprint of the package once it has been built
+            if pkg.name in package_fingerprints:
+                job.stages.append(FunctionStage(
+                    'fingerprint',
+                    store_fingerprint,
+                    fingerprint_path=get_fingerprint_path(context, pkg.name),
+                    fingerprint=package_fingerprints[pkg.name]))
+
+            jobs.append(job)
         else:
             wide_log(clr(
                 "[build] @!@{yf}Warning:@| Skipping package `{}` because it "
@@ -505,8 +579,52 @@ def build_isolated_workspace(
             for bt_name in build_job_creators.keys():
                 wide_log(clr("[build]  - `{}`".format(bt_name)))
 
+    # Get the durations of the packages from previous builds
+    build_history = load_history(context.log_space_abs, 'build')
+    job_durations = get_median_job_durations(build_history)
+
+    # Rank the jobs by the length of the longest chain of jobs which depend on them
+    priorities = None
+    summary_notes = []
+    if schedule == SCHEDULE_CRITICAL_PATH and len(jobs) > 0:
+        weights, weights_are_durations = get_job_weights(jobs, job_durations)
+        priorities = get_critical_path_priorities(jobs, weights)
+
+        if weights_are_durations:
+            max_jobs = n_jobs or job_server.max_jobs()
+            time_saved = (
+                estimate_wall_time(jobs, weights, max_jobs) -
+                estimate_wall_time(jobs, weights, max_jobs, priorities))
+            summary_notes.append('Schedule: critical-path, estimated {} saved compared to FIFO.'.format(
+                format_time_delta(max(0.0, time_saved))))
+        else:
+            summary_notes.append(
+                'Schedule: critical-path, ranked by number of dependent packages (no build history yet).')
+
+    # Record the timing of every job and stage in the build history
+    history_recorder = HistoryRecorder(
+        'build',
+        fingerprints=dict([(jid, fingerprint_digest(fp)) for jid, fp in package_fingerprints.items()]),
+        up_to_date_jobs=sorted(up_to_date_packages),
+        max_jobs=n_jobs or job_server.max_jobs(),
+        start_time=pre_start_time)
+
+    # Collect the warnings and errors of every stage in the diagnostics index
+    diagnostics_recorder = DiagnosticsRecorder('build')
+
+    event_listeners = [history_recorder, diagnostics_recorder]
+
+    # Estimate the remaining time of the build from the stage durations of previous builds
+    stage_durations = get_stage_durations(build_history) if not no_status else None
+    if trace_path is not None:
+        trace_recorder = TraceRecorder('build', jobs, start_time=pre_start_time)
+        event_listeners.append(trace_recorder)
+    if event_log_path is not None:
+        event_log_writer = EventLogWriter('build', event_log_path)
+        event_listeners.append(event_log_writer)
+
     # Queue for communicating status
-    event_queue = Queue()
+    event_queue = ExecutionEventQueue()
 
     try:
         # Spin up status output thread
@@ -519,6 +637,10 @@ def build_isolated_workspace(
             [p for p in context.whitelist],
             [p for p in context.blacklist],
             event_queue,
+            up_to_date_jobs=sorted(up_to_date_packages),
+            summary_notes=summary_notes,
+            event_listeners=event_listeners,
+            stage_durations=stage_durations,
             show_notifications=not no_notify,
             show_active_status=not no_status,
             show_buffered_stdout=not quiet and not interleave_output,
@@ -531,10 +653,24 @@ def build_isolated_workspace(
             active_status_rate=limit_status_rate)
         status_thread.start()
 
-        # Initialize locks
+        # Initialize locks, the install stages of packages only exclude each
+        # other if the files which they installed in their previous builds overlap
+        install_locks = ConflictLockGroup()
         locks = {
-            'installspace': asyncio.Lock() if lock_install else FakeLock()
+            'installspace': install_locks.lock(None) if lock_install else FakeLock()
         }
+        if lock_install:
+            packages_by_name = dict([(pkg.name, pkg) for _, pkg in all_packages])
+            for job in jobs:
+                installed_files = None
+                if job.jid in packages_by_name:
+                    installed_files = get_previous_installed_files(context, packages_by_name[job.jid])
+                locks[get_install_lock_name(job.jid)] = install_locks.lock(installed_files)
+
+        set_max_logfile_history(context.log_history)
+        set_compress_logs(context.compress_logs)
+        set_log_fsync(context.log_fsync)
+        set_max_buffer_size(context.log_buffer_size)
 
         # Block while running N jobs asynchronously
         try:
@@ -546,7 +682,8 @@ def build_isolated_workspace(
                 context.log_space_abs,
                 max_toplevel_jobs=n_jobs,
                 continue_on_failure=continue_on_failure,
-                continue_without_deps=False))
+                continue_without_deps=False,
+                priorities=priorities))
         except Exception:
             status_thread.keep_running = False
             all_succeeded = False
@@ -555,6 +692,12 @@ def build_isolated_workspace(
 
         status_thread.join(1.0)
 
+        append_history(context.log_space_abs, history_recorder.get_record())
+        update_diagnostics(context.log_space_abs, diagnostics_recorder)
+        if trace_path is not None:
+            trace_recorder.write(trace_path)
+            log(clr("[build] Wrote trace to: @{yf}{}@|").format(trace_path))
+
         # Warn user about new packages
         now_built_packages, now_unbuilt_pkgs = get_built_unbuilt_packages(context, workspace_packages)
         new_pkgs = [p for p in unbuilt_pkgs if p not in now_unbuilt_pkgs]
@@ -577,6 +720,10 @@ def build_isolated_workspace(
         wide_log("[build] Interrupted by user!")
         event_queue.put(None)
 
+    finally:
+        if event_log_path is not None:
+            event_log_writer.close()
+
 
 def _create_unmerged_devel_setup(context, unbuilt):
     # Find all of the leaf packages in the workspace
@@ -20,7 +20,6 @@ import os
 import sys
 
 try:
-    from catkin_pkg.packages import find_packages
     from catkin_pkg.topological_order import topological_order_packages
 except ImportError as e:
     sys.exit(
@@ -36,6 +35,10 @@ from catkin_pkg.tool_detection import mark_space_as_built_by
 from ckx_tools.argument_parsing import add_context_args
 from ckx_tools.argument_parsing import add_cmake_and_make_and_catkin_make_args
 from ckx_tools.argument_parsing import configure_make_args
+from ckx_tools.argument_parsing import event_log_type
+
+from ckx_tools.build_history import format_history_report
+from ckx_tools.build_history import load_history
 
 from ckx_tools.common import get_build_type
 from ckx_tools.common import getcwd
@@ -49,12 +52,17 @@ from ckx_tools.context import Context
 import ckx_tools.metadata as metadata
 import ckx_tools.execution.job_server as job_server
 
+from ckx_tools.execution.scheduling import SCHEDULE_FIFO
+from ckx_tools.execution.scheduling import SCHEDULES
+
 from ckx_tools.jobs.utils import get_env_loader
 
 from ckx_tools.metadata import find_enclosing_workspace
 from ckx_tools.metadata import get_metadata
 from ckx_tools.metadata import update_metadata
 
+from ckx_tools.package_index import find_workspace_packages
+
 from ckx_tools.resultspace import load_resultspace_environment
 
 from ckx_tools.terminal_color import set_color
@@ -155,7 +163,23 @@ the --save-config argument. To see the current config, use the
     add = build_group.add_argument
     add('--strip', action='store_true', help='Strips binaries, only valid with --install')
     add('--no-install-lock', action='store_true', default=None,
-        help='Prevents serialization of the install steps, which is on by default to prevent file install collisions')
+        help='Prevents serialization of the install steps. By default, the install steps of packages whose '
+             'previously installed files overlap, or which haven\'t been installed yet, run one at a time to '
+             'prevent file install collisions.')
+    add('--schedule', choices=SCHEDULES, default=SCHEDULE_FIFO,
+        help='The order in which packages whose dependencies have been built are started. `critical-path` starts '
+             'the packages with the longest chains of packages depending on them first, weighted by how long each '
+             'package took to build previously. Default is `fifo`.')
+    add('--max-load', metavar='HIGH[:LOW]', default=None,
+        help='Stop starting new jobs while the 5-minute load average is above HIGH, until it drops below LOW. '
+             'LOW defaults to 90%% of HIGH. Default is the `-l` value given to make, or the number of cores plus one.')
+    add('--mem-limit', metavar='HIGH[:LOW]', default=None,
+        help='Stop starting new jobs while the used physical memory is above HIGH, until it drops below LOW. '
+             'Amounts are given as a percentage like `80%%`, or in bytes with an optional k, m or g suffix. '
+             'LOW defaults to 5%% of the total memory below HIGH. Requires psutil.')
+    add('--resource-sample-period', metavar='SECONDS', type=float, default=None,
+        help='The period with which the load average and memory usage are sampled for --max-load and '
+             '--mem-limit. Default is 1 second.')
 
     config_group = parser.add_argument_group('Advanced Configuration', 'Parameters for the underlying build system.')
     add = config_group.add_argument
@@ -184,9 +208,16 @@ the --save-config argument. To see the current config, use the
         help='List the packages which will be built with the given arguments without building them.')
     add('--get-env', dest='get_env', metavar='PKGNAME', nargs=1,
         help='Print the environment in which PKGNAME is built to stdout.')
+    add('--trace', metavar='FILE', default=None,
+        help='Write the timing of every job and stage to FILE as Chrome trace-event JSON, which can be opened '
+             'in chrome://tracing or the Perfetto UI.')
+    add('--event-log', metavar='FILE', type=event_log_type, default=None,
+        help='Write the lifecycle, progress and results of every job and stage to FILE as JSON lines while '
+             'building. Use `fd:N` to write to the open file descriptor N instead.')
+    add('--history', metavar='PKGNAME', nargs='?', const=True, default=None,
+        help='Print the durations of recent builds, the slowest packages and the packages which got slower in '
+             'the last build. If PKGNAME is given, print the durations of its stages in recent builds instead.')
 
-    # Experimental args
-    add('--mem-limit', default=None, help=argparse.SUPPRESS)
     # Advanced args
     add('--develdebug', metavar='LEVEL', default=None, help=argparse.SUPPRESS)
 
@@ -263,13 +294,19 @@ def main(opts):
     # Load the context
     ctx = Context.load(opts.workspace, opts.profile, opts, append=True)
 
+    # Print the build history and leave the filesystem untouched
+    if opts.history:
+        history = load_history(ctx.log_space_abs, 'build')
+        for line in format_history_report(history, None if opts.history is True else opts.history):
+            log(line)
+        return 0
+
     # Initialize the build configuration
     make_args, makeflags, cli_flags, jobserver = configure_make_args(
         ctx.make_args, ctx.jobs_args, ctx.use_internal_make_jobserver)
 
-    # Set the jobserver memory limit
-    if jobserver and opts.mem_limit:
-        log(clr("@!@{pf}EXPERIMENTAL: limit memory to '%s'@|" % str(opts.mem_limit)))
+    # Set the load and memory limits for starting new jobs
+    if opts.mem_limit:
         # At this point psuitl will be required, check for it and bail out if not set
         try:
             import psutil  # noqa
@@ -277,13 +314,21 @@ def main(opts):
             log("Could not import psutil, but psutil is required when using --mem-limit.")
             log("Please either install psutil or avoid using --mem-limit.")
             sys.exit("Exception: {0}".format(exc))
-        job_server.set_max_mem(opts.mem_limit)
+    try:
+        if opts.resource_sample_period is not None:
+            job_server.set_sample_period(opts.resource_sample_period)
+        if opts.max_load:
+            job_server.set_max_load(opts.max_load)
+        if opts.mem_limit:
+            job_server.set_max_mem(opts.mem_limit)
+    except ValueError as exc:
+        sys.exit(clr("[build] @!@{rf}Error:@| {0}").format(exc))
 
     ctx.make_args = make_args
 
     # Load the environment of the workspace to extend
     if ctx.underlays is not None:
-        load_resultspace_environment(ctx.underlays)
+        load_resultspace_environment(ctx.underlays, cache_path=ctx.env_cache_path())
 
     # Check if the context is valid before writing any metadata
     if not ctx.source_space_exists():
@@ -390,7 +435,10 @@ def main(opts):
         lock_install=not opts.no_install_lock,
         no_notify=opts.no_notify,
         continue_on_failure=opts.continue_on_failure,
-        summarize_build=opts.summarize  # Can be True, False, or None
+        summarize_build=opts.summarize,  # Can be True, False, or None
+        schedule=opts.schedule,
+        trace_path=opts.trace,
+        event_log_path=opts.event_log
     )
 
 ##############################################################################
@@ -403,7 +451,7 @@ def dry_run(context, packages, no_deps, start_with):
     log(context.summary())
     # Get all the packages in the context source space
     # Suppress warnings since this is a utility function
-    workspace_packages = find_packages(context.source_space_abs, exclude_subspaces=True, warnings=[])
+    workspace_packages = find_workspace_packages(context, exclude_subspaces=True, warnings=[])
     # Find list of packages in the workspace
     packages_to_be_built, packages_to_be_built_deps, all_packages = determine_packages_to_be_built(
         packages, context, workspace_packages)
@@ -430,7 +478,7 @@ def dry_run(context, packages, no_deps, start_with):
 
 
 def print_build_env(context, package_name):
-    workspace_packages = find_packages(context.source_space_abs, exclude_subspaces=True, warnings=[])
+    workspace_packages = find_workspace_packages(context, exclude_subspaces=True, warnings=[])
     # Load the environment used by this package for building
     for pth, pkg in workspace_packages.items():
         if pkg.name == package_name:
@@ -14,20 +14,13 @@
 
 """This modules implements the engine for cleaning packages in parallel"""
 
+import os
 import pkg_resources
 import sys
 import time
 import traceback
 
 try:
-    # Python3
-    from queue import Queue
-except ImportError:
-    # Python2
-    from Queue import Queue
-
-try:
-    from catkin_pkg.packages import find_packages
     from catkin_pkg.topological_order import topological_order_packages
 except ImportError as e:
     sys.exit(
@@ -36,14 +29,30 @@ except ImportError as e:
         '"catkin_pkg", and that it is up to date and on the PYTHONPATH.' % e
     )
 
+import ckx_tools.execution.job_server as job_server
+
 from ckx_tools.execution.controllers import ConsoleStatusController
+from ckx_tools.execution.events import ExecutionEventQueue
 from ckx_tools.execution.executor import execute_jobs
 from ckx_tools.execution.executor import run_until_complete
+from ckx_tools.execution.io import set_compress_logs
+from ckx_tools.execution.io import set_log_fsync
+from ckx_tools.execution.io import set_max_buffer_size
+from ckx_tools.execution.io import set_max_logfile_history
+from ckx_tools.execution.stages import FunctionStage
+from ckx_tools.execution.trace import TraceRecorder
 
 from ckx_tools.common import get_build_type
 from ckx_tools.common import get_recursive_build_dependents_in_workspace
+from ckx_tools.common import log
 from ckx_tools.common import wide_log
 
+from ckx_tools.fingerprint import get_fingerprint_path
+
+from ckx_tools.jobs.utils import rmfiles
+
+from ckx_tools.package_index import find_workspace_packages
+
 
 def determine_packages_to_be_cleaned(context, include_dependents, packages):
     """Returns list of packages which should be cleaned, and those packages' deps.
@@ -57,7 +66,8 @@ def determine_packages_to_be_cleaned(context, include_dependents, packages):
     """
 
     # Get all the cached packages in the context source space
-    workspace_packages = find_packages(context.package_metadata_path(), exclude_subspaces=True, warnings=[])
+    workspace_packages = find_workspace_packages(
+        context, context.package_metadata_path(), exclude_subspaces=True, warnings=[])
     # Order the packages by topology
     ordered_packages = topological_order_packages(workspace_packages)
 
@@ -98,7 +108,17 @@ def clean_packages(
         names_of_packages_to_be_cleaned,
         clean_dependents,
         verbose,
-        dry_run):
+        dry_run,
+        trace_path=None,
+        event_log_writer=None,
+        trash_path=None):
+    """Clean the products of packages, up to the number of jobs of the job server in parallel.
+
+    :param event_log_writer: An open :py:class:`EventLogWriter` which the events of the jobs are written to,
+        it is shared by the cleaning of all profiles and closed by the caller
+    :param trash_path: If given, the directories of the packages are moved into this trash directory
+        instead of being deleted
+    """
 
     pre_start_time = time.time()
 
@@ -132,35 +152,57 @@ def clean_packages(
             context=context,
             package=pkg,
             package_path=path,
-            dependencies=[],  # Unused because clean jobs are not parallelized
+            dependencies=[],  # Clean jobs don't depend on each other
             dry_run=dry_run,
             clean_build=True,
             clean_devel=True,
             clean_install=True)
+        # Only passed when set, so that the build types of other packages keep working
+        if trash_path is not None:
+            clean_job_kwargs['trash_path'] = trash_path
 
         # Create the job based on the build type
         build_type = get_build_type(pkg)
 
         if build_type in clean_job_creators:
-            jobs.append(clean_job_creators[build_type](**clean_job_kwargs))
+            job = clean_job_creators[build_type](**clean_job_kwargs)
+
+            # Forget the fingerprint of the last build so the package is rebuilt
+            fingerprint_path = get_fingerprint_path(context, pkg.name)
+            if os.path.exists(fingerprint_path):
+                job.stages.insert(0, FunctionStage(
+                    'rmfingerprint',
+                    rmfiles,
+                    paths=[fingerprint_path],
+                    dry_run=dry_run))
+
+            jobs.append(job)
 
     if len(jobs) == 0:
         print("[clean] There are no products from the given packages to clean.")
         return False
 
     # Queue for communicating status
-    event_queue = Queue()
+    event_queue = ExecutionEventQueue()
+
+    event_listeners = []
+    if trace_path is not None:
+        trace_recorder = TraceRecorder('clean', jobs, start_time=pre_start_time)
+        event_listeners.append(trace_recorder)
+    if event_log_writer is not None:
+        event_listeners.append(event_log_writer)
 
     # Spin up status output thread
     status_thread = ConsoleStatusController(
         'clean',
         ['package', 'packages'],
         jobs,
-        1,
+        job_server.max_jobs(),
         [pkg.name for _, pkg in context.packages],
         [p for p in context.whitelist],
         [p for p in context.blacklist],
         event_queue,
+        event_listeners=event_listeners,
         show_notifications=False,
         show_active_status=False,
         show_buffered_stdout=verbose or False,
@@ -177,6 +219,11 @@ def clean_packages(
     locks = {
     }
 
+    set_max_logfile_history(context.log_history)
+    set_compress_logs(context.compress_logs)
+    set_log_fsync(context.log_fsync)
+    set_max_buffer_size(context.log_buffer_size)
+
     # Block while running N jobs asynchronously
     try:
         ej = execute_jobs(
@@ -185,7 +232,7 @@ def clean_packages(
             locks,
             event_queue,
             context.log_space_abs,
-            max_toplevel_jobs=1,
+            max_toplevel_jobs=job_server.max_jobs(),
             continue_on_failure=True,
             continue_without_deps=False)
         all_succeeded = run_until_complete(ej)
@@ -197,4 +244,8 @@ def clean_packages(
 
     status_thread.join(1.0)
 
+    if trace_path is not None:
+        trace_recorder.write(trace_path)
+        log("[clean] Wrote trace to: {}".format(trace_path))
+
     return all_succeeded
@@ -23,22 +23,33 @@ import os
 import shutil
 import sys
 
-from catkin_pkg.packages import find_packages
-
 from ckx_tools.argument_parsing import add_context_args
+from ckx_tools.argument_parsing import event_log_type
 
 from ckx_tools.context import Context
 
+from ckx_tools.fingerprint import FINGERPRINTS_DIR_NAME
+
+from ckx_tools.resultspace import get_env_cache_path
+
 from ckx_tools.common import log
 from ckx_tools.common import wide_log
 
 import ckx_tools.execution.job_server as job_server
 
+from ckx_tools.execution.event_log import EventLogWriter
+
+from ckx_tools.jobs.utils import empty_trash_in_background
+from ckx_tools.jobs.utils import get_trash_path
+from ckx_tools.jobs.utils import move_to_trash
+
 from ckx_tools.metadata import get_paths as get_metadata_paths
 from ckx_tools.metadata import get_profile_names
 from ckx_tools.metadata import update_metadata
 from ckx_tools.metadata import METADATA_DIR_NAME
 
+from ckx_tools.package_index import find_workspace_packages
+
 from ckx_tools.terminal_color import ColorMapper
 
 from .clean import clean_packages
@@ -63,8 +74,12 @@ def yes_no_loop(question):
         log(clr("[clean] Please answer either \"yes\" or \"no\"."))
 
 
-def safe_rmtree(path, workspace_root, force):
-    """Safely remove a path outside of the workspace root."""
+def safe_rmtree(path, workspace_root, force, trash_path=None):
+    """Safely remove a path outside of the workspace root.
+
+    If `trash_path` is given, the path is moved into that trash directory
+    instead, unless it is on a different filesystem.
+    """
 
     # Check if the path is inside the workspace
     path_in_workspace = path.find(workspace_root) == 0
@@ -76,7 +91,8 @@ def safe_rmtree(path, workspace_root, force):
         yes = yes_no_loop("Are you sure you want to entirely remove `{}`?".format(path))
 
     if yes:
-        shutil.rmtree(path)
+        if trash_path is None or not move_to_trash(path, trash_path):
+            shutil.rmtree(path)
     else:
         log("[clean] Not removing `{}`".format(path))
 
@@ -96,6 +112,17 @@ def prepare_arguments(parser):
         help='Allow cleaning files outside of the workspace root.')
     add('--all-profiles', action='store_true', default=False,
         help='Apply the specified clean operation for all profiles in this workspace.')
+    add('-p', '--parallel-packages', metavar='PACKAGE_JOBS', dest='parallel_jobs', type=int, default=None,
+        help='Maximum number of packages cleaned in parallel (default is cpu count)')
+    add('--background', action='store_true', default=False,
+        help='Move the removed directories into a trash directory in the workspace, and delete them in a '
+             'detached background process, so that cleaning returns right away.')
+    add('--trace', metavar='FILE', default=None,
+        help='Write the timing of every job and stage of cleaning individual packages to FILE as Chrome '
+             'trace-event JSON, which can be opened in chrome://tracing or the Perfetto UI.')
+    add('--event-log', metavar='FILE', type=event_log_type, default=None,
+        help='Write the lifecycle and results of every job and stage of cleaning individual packages to FILE as '
+             'JSON lines. Use `fd:N` to write to the open file descriptor N instead.')
 
     full_group = parser.add_argument_group(
         'Full',
@@ -148,7 +175,7 @@ def prepare_arguments(parser):
     return parser
 
 
-def clean_profile(opts, profile):
+def clean_profile(opts, profile, event_log_writer=None):
     # Load the context
     ctx = Context.load(opts.workspace, profile, opts, strict=True, load_env=False)
 
@@ -232,19 +259,22 @@ def clean_profile(opts, profile):
     # Initialize flag to be used on the next invocation
     needs_force = False
 
+    # Directories are moved into the trash and deleted in the background
+    trash_path = get_trash_path(ctx.workspace) if opts.background and not opts.dry_run else None
+
     try:
         # Remove all installspace files
         if opts.install and install_exists:
             log("[clean] Removing installspace: %s" % install_path)
             if not opts.dry_run:
-                safe_rmtree(install_path, ctx.workspace, opts.force)
+                safe_rmtree(install_path, ctx.workspace, opts.force, trash_path)
 
         # Remove all develspace files
         if opts.devel:
             if devel_exists:
                 log("[clean] Removing develspace: %s" % ctx.devel_space_abs)
                 if not opts.dry_run:
-                    safe_rmtree(ctx.devel_space_abs, ctx.workspace, opts.force)
+                    safe_rmtree(ctx.devel_space_abs, ctx.workspace, opts.force, trash_path)
             # Clear the cached metadata from the last build run
             _, build_metadata_file = get_metadata_paths(ctx.workspace, profile, 'build')
             if os.path.exists(build_metadata_file):
@@ -258,7 +288,17 @@ def clean_profile(opts, profile):
         if opts.build and build_exists:
             log("[clean] Removing buildspace: %s" % ctx.build_space_abs)
             if not opts.dry_run:
-                safe_rmtree(ctx.build_space_abs, ctx.workspace, opts.force)
+                safe_rmtree(ctx.build_space_abs, ctx.workspace, opts.force, trash_path)
+
+        # Forget the fingerprints of the builds whose products were removed
+        if any([opts.install, opts.devel, opts.build]) and not opts.dry_run:
+            fingerprints_path = os.path.join(ctx.metadata_path(), FINGERPRINTS_DIR_NAME)
+            if os.path.exists(fingerprints_path):
+                safe_rmtree(fingerprints_path, ctx.workspace, opts.force)
+            # The cached environments of the removed resultspaces can't be re-used either
+            env_cache_path = get_env_cache_path(ctx.metadata_path())
+            if os.path.exists(env_cache_path):
+                safe_rmtree(env_cache_path, ctx.workspace, opts.force)
 
         # Setup file removal
         if opts.setup_files:
@@ -273,7 +313,7 @@ def clean_profile(opts, profile):
         if opts.logs and logs_exists:
             log("[clean] Removing log space: {}".format(ctx.log_space_abs))
             if not opts.dry_run:
-                safe_rmtree(ctx.log_space_abs, ctx.workspace, opts.force)
+                safe_rmtree(ctx.log_space_abs, ctx.workspace, opts.force, trash_path)
 
         # Find orphaned packages
         if ctx.link_devel and not any([opts.build, opts.devel]):
@@ -285,10 +325,10 @@ def clean_profile(opts, profile):
                     # Suppress warnings since this is looking for packages which no longer exist
                     found_source_packages = [
                         pkg.name for (path, pkg) in
-                        find_packages(ctx.source_space_abs, warnings=[]).items()]
+                        find_workspace_packages(ctx, warnings=[]).items()]
                     built_packages = [
                         pkg.name for (path, pkg) in
-                        find_packages(ctx.package_metadata_path(), warnings=[]).items()]
+                        find_workspace_packages(ctx, ctx.package_metadata_path(), warnings=[]).items()]
 
                     # Look for orphaned products in the build space
                     orphans = [p for p in built_packages
@@ -312,7 +352,10 @@ def clean_profile(opts, profile):
                         opts.packages,
                         opts.dependents,
                         opts.verbose,
-                        opts.dry_run)
+                        opts.dry_run,
+                        trace_path=opts.trace,
+                        event_log_writer=event_log_writer,
+                        trash_path=trash_path)
                 except KeyboardInterrupt:
                     wide_log("[build] User interrupted!")
                     return False
@@ -334,6 +377,9 @@ def clean_profile(opts, profile):
                 "necessitate re-configuring CMake on the next build.@|"))
             update_metadata(ctx.workspace, ctx.profile, 'build', {'needs_force': True})
 
+    if trash_path is not None and empty_trash_in_background(trash_path) is not None:
+        log("[clean] Deleting the removed directories in the background: {}".format(trash_path))
+
     return True
 
 
@@ -364,15 +410,24 @@ def main(opts):
 
     # Initialize job server
     job_server.initialize(
-        max_jobs=1,
+        max_jobs=opts.parallel_jobs,
         max_load=None,
         gnu_make_enabled=False)
 
+    # The event log is opened once, so that the events of all profiles are written to it
+    event_log_writer = None
+    if opts.event_log is not None and len(opts.packages) > 0:
+        event_log_writer = EventLogWriter('clean', opts.event_log)
+
     # Clean the requested profiles
     retcode = 0
-    for profile in profiles:
-        if not clean_profile(opts, profile):
-            retcode = 1
+    try:
+        for profile in profiles:
+            if not clean_profile(opts, profile, event_log_writer):
+                retcode = 1
+    finally:
+        if event_log_writer is not None:
+            event_log_writer.close()
 
     # Warn before nuking .ckx_tools
     if retcode == 0:
@@ -395,6 +450,9 @@ def main(opts):
             metadata_dir = os.path.join(ctx.workspace, METADATA_DIR_NAME)
             log("[clean] Deinitializing workspace by removing ckx_tools config: %s" % metadata_dir)
             if not opts.dry_run:
-                safe_rmtree(metadata_dir, ctx.workspace, opts.force)
+                trash_path = get_trash_path(ctx.workspace) if opts.background else None
+                safe_rmtree(metadata_dir, ctx.workspace, opts.force, trash_path)
+                if trash_path is not None:
+                    empty_trash_in_background(trash_path)
 
     return retcode
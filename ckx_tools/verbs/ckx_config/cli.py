@@ -78,6 +78,22 @@ def prepare_arguments(parser):
         help="The path to the source space ['{0}']".format(Context.DEFAULT_SOURCE_SPACE))
     add('-l', '--log-space', default=None,
         help="The path to the log space ['{0}']".format(Context.DEFAULT_LOG_SPACE))
+    add('--log-history', metavar='N', type=int, default=None,
+        help="The number of previous logfiles kept for each verb and stage of a package [{0}]".format(
+            Context.DEFAULT_LOG_HISTORY))
+    add = spaces_group.add_mutually_exclusive_group().add_argument
+    add('--compress-logs', dest='compress_logs', action='store_true', default=None,
+        help="Write compressed logfiles, which can be read with `catkin log` or `zcat`.")
+    add('--no-compress-logs', dest='compress_logs', action='store_false', default=None,
+        help="Write plain logfiles. This is the default.")
+    add = spaces_group.add_argument
+    add('--log-fsync', choices=Context.LOG_FSYNC_POLICIES, default=None,
+        help="When logfiles are synced to the disk: 'never' leaves it to the operating system, 'close' syncs "
+             "each logfile once its stage has finished, and 'always' syncs each block of output as it is "
+             "written ['{0}']".format(Context.DEFAULT_LOG_FSYNC))
+    add('--log-buffer-size', metavar='MIB', type=int, default=None,
+        help="The number of MiB of stdout or stderr of each stage which are kept in memory, larger output is "
+             "spilled to the disk and only its tail is shown [{0}]".format(Context.DEFAULT_LOG_BUFFER_SIZE))
     add('-b', '--build-space', default=None,
         help="The path to the build space ['{0}']".format(Context.DEFAULT_BUILD_SPACE))
     add('-d', '--devel-space', default=None,
@@ -0,0 +1,117 @@
+# Copyright 2016 Open Source Robotics Foundation, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import os
+import sys
+
+from ckx_tools.argument_parsing import add_context_args
+from ckx_tools.context import Context
+from ckx_tools.execution.diagnostics import load_diagnostics
+from ckx_tools.execution.diagnostics import query_diagnostics
+from ckx_tools.execution.diagnostics import SEVERITIES
+from ckx_tools.execution.diagnostics import SEVERITY_ERROR
+from ckx_tools.metadata import find_enclosing_workspace
+from ckx_tools.terminal_color import ColorMapper
+
+color_mapper = ColorMapper()
+clr = color_mapper.clr
+
+
+def prepare_arguments(parser):
+    add_context_args(parser)
+
+    add = parser.add_argument
+    add('packages', metavar='PKGNAME', nargs='*',
+        help='The names of the packages whose diagnostics are shown. By default, the diagnostics of all '
+             'packages are shown.')
+
+    filter_group = parser.add_argument_group('Filters')
+    add = filter_group.add_argument
+    add('--stage', metavar='STAGE', default=None,
+        help='Only show diagnostics of stages with this label, e.g. `make` or `cmake`.')
+    add('--severity', choices=SEVERITIES, default=None,
+        help='Only show diagnostics with this severity.')
+    add('--flag', metavar='FLAG', default=None,
+        help='Only show diagnostics with this flag, e.g. `-Wunused-variable`, `unused-variable` or `cmake-dev`.')
+    add('--path', metavar='TEXT', default=None,
+        help='Only show diagnostics in files whose path contains TEXT.')
+
+    behavior_group = parser.add_argument_group('Behavior')
+    add = behavior_group.add_argument
+    add('--summary', '-s', action='store_true', default=False,
+        help='Only show the number of warnings and errors of each package and the most frequent flags.')
+
+    return parser
+
+
+def format_diagnostic(jid, diagnostic):
+    """Format a diagnostic like a compiler, followed by its package, stage and number of occurrences."""
+    stage_label, severity, flag, path, line, column, message, count = diagnostic
+    return clr('@!{}:@| {} {}{} @{kf}[{}:{}{}]@|').format(
+        ':'.join([str(v) for v in [path, line, column] if v]) or '?',
+        clr('@!@{rf}error:@|' if severity == SEVERITY_ERROR else '@!@{yf}warning:@|'),
+        message,
+        ' [{}]'.format(flag) if flag else '',
+        jid,
+        stage_label,
+        ' x{}'.format(count) if count > 1 else '')
+
+
+def print_summary(selected):
+    counts = {}
+    flags = {}
+    for jid, d in selected:
+        job_counts = counts.setdefault(jid, dict([(s, 0) for s in SEVERITIES]))
+        job_counts[d[1]] += d[7]
+        if d[2]:
+            flags[d[2]] = flags.get(d[2], 0) + d[7]
+
+    print(clr('@!Diagnostics of the last build of each package:@|'))
+    for jid in sorted(counts):
+        print(clr('  @{cf}{:<32}@| {:>6} warnings {:>6} errors').format(
+            jid, counts[jid]['warning'], counts[jid]['error']))
+    if len(flags) > 0:
+        print(clr('@!Most frequent flags:@|'))
+        for flag, count in sorted(flags.items(), key=lambda fc: (-fc[1], fc[0]))[:10]:
+            print('  {:<32} {:>6}'.format(flag, count))
+
+
+def main(opts):
+    # Get the workspace (either the given directory or the enclosing ws)
+    workspace_hint = opts.workspace or os.getcwd()
+    workspace = find_enclosing_workspace(workspace_hint)
+
+    if not workspace:
+        print(clr("@{rf}ERROR: No workspace found containing '%s'@|" % workspace_hint), file=sys.stderr)
+        return 1
+
+    ctx = Context.load(workspace, opts.profile, opts, load_env=False)
+
+    selected = query_diagnostics(
+        load_diagnostics(ctx.log_space_abs, 'build'),
+        job_ids=opts.packages,
+        stage_label=opts.stage,
+        severity=opts.severity,
+        flag=opts.flag,
+        path=opts.path)
+
+    if opts.summary:
+        print_summary(selected)
+    else:
+        for jid, diagnostic in selected:
+            print(format_diagnostic(jid, diagnostic))
+
+    return 0
@@ -27,7 +27,8 @@ from ckx_tools.common import get_recursive_run_dependents_in_workspace
 from ckx_tools.common import get_recursive_run_depends_in_workspace
 from ckx_tools.common import getcwd
 
-from catkin_pkg.packages import find_packages
+from ckx_tools.package_index import find_workspace_packages
+
 from catkin_pkg.package import InvalidPackage
 from catkin_pkg.topological_order import topological_order_packages
 
@@ -86,7 +87,7 @@ def main(opts):
     warnings = []
     for folder in folders:
         try:
-            packages = find_packages(folder, warnings=warnings)
+            packages = find_workspace_packages(ctx, folder, warnings=warnings)
             ordered_packages = topological_order_packages(packages)
             packages_by_name = {pkg.name: (pth, pkg) for pth, pkg in ordered_packages}
 
@@ -17,11 +17,10 @@ from __future__ import print_function
 import os
 import sys
 
-from catkin_pkg.packages import find_packages
-
 from ckx_tools.argument_parsing import add_context_args
 from ckx_tools.context import Context
 from ckx_tools.metadata import find_enclosing_workspace
+from ckx_tools.package_index import find_workspace_packages
 from ckx_tools.terminal_color import ColorMapper
 
 color_mapper = ColorMapper()
@@ -133,7 +132,7 @@ def main(opts):
             path = os.path.join(path, 'share', opts.package)
         else:
             try:
-                packages = find_packages(path, warnings=[])
+                packages = find_workspace_packages(ctx, path, warnings=[])
                 catkin_package = [pkg_path for pkg_path, p in packages.items() if p.name == opts.package]
                 if catkin_package:
                     path = os.path.join(path, catkin_package[0])
@@ -0,0 +1,142 @@
+# Copyright 2016 Open Source Robotics Foundation, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import os
+import re
+import sys
+
+from ckx_tools.argument_parsing import add_context_args
+from ckx_tools.context import Context
+from ckx_tools.execution.compressed_log import COMPRESSED_LOG_SUFFIX
+from ckx_tools.execution.compressed_log import iter_log
+from ckx_tools.execution.compressed_log import tail_log
+from ckx_tools.execution.io import LOGFILE_SUFFIX
+from ckx_tools.execution.io import STDERR_LOGFILE_SUFFIX
+from ckx_tools.execution.io import load_log_index
+from ckx_tools.metadata import find_enclosing_workspace
+from ckx_tools.terminal_color import ColorMapper
+
+color_mapper = ColorMapper()
+clr = color_mapper.clr
+
+# Matches the names of the latest and of previous logfiles
+LOGFILE_RE = re.compile(r'^(?P<verb>[^.]+)\.(?P<stage>.+)\.log(\.gz)?$')
+
+# Matches the index with which previous logfiles are named
+LOGFILE_INDEX_RE = re.compile(r'\.[0-9]+$')
+
+
+def prepare_arguments(parser):
+    add_context_args(parser)
+
+    add = parser.add_argument
+    add('package', metavar='PKGNAME',
+        help='The name of the package whose logs are shown.')
+    add('stage', metavar='STAGE', nargs='?', default=None,
+        help='The stage whose log is shown. By default, the logs of all stages are shown '
+             'in the order in which they finished.')
+
+    behavior_group = parser.add_argument_group('Behavior')
+    add = behavior_group.add_argument
+    add('--verb', default='build',
+        help='The verb whose logs are shown. (default: build)')
+    add('--errors', '-e', action='store_true', default=False,
+        help='Only show what the stages wrote to stderr.')
+    add('--tail', '-n', metavar='N', type=int, default=None,
+        help='Only show the last N lines of each log. Of compressed logs, only the blocks holding '
+             'these lines are decompressed.')
+
+    return parser
+
+
+def find_stage_logfiles(job_log_path, verb):
+    """Find the latest logfile of each stage of a verb.
+
+    :returns: list of (stage label, logfile path) tuples, in the order in which the stages finished
+    """
+    logfiles = []
+    for filename in os.listdir(job_log_path):
+        match = LOGFILE_RE.match(filename)
+        if match is None or match.group('verb') != verb or LOGFILE_INDEX_RE.search(match.group('stage')):
+            continue
+        logfile_path = os.path.join(job_log_path, filename)
+        logfiles.append((os.path.getmtime(logfile_path), match.group('stage'), logfile_path))
+    return [(stage_label, logfile_path) for _, stage_label, logfile_path in sorted(logfiles)]
+
+
+def get_stderr_logfile(job_log_path, verb, stage_label):
+    """Get the stderr logfile of the latest run of a stage, or None if it didn't write to stderr."""
+    logfile_indices = (load_log_index(job_log_path) or {}).get('.'.join([verb, stage_label]))
+    if logfile_indices is None:
+        return None
+    stderr_logfile_path = os.path.join(job_log_path, '{}.{}.{:0>{}}{}{}'.format(
+        verb, stage_label, logfile_indices[1], 3, LOGFILE_SUFFIX, STDERR_LOGFILE_SUFFIX))
+    for path in [stderr_logfile_path, stderr_logfile_path + COMPRESSED_LOG_SUFFIX]:
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def write_log(logfile_path, tail=None):
+    """Write the contents of a plain or compressed logfile to stdout."""
+    sys.stdout.flush()
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    if tail is None:
+        for data in iter_log(logfile_path):
+            out.write(data)
+    else:
+        out.writelines(tail_log(logfile_path, tail))
+    out.flush()
+
+
+def main(opts):
+    # Get the workspace (either the given directory or the enclosing ws)
+    workspace_hint = opts.workspace or os.getcwd()
+    workspace = find_enclosing_workspace(workspace_hint)
+
+    if not workspace:
+        print(clr("@{rf}ERROR: No workspace found containing '%s'@|" % workspace_hint), file=sys.stderr)
+        return 1
+
+    ctx = Context.load(workspace, opts.profile, opts, load_env=False)
+
+    job_log_path = os.path.join(ctx.log_space_abs, opts.package)
+    if not os.path.isdir(job_log_path):
+        print(clr("@{rf}ERROR: No logs have been written for package '%s' in '%s'@|" %
+                  (opts.package, ctx.log_space_abs)), file=sys.stderr)
+        return 1
+
+    stage_logfiles = find_stage_logfiles(job_log_path, opts.verb)
+    if opts.stage is not None:
+        selected_logfiles = [(s, p) for s, p in stage_logfiles if s == opts.stage]
+        if len(selected_logfiles) == 0:
+            print(clr("@{rf}ERROR: No `%s` log has been written for stage '%s' of package '%s'. "
+                      "Stages with logs: %s@|" % (
+                          opts.verb, opts.stage, opts.package,
+                          ', '.join([s for s, _ in stage_logfiles]) or 'none')), file=sys.stderr)
+            return 1
+        stage_logfiles = selected_logfiles
+
+    for stage_label, logfile_path in stage_logfiles:
+        if opts.errors:
+            logfile_path = get_stderr_logfile(job_log_path, opts.verb, stage_label)
+            if logfile_path is None:
+                continue
+        if opts.stage is None:
+            print(clr('@!@{cf}{}:{}@| @{kf}{}@|').format(opts.package, stage_label, logfile_path))
+        write_log(logfile_path, opts.tail)
+
+    return 0
@@ -26,7 +26,6 @@ try:
 except ImportError:
     from Queue import Queue # Python2
 
-import catkin_pkg.packages as catkin_packages
 import ckx_tools.argument_parsing as argument_parsing
 import ckx_tools.common as common
 import ckx_tools.execution.job_server as job_server
@@ -38,6 +37,7 @@ from ckx_tools.execution.executor import run_until_complete
 from ckx_tools.execution.jobs import Job
 from ckx_tools.execution.stages import CommandStage
 from ckx_tools.execution.controllers import ConsoleStatusController
+from ckx_tools.package_index import find_workspace_packages
 from ckx_tools.terminal_color import ColorMapper
 from ckx_tools.utils import which
 
@@ -93,7 +93,7 @@ def main(opts):
         gnu_make_enabled=False)
 
     # List of packages, curtail if restricted list is specified
-    packages = catkin_packages.find_packages(context.source_space_abs, exclude_subspaces=True)
+    packages = find_workspace_packages(context, exclude_subspaces=True)
     if opts.packages:
         packages = {k: v for (k, v) in packages.iteritems() if v.name in opts.packages}
 
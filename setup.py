@@ -158,9 +158,11 @@ setup(
             'clean = ckx_tools.verbs.ckx_clean:description',
             'config = ckx_tools.verbs.ckx_config:description',
             'create = ckx_tools.verbs.ckx_create:description',
+            'diagnostics = ckx_tools.verbs.ckx_diagnostics:description',
             'env = ckx_tools.verbs.ckx_env:description',
             'list = ckx_tools.verbs.ckx_list:description',
             'locate = ckx_tools.verbs.ckx_locate:description',
+            'log = ckx_tools.verbs.ckx_log:description',
             'profile = ckx_tools.verbs.ckx_profile:description',
             'rosdep = ckx_tools.verbs.ckx_rosdep:description',
             'rosdoc = ckx_tools.verbs.ckx_rosdoc:description',
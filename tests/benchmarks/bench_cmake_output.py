@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""Benchmark the processing of CMake output by `CMakeIOBufferProtocol`.
+
+The output of a large CMake configure step is recorded once, by configuring a
+generated project with many checks and warnings, or read from a given log.
+The recorded output is then fed to the protocol in pipe-sized chunks, with
+color on and off, and with its output events shown or dropped.
+
+Usage: python tests/benchmarks/bench_cmake_output.py [CONFIGURE_LOG]
+"""
+
+from __future__ import print_function
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from ckx_tools.execution.events import ExecutionEventQueue
+from ckx_tools.jobs.commands.cmake import CMakeIOBufferProtocol
+from ckx_tools.terminal_color import set_color
+
+CHUNK_SIZE = 4096
+N_CHECKS = 500
+N_WARNINGS = 200
+N_REPEATS = 5
+
+
+def record_configure_log(tmp):
+    """Configure a generated CMake project and return its output."""
+    source_path = os.path.join(tmp, 'src')
+    build_path = os.path.join(tmp, 'build')
+    os.makedirs(source_path)
+    os.makedirs(build_path)
+
+    with open(os.path.join(source_path, 'CMakeLists.txt'), 'w') as f:
+        f.write('cmake_minimum_required(VERSION 3.5)\nproject(bench C)\n')
+        f.write('include(CheckIncludeFile)\ninclude(CheckFunctionExists)\n')
+        for i in range(N_CHECKS):
+            f.write('check_include_file(bench_header_{0}.h HAVE_BENCH_HEADER_{0})\n'.format(i))
+            f.write('check_function_exists(bench_function_{0} HAVE_BENCH_FUNCTION_{0})\n'.format(i))
+            f.write('message(STATUS "Configuring component {0} of {1}")\n'.format(i, N_CHECKS))
+        for i in range(N_WARNINGS):
+            f.write('message(WARNING "Deprecated option {0} is used")\n'.format(i))
+            f.write('message(AUTHOR_WARNING "Component {0} has no tests")\n'.format(i))
+
+    process = subprocess.Popen(
+        ['cmake', source_path], cwd=build_path, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.communicate()[0]
+    return source_path, output
+
+
+def run(output, source_path, log_path, shown):
+    chunks = [output[i:i + CHUNK_SIZE] for i in range(0, len(output), CHUNK_SIZE)]
+    best = None
+    for _ in range(N_REPEATS):
+        event_queue = ExecutionEventQueue()
+        if shown:
+            event_queue.subscribe(['STDOUT', 'STDERR'])
+        protocol = CMakeIOBufferProtocol('build', 'bench', 'cmake', event_queue, log_path, source_path)
+        start = time.time()
+        for chunk in chunks:
+            protocol.on_stdout_received(chunk)
+        protocol.flush_tails()
+        protocol.flush_output()
+        elapsed = time.time() - start
+        protocol.close()
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(argv):
+    tmp = tempfile.mkdtemp()
+    try:
+        if len(argv) > 1:
+            source_path = tmp
+            with open(argv[1], 'rb') as f:
+                output = f.read()
+        else:
+            source_path, output = record_configure_log(tmp)
+
+        log_path = os.path.join(tmp, 'logs')
+        os.makedirs(log_path)
+
+        print('{} lines, {} bytes of CMake output'.format(output.count(b'\n'), len(output)))
+        for color in [True, False]:
+            set_color(color)
+            for shown in [True, False]:
+                elapsed = run(output, source_path, log_path, shown)
+                print('color {:<3}, output {:<6}: {:8.2f} ms, {:6.1f} MB/s'.format(
+                    'on' if color else 'off', 'shown' if shown else 'hidden',
+                    1e3 * elapsed, len(output) / elapsed / 1e6))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
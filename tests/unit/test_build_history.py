@@ -0,0 +1,74 @@
+import shutil
+import tempfile
+
+from ckx_tools import build_history
+from ckx_tools.execution.events import ExecutionEvent
+
+
+def _event(event_id, time, **kwargs):
+    event = ExecutionEvent(event_id, **kwargs)
+    event.time = time
+    return event
+
+
+def _record(start, durations):
+    return {
+        'version': build_history.HISTORY_VERSION,
+        'verb': 'build',
+        'start': start,
+        'duration': sum(durations.values()),
+        'max_jobs': 1,
+        'jobs': dict([(jid, {'status': 'succeeded', 'duration': d, 'retcode': 0, 'stages': []})
+                      for jid, d in durations.items()]),
+    }
+
+
+def test_recorder_collects_stage_timing():
+    recorder = build_history.HistoryRecorder('build', fingerprints={'a': 'abc'}, up_to_date_jobs=['b'])
+    for event in [
+            _event('STARTED_JOB', 10.0, job_id='a'),
+            _event('STARTED_STAGE', 10.0, job_id='a', stage_label='cmake'),
+            _event('FINISHED_STAGE', 12.0, job_id='a', stage_label='cmake', retcode=0),
+            _event('STARTED_STAGE', 12.0, job_id='a', stage_label='make'),
+            _event('FINISHED_STAGE', 15.0, job_id='a', stage_label='make', retcode=2),
+            _event('FINISHED_JOB', 15.0, job_id='a', succeeded=False),
+            _event('ABANDONED_JOB', 15.0, job_id='c', reason='DEP_FAILED')]:
+        recorder.handle_event(event)
+
+    jobs = recorder.get_record()['jobs']
+    assert jobs['a'] == {
+        'status': 'failed', 'duration': 5.0, 'retcode': 2, 'fingerprint': 'abc',
+        'stages': [['cmake', 2.0, 0], ['make', 3.0, 2]]}
+    assert jobs['b'] == {'status': 'up-to-date'}
+    assert jobs['c'] == {'status': 'abandoned', 'reason': 'DEP_FAILED'}
+
+
+def test_history_round_trip_and_regressions():
+    log_path = tempfile.mkdtemp()
+    try:
+        for i, duration in enumerate([10.0, 11.0, 10.0, 20.0]):
+            build_history.append_history(log_path, _record(i, {'slow': duration, 'fast': 1.0}))
+        records = build_history.load_history(log_path, 'build')
+        assert len(records) == 4
+
+        assert build_history.get_slowest_jobs(records, 1) == [('slow', 10.5)]
+        assert build_history.get_regressions(records) == [('slow', 20.0, 10.0, True)]
+        assert len(build_history.format_history_report(records, 'slow')) > 0
+    finally:
+        shutil.rmtree(log_path)
+
+
+def test_stage_durations_are_medians_of_successful_runs():
+    records = [_record(float(i), {'a': 1.0}) for i in range(3)]
+    for record, make_duration in zip(records, [10.0, 30.0, 20.0]):
+        record['jobs']['a']['stages'] = [['cmake', 1.0, 0], ['make', make_duration, 0]]
+    records[1]['jobs']['b'] = {'status': 'failed', 'duration': 1.0, 'retcode': 2, 'stages': [['make', 1.0, 2]]}
+
+    assert build_history.get_stage_durations(records) == {'a': {'cmake': 1.0, 'make': 20.0}}
+
+
+def test_job_durations_are_medians_of_recent_successful_runs():
+    records = [_record(float(i), {'a': d}) for i, d in enumerate([100.0, 3.0, 1.0, 2.0])]
+    records[3]['jobs']['b'] = {'status': 'failed', 'duration': 1.0, 'retcode': 2, 'stages': []}
+
+    assert build_history.get_median_job_durations(records, n_records=3) == {'a': 2.0}
@@ -0,0 +1,44 @@
+import shutil
+import tempfile
+
+from ckx_tools.execution.events import ExecutionEventQueue
+from ckx_tools.jobs.commands.cmake import CMakeIOBufferProtocol
+from ckx_tools.terminal_color import set_color
+
+
+def _process(output):
+    tmp = tempfile.mkdtemp()
+    try:
+        protocol = CMakeIOBufferProtocol('build', 'pkg', 'cmake', ExecutionEventQueue(), tmp, '/src')
+        protocol.on_stdout_received(output)
+        protocol.flush_tails()
+        log = protocol.get_stdout_log()
+        protocol.close()
+        return log
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_cmake_lines_are_classified():
+    log = _process(
+        b'-- Found {x}@\n'
+        b'CMake Warning (dev) at CMakeLists.txt:3 (message):\n'
+        b'  warning: deprecated\n'
+        b'Warning: unused\n'
+        b'plain line\n').splitlines()
+    assert log[0] == '\x1b[36m--\x1b[0m Found {x}@'
+    assert log[1] == '\x1b[33m\x1b[1mCMake Warning (dev)\x1b[0m at /src/CMakeLists.txt:3 (message):'
+    assert log[2] == '  warning: deprecated'
+    assert log[3] == '\x1b[33mWarning: unused\x1b[0m'
+    assert log[4] == 'plain line'
+
+
+def test_cmake_output_passes_through_without_color():
+    set_color(False)
+    try:
+        assert _process(b'-- Found x\nplain line\n') == '-- Found x\nplain line\n'
+        # Lines which are rewritten keep their line breaks like the ones which are passed through
+        assert _process(b'CMake Error at a.cmake:2 (include):\n  bad\n') == \
+            'CMake Error at /src/a.cmake:2 (include):\n  bad\n'
+    finally:
+        set_color(True)
@@ -0,0 +1,52 @@
+import gzip
+import os
+import shutil
+import tempfile
+
+from ckx_tools.execution import compressed_log
+
+
+def _lines(n):
+    return [('line %d\n' % i).encode('utf-8') for i in range(n)]
+
+
+def test_compressed_log_roundtrip():
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'build.make.log.gz')
+        writer = compressed_log.CompressedLogWriter(path, block_size=100)
+        lines = _lines(100)
+        for line in lines:
+            writer.write(line)
+        writer.close()
+
+        block_index = compressed_log.load_block_index(path)
+        assert len(block_index) > 1
+        assert sum(b[3] for b in block_index) == 100
+        assert compressed_log.read_log(path) == b''.join(lines)
+
+        # The blocks are gzip members, which can be read by any gzip reader
+        with gzip.open(path, 'rb') as f:
+            assert f.read() == b''.join(lines)
+
+        assert compressed_log.tail_log(path, 3) == lines[-3:]
+        assert compressed_log.tail_log(path, 1000) == lines
+
+        # Without an index, the log is read sequentially
+        os.unlink(path + compressed_log.BLOCK_INDEX_SUFFIX)
+        assert compressed_log.tail_log(path, 3) == lines[-3:]
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_tail_plain_log():
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'build.make.log')
+        lines = _lines(20000)
+        with open(path, 'wb') as f:
+            f.writelines(lines)
+        assert compressed_log.tail_log(path, 5) == lines[-5:]
+        assert compressed_log.read_log(path) == b''.join(lines)
+    finally:
+        shutil.rmtree(tmp)
@@ -0,0 +1,35 @@
+from osrf_pycommon.process_utils import get_loop
+
+from ckx_tools.execution.conflict_locks import ConflictLockGroup
+
+
+def test_only_overlapping_locks_exclude_each_other():
+    loop = get_loop()
+    group = ConflictLockGroup()
+    a = group.lock(['/install/lib/liba.so', '/install/share/a/package.xml'])
+    b = group.lock(['/install/lib/libb.so'])
+    ab = group.lock(['/install/lib/liba.so', '/install/lib/libb.so'])
+    c = group.lock(['/install/lib/libc.so'])
+    unknown = group.lock(None)
+    d = group.lock(['/install/lib/libd.so'])
+
+    futures = [group.request(lock) for lock in [a, b, ab, c, unknown, d]]
+    loop.run_until_complete(futures[0])
+
+    # Disjoint locks are held at the same time, the overlapping one waits
+    assert [f.done() for f in futures] == [True, True, False, True, False, False]
+
+    # Locks which overlap with an earlier waiting lock keep waiting
+    group.release(a)
+    assert [f.done() for f in futures] == [True, True, False, True, False, False]
+    group.release(b)
+    assert futures[2].done()
+
+    # Locks with unknown paths wait for all other locks, and later locks wait for them
+    group.release(ab)
+    group.release(c)
+    assert futures[4].done() and not futures[5].done()
+    group.release(unknown)
+    assert futures[5].done()
+    group.release(d)
+    assert group.n_held == 0 and len(group.held_paths) == 0
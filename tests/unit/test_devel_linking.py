@@ -0,0 +1,203 @@
+import os
+import shutil
+import tempfile
+import threading
+
+from ckx_tools.jobs import catkin
+
+
+class _Logger(object):
+
+    def __init__(self):
+        self.lines = []
+
+    def out(self, line):
+        self.lines.append(line)
+
+    def err(self, line):
+        self.lines.append(line)
+
+
+def _link(tmp):
+    logger = _Logger()
+    assert catkin.link_devel_products(
+        logger, None,
+        package=None,
+        package_path=os.path.join(tmp, 'src', 'pkg'),
+        devel_manifest_path=os.path.join(tmp, 'metadata', 'pkg'),
+        source_devel_path=os.path.join(tmp, 'private', 'pkg'),
+        dest_devel_path=os.path.join(tmp, 'devel'),
+        metadata_path=os.path.join(tmp, 'metadata'),
+        prebuild=False) == 0
+    return logger.lines
+
+
+def _write(path, content):
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def test_link_devel_products_only_touches_changed_files():
+    tmp = tempfile.mkdtemp()
+    try:
+        private = os.path.join(tmp, 'private', 'pkg')
+        devel = os.path.join(tmp, 'devel')
+        os.makedirs(devel)
+        _write(os.path.join(private, 'lib', 'liba.so'), 'a')
+        _write(os.path.join(private, 'lib', 'libb.so'), 'b')
+        _write(os.path.join(private, 'setup.bash'), 'blacklisted')
+
+        lines = _link(tmp)
+        assert sorted(os.listdir(os.path.join(devel, 'lib'))) == ['liba.so', 'libb.so']
+        assert not os.path.exists(os.path.join(devel, 'setup.bash'))
+        assert len([line for line in lines if line.startswith('Symlinking')]) == 2
+
+        # Nothing changed, so nothing is linked again
+        lines = _link(tmp)
+        assert lines == ['Unchanged: 2 linked files']
+
+        # Removed files are unlinked and added files are linked
+        os.unlink(os.path.join(private, 'lib', 'libb.so'))
+        _write(os.path.join(private, 'lib', 'libc.so'), 'c')
+        lines = _link(tmp)
+        assert sorted(os.listdir(os.path.join(devel, 'lib'))) == ['liba.so', 'libc.so']
+        assert 'Symlinking {}'.format(os.path.join(devel, 'lib', 'libc.so')) in lines
+
+        manifest = catkin.read_devel_manifest(os.path.join(tmp, 'metadata', 'pkg', catkin.DEVEL_MANIFEST_FILENAME))
+        assert sorted(manifest) == [os.path.join(devel, 'lib', 'liba.so'), os.path.join(devel, 'lib', 'libc.so')]
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_file_digest():
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'file')
+        _write(path, 'x' * (catkin.DIGEST_BLOCK_SIZE + 1))
+        assert catkin.get_file_digest(path) == catkin.md5(b'x' * (catkin.DIGEST_BLOCK_SIZE + 1)).hexdigest()
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_collisions_are_counted_once_per_package():
+    tmp = tempfile.mkdtemp()
+    try:
+        devel = os.path.join(tmp, 'devel')
+        os.makedirs(devel)
+        metadata = os.path.join(tmp, 'metadata')
+        for pkg in ['a', 'b', 'c']:
+            _write(os.path.join(tmp, 'private', pkg, 'share', 'common.txt'), pkg)
+
+        def link(pkg):
+            return catkin.link_devel_products(
+                _Logger(), None,
+                package=None,
+                package_path=os.path.join(tmp, 'src', pkg),
+                devel_manifest_path=os.path.join(metadata, pkg),
+                source_devel_path=os.path.join(tmp, 'private', pkg),
+                dest_devel_path=devel,
+                metadata_path=metadata,
+                prebuild=False)
+
+        def count():
+            db = catkin.open_devel_collisions(metadata)
+            try:
+                row = db.execute('SELECT count FROM collisions').fetchone()
+                return 0 if row is None else row[0]
+            finally:
+                db.close()
+
+        # Packages link at the same time, one of them owns the link and the others collide
+        threads = [threading.Thread(target=link, args=(pkg,)) for pkg in ['a', 'b', 'c']]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert count() == 2
+
+        # Rebuilding doesn't count the collisions again
+        link('b')
+        assert count() == 2
+
+        # The link is only removed with the last package which links it
+        dest_file = os.path.join(devel, 'share', 'common.txt')
+        for n_collisions, pkg in enumerate(['a', 'b', 'c']):
+            assert os.path.lexists(dest_file)
+            assert catkin.unlink_devel_products(
+                _Logger(), None,
+                devel_space_abs=devel,
+                private_devel_path=os.path.join(tmp, 'private', pkg),
+                metadata_path=metadata,
+                package_metadata_path=os.path.join(metadata, pkg),
+                dry_run=False) == 0
+            assert count() == max(0, 1 - n_collisions)
+        assert not os.path.lexists(dest_file)
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_links_are_kept_when_linking_and_unlinking_at_the_same_time():
+    tmp = tempfile.mkdtemp()
+    try:
+        devel = os.path.join(tmp, 'devel')
+        os.makedirs(devel)
+        metadata = os.path.join(tmp, 'metadata')
+        dest_file = os.path.join(devel, 'share', 'a', 'common.txt')
+        for pkg in ['a', 'b']:
+            _write(os.path.join(tmp, 'private', pkg, 'share', 'a', 'common.txt'), pkg)
+
+        def link(pkg):
+            assert catkin.link_devel_products(
+                _Logger(), None,
+                package=None,
+                package_path=os.path.join(tmp, 'src', pkg),
+                devel_manifest_path=os.path.join(metadata, pkg),
+                source_devel_path=os.path.join(tmp, 'private', pkg),
+                dest_devel_path=devel,
+                metadata_path=metadata,
+                prebuild=False) == 0
+
+        def unlink(pkg):
+            assert catkin.unlink_devel_products(
+                _Logger(), None,
+                devel_space_abs=devel,
+                private_devel_path=os.path.join(tmp, 'private', pkg),
+                metadata_path=metadata,
+                package_metadata_path=os.path.join(metadata, pkg),
+                dry_run=False) == 0
+
+        def count():
+            db = catkin.open_devel_collisions(metadata)
+            try:
+                row = db.execute('SELECT count FROM collisions').fetchone()
+                return 0 if row is None else row[0]
+            finally:
+                db.close()
+
+        # b sees the link of a, which is removed before b counts the collision
+        link('a')
+        source_file = os.path.join(tmp, 'private', 'b', 'share', 'a', 'common.txt')
+        assert catkin._link(_Logger(), source_file, dest_file)
+        unlink('a')
+        assert not os.path.lexists(dest_file)
+        catkin.clean_linked_files(_Logger(), None, metadata, [(source_file, dest_file)], [], dry_run=False)
+        assert os.readlink(dest_file) == source_file
+        assert count() == 0
+
+        # The stages run on different threads
+        link('b')
+        for _ in range(10):
+            unlink('b')
+            shutil.rmtree(os.path.join(metadata, 'b'))
+            link('a')
+            threads = [threading.Thread(target=link, args=('b',)), threading.Thread(target=unlink, args=('a',))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            assert os.path.exists(dest_file)
+            assert count() == 0
+    finally:
+        shutil.rmtree(tmp)
@@ -0,0 +1,44 @@
+import shutil
+import tempfile
+
+from ckx_tools.execution import diagnostics
+from ckx_tools.execution.events import ExecutionEvent
+
+
+def test_extractor_parses_compiler_and_cmake_diagnostics():
+    extractor = diagnostics.DiagnosticsExtractor()
+    extractor.feed('stderr', b'/src/a.h:3:5: warning: unused variable \'x\' [-Wunused-variable]\n/src/b.c')
+    extractor.feed('stdout', b'[ 50%] Building C object b.c.o\n')
+    extractor.feed('stderr', b'pp:7: error: expected \';\'\n/src/a.h:3:5: warning: unused variable \'x\' [-W')
+    extractor.feed('stderr', b'unused-variable]\n\x1b[33m\x1b[1mCMake Warning (dev)\x1b[0m at /src/CMakeLists.txt:4 ')
+    extractor.feed('stderr', b'(message):\n  Something is off\n\nIn file included from /src/b.cpp:1:\n')
+    extractor.feed('stderr', b'CMake Error at /src/CMakeLists.txt:9 (find_package):')
+
+    assert extractor.get_diagnostics() == [
+        ['warning', '-Wunused-variable', '/src/a.h', 3, 5, 'unused variable \'x\'', 2],
+        ['error', '', '/src/b.cpp', 7, 0, 'expected \';\'', 1],
+        ['warning', 'cmake-dev', '/src/CMakeLists.txt', 4, 0, 'Something is off', 1],
+    ]
+    extractor.flush()
+    assert extractor.get_diagnostics()[-1] == ['error', 'cmake', '/src/CMakeLists.txt', 9, 0, '', 1]
+
+
+def test_index_keeps_diagnostics_of_packages_which_were_not_rebuilt():
+    log_path = tempfile.mkdtemp()
+    try:
+        warning = ['warning', '-Wshadow', '/src/a.cpp', 1, 2, 'shadowed', 1]
+        for jids in [['a', 'b'], ['b']]:
+            recorder = diagnostics.DiagnosticsRecorder('build')
+            for jid in jids:
+                recorder.handle_event(ExecutionEvent('STARTED_JOB', job_id=jid))
+                recorder.handle_event(ExecutionEvent(
+                    'FINISHED_STAGE', job_id=jid, stage_label='make', diagnostics=[warning] if jid == 'a' else []))
+            diagnostics.update_diagnostics(log_path, recorder)
+
+        jobs = diagnostics.load_diagnostics(log_path, 'build')
+        assert jobs == {'a': [['make'] + warning]}
+        assert diagnostics.query_diagnostics(jobs, flag='shadow') == [('a', ['make'] + warning)]
+        assert diagnostics.query_diagnostics(jobs, job_ids=['b']) == []
+        assert diagnostics.query_diagnostics(jobs, severity='error') == []
+    finally:
+        shutil.rmtree(log_path)
@@ -0,0 +1,45 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+
+from ckx_tools.argument_parsing import event_log_type
+from ckx_tools.execution.event_log import EventLogWriter
+from ckx_tools.execution.events import ExecutionEvent
+
+
+def test_events_are_written_as_json_lines():
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'logs', 'events.jsonl')
+        writer = EventLogWriter('build', path)
+        writer.handle_event(ExecutionEvent('STARTED_STAGE', job_id='a', stage_label='make'))
+        writer.handle_event(ExecutionEvent(
+            'FINISHED_STAGE', job_id='a', stage_label='make', succeeded=True, retcode=0,
+            stdout='output', stderr='', interleaved='output', logfile_filename='/logs/a/build.make.000.log'))
+        # Lines can be read while the log is being written
+        with open(path) as f:
+            lines = [json.loads(line) for line in f]
+        writer.close()
+
+        assert [line['event'] for line in lines] == ['STARTED_STAGE', 'FINISHED_STAGE']
+        assert lines[0]['verb'] == 'build'
+        assert 0.0 <= lines[0]['elapsed'] <= lines[1]['elapsed']
+        assert lines[1]['data'] == {
+            'job_id': 'a', 'stage_label': 'make', 'succeeded': True, 'retcode': 0,
+            'logfile_filename': '/logs/a/build.make.000.log'}
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_event_log_targets_are_validated():
+    assert event_log_type('events.jsonl') == 'events.jsonl'
+    assert event_log_type('fd:3') == 'fd:3'
+    for target in ['fd:x', 'fd:', 'fd:-1']:
+        try:
+            event_log_type(target)
+        except argparse.ArgumentTypeError:
+            pass
+        else:
+            assert False, target
@@ -0,0 +1,56 @@
+import os
+import shutil
+import tempfile
+
+import mock
+
+from ckx_tools import fingerprint
+
+
+def _write(path, content):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def test_hash_source_tree_reuses_unchanged_digests():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        _write(os.path.join(tmpdir, 'CMakeLists.txt'), 'project(foo)')
+        _write(os.path.join(tmpdir, 'src', 'foo.cpp'), 'int main() {}')
+        _write(os.path.join(tmpdir, '.git', 'HEAD'), 'ref: refs/heads/master')
+        _write(os.path.join(tmpdir, 'scripts', 'foo.pyc'), 'bytecode')
+
+        digest, files = fingerprint.hash_source_tree(tmpdir)
+        assert sorted(files.keys()) == ['CMakeLists.txt', os.path.join('src', 'foo.cpp')]
+
+        # Unchanged files aren't read again
+        with mock.patch.object(fingerprint, '_hash_file') as hash_file:
+            same_digest, _ = fingerprint.hash_source_tree(tmpdir, files)
+            assert not hash_file.called
+        assert same_digest == digest
+
+        # Changed files are
+        _write(os.path.join(tmpdir, 'src', 'foo.cpp'), 'int main() { return 1; }')
+        new_digest, _ = fingerprint.hash_source_tree(tmpdir, files)
+        assert new_digest != digest
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_fingerprints_match():
+    current = {'source': 'a', 'config': 'b', 'deps': [('dep', 'c')]}
+    assert fingerprint.fingerprints_match(current, dict(current, files={}))
+    assert not fingerprint.fingerprints_match(current, None)
+    assert not fingerprint.fingerprints_match(current, dict(current, deps=[('dep', 'd')]))
+
+
+def test_get_make_targets():
+    assert fingerprint.get_make_targets(['-k', 'VERBOSE=1']) == []
+    assert fingerprint.get_make_targets(['run_tests', '-k']) == ['run_tests']
+    # The values of options given as separate arguments aren't targets
+    assert fingerprint.get_make_targets(['-j', '4']) == []
+    assert fingerprint.get_make_targets(['-j', '4', '-l', '8.5', '-C', 'build', '-f', 'Makefile']) == []
+    # Without a value, -j is followed by the targets
+    assert fingerprint.get_make_targets(['-j', 'install']) == ['install']
@@ -0,0 +1,239 @@
+import os
+import shutil
+import tempfile
+import time
+
+import trollius as asyncio
+
+from osrf_pycommon.process_utils import get_loop
+
+from ckx_tools.execution import compressed_log
+from ckx_tools.execution import io
+from ckx_tools.execution.events import ExecutionEventQueue
+
+
+class _Queue(object):
+
+    def __init__(self):
+        self.events = []
+
+    def put(self, event):
+        self.events.append(event)
+
+
+class _SlowFile(object):
+
+    def __init__(self):
+        self.blocks = []
+
+    def write(self, data):
+        time.sleep(0.005)
+        self.blocks.append(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class _FlowControl(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def pause_output(self):
+        self.calls.append('pause')
+
+    def resume_output(self):
+        self.calls.append('resume')
+
+
+def test_chunked_buffer_spills():
+    tmp = tempfile.mkdtemp()
+    try:
+        spill_path = os.path.join(tmp, 'spill')
+        buf = io.ChunkedBuffer(spill_path, max_size=8)
+        buf.write(b'abcd')
+        buf.write(b'efgh')
+        assert not buf.spilled
+        assert buf.getvalue() == b'abcdefgh'
+        buf.write(b'ij')
+        assert buf.spilled
+        assert buf.chunks == []
+        buf.write(b'kl')
+        assert len(buf) == 12
+        assert buf.get_tail() == (4, b'efghijkl')
+        buf.write(b'\nmn')
+        assert buf.get_tail() == (13, b'mn')
+        buf.close()
+        with open(spill_path, 'rb') as f:
+            assert f.read() == b'abcdefghijkl\nmn'
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_large_output_is_passed_on_as_tail():
+    tmp = tempfile.mkdtemp()
+    max_buffer_size = io.MAX_BUFFER_SIZE
+    io.MAX_BUFFER_SIZE = 16
+    try:
+        protocol = io.IOBufferProtocol('build', 'pkg', 'make', _Queue(), tmp)
+        for i in range(10):
+            protocol.on_stdout_received('line {}\n'.format(i).encode('utf-8'))
+        protocol.on_process_exited2(0)
+        protocol.on_process_exited(0)
+
+        tail = '[56 bytes of output omitted, see {}]\nline 8\nline 9\n'.format(protocol.unique_logfile_name)
+        assert protocol.get_stdout_log() == tail
+        assert protocol.get_interleaved_log() == tail
+        protocol.close()
+    finally:
+        io.MAX_BUFFER_SIZE = max_buffer_size
+        shutil.rmtree(tmp)
+
+
+def test_protocol_buffers_lines():
+    tmp = tempfile.mkdtemp()
+    try:
+        queue = _Queue()
+        protocol = io.IOBufferProtocol('build', 'pkg', 'make', queue, tmp)
+        protocol.on_stdout_received(b'one\ntw')
+        protocol.on_stdout_received(b'o')
+        protocol.on_stderr_received(b'warning\n')
+        protocol.on_stdout_received(b'o\nthree')
+        protocol.on_process_exited2(0)
+        protocol.on_process_exited(0)
+
+        # Consecutive output from the same stream is emitted in one batch
+        assert [e.data['data'] for e in queue.events] == ['one\n', 'warning\n', 'twoo\nthree\n']
+        assert protocol.get_stdout_log() == 'one\ntwoo\nthree\n'
+        assert protocol.get_stderr_log() == 'warning\n'
+        assert protocol.get_interleaved_log() == 'one\nwarning\ntwoo\nthree\n'
+
+        protocol.close()
+        with open(protocol.unique_logfile_name + '.stderr', 'rb') as f:
+            assert f.read() == b'warning\n'
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_unwanted_output_events_are_skipped():
+    tmp = tempfile.mkdtemp()
+    try:
+        queue = ExecutionEventQueue()
+        queue.subscribe(['STDERR'])
+        protocol = io.IOBufferProtocol('build', 'pkg', 'make', queue, tmp)
+        protocol.on_stdout_received(b'out\n')
+        protocol.on_stderr_received(b'err\n')
+        protocol.close()
+
+        assert protocol.get_stdout_log() == 'out\n'
+        event = queue.get(False)
+        assert (event.event_id, event.data['data']) == ('STDERR', 'err\n')
+        assert queue.empty()
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_logfile_rotation():
+    tmp = tempfile.mkdtemp()
+    max_logfile_history = io.MAX_LOGFILE_HISTORY
+    try:
+        io.set_max_logfile_history(3)
+        for i in range(5):
+            logger = io.IOBufferLogger('build', 'pkg', 'make', _Queue(), tmp)
+            assert logger.logfile_index == i
+            logger.out('run {}'.format(i))
+            logger.close()
+
+        job_log_path = os.path.join(tmp, 'pkg')
+        assert sorted(os.listdir(job_log_path)) == [
+            '.log_index', 'build.make.002.log', 'build.make.003.log', 'build.make.004.log', 'build.make.log']
+        assert io.load_log_index(job_log_path) == {'build.make': (2, 4)}
+        with open(os.path.join(job_log_path, 'build.make.log')) as f:
+            assert f.read() == 'run 4\n'
+        with open(os.path.join(job_log_path, 'build.make.003.log')) as f:
+            assert f.read() == 'run 3\n'
+
+        # Logfiles without an index are picked up from the log directory
+        os.unlink(os.path.join(job_log_path, '.log_index'))
+        logger = io.IOBufferLogger('build', 'pkg', 'make', _Queue(), tmp)
+        assert (logger.oldest_logfile_index, logger.logfile_index) == (2, 5)
+        logger.close()
+    finally:
+        io.set_max_logfile_history(max_logfile_history)
+        shutil.rmtree(tmp)
+
+
+def test_compressed_logfiles():
+    tmp = tempfile.mkdtemp()
+    try:
+        io.set_compress_logs(True)
+        logger = io.IOBufferLogger('build', 'pkg', 'make', _Queue(), tmp)
+        logger.out('out')
+        logger.err('err')
+        assert logger.get_interleaved_log() == 'out\nerr\n'
+        logger.close()
+
+        job_log_path = os.path.join(tmp, 'pkg')
+        assert sorted(os.listdir(job_log_path)) == [
+            '.log_index',
+            'build.make.000.log.gz', 'build.make.000.log.gz.idx',
+            'build.make.000.log.stderr.gz', 'build.make.000.log.stderr.gz.idx',
+            'build.make.log.gz', 'build.make.log.gz.idx']
+        assert compressed_log.read_log(logger.stderr_logfile_name) == b'err\n'
+    finally:
+        io.set_compress_logs(False)
+        shutil.rmtree(tmp)
+
+
+def test_threaded_logfile():
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'test.log')
+        log_file = io.ThreadedLogFile(open(path, 'wb'), fsync=io.LOG_FSYNC_CLOSE)
+        log_file.write(b'out\n')
+        log_file.write(b'x' * io.LOG_WRITE_SIZE)
+        log_file.write(b'err\n')
+        log_file.flush()
+        with open(path, 'rb') as f:
+            assert f.read() == b'out\n' + b'x' * io.LOG_WRITE_SIZE + b'err\n'
+        log_file.close()
+
+        try:
+            io.set_log_fsync('sometimes')
+            assert False, 'unknown fsync policies should be rejected'
+        except ValueError:
+            pass
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_slow_log_writes_dont_block_the_event_loop():
+    loop = get_loop()
+    log_file = io.ThreadedLogFile(_SlowFile())
+    flow_control = _FlowControl()
+    log_file.set_flow_control(flow_control)
+
+    # Writing the blocks takes a while on the writer thread, but handing them off doesn't
+    n_blocks = 2 * io.MAX_QUEUED_LOG_WRITES
+    start_time = time.time()
+    for i in range(n_blocks):
+        log_file.write(b'x' * io.LOG_WRITE_SIZE)
+    assert time.time() - start_time < n_blocks * 0.005 / 2
+    assert flow_control.calls == ['pause']
+
+    # The event loop keeps running while it waits for the logfile to be closed
+    ticks = []
+
+    def tick():
+        ticks.append(time.time())
+        if not log_file.close_future.done():
+            loop.call_later(0.01, tick)
+
+    loop.call_soon(tick)
+    loop.run_until_complete(asyncio.wrap_future(log_file.close_async(), loop=loop))
+    assert flow_control.calls == ['pause', 'resume']
+    assert len(ticks) > 5
+    assert len(log_file.log_file.blocks) == n_blocks
@@ -0,0 +1,44 @@
+import mock
+
+from ckx_tools.execution import job_server
+from ckx_tools.execution.events import ExecutionEventQueue
+from ckx_tools.execution.job_server import JobServer
+
+
+def test_parse_watermarks():
+    assert job_server.parse_watermarks('8', job_server.parse_load) == (8.0, None)
+    assert job_server.parse_watermarks('8:6.5', job_server.parse_load) == (8.0, 6.5)
+    assert job_server.parse_watermarks('80%:70%', job_server.parse_mem) == (80.0, 70.0)
+    for value in ['8:9', 'high', '8:6:4']:
+        try:
+            job_server.parse_watermarks(value, job_server.parse_load)
+            assert False, value
+        except ValueError:
+            pass
+
+
+def test_load_hysteresis():
+    with mock.patch.object(JobServer, '_start_sampler'):
+        JobServer._set_max_load(4.0, 3.0)
+    try:
+        for load, ok in [(3.5, True), (4.5, False), (3.5, False), (2.5, True), (3.5, True)]:
+            with mock.patch('os.getloadavg', return_value=(0.0, load, 0.0)), \
+                    mock.patch.object(JobServer, '_log_throttling') as log_throttling:
+                JobServer._sample()
+            assert JobServer._check_load() == ok, load
+            assert log_throttling.called == (load in [4.5, 2.5])
+    finally:
+        JobServer._max_load = None
+        JobServer._load_ok = True
+
+
+def test_throttling_messages_are_put_on_the_event_queue():
+    queue = ExecutionEventQueue()
+    job_server.set_event_queue(queue)
+    try:
+        JobServer._log_throttling('throttling, load average 4.50 is above 4.00')
+    finally:
+        job_server.set_event_queue(None)
+    event = queue.get(False)
+    assert event.event_id == 'MESSAGE'
+    assert 'load average 4.50' in event.data['msg']
@@ -0,0 +1,103 @@
+import os
+import shutil
+import tempfile
+
+from ckx_tools.jobs import utils
+
+
+def test_trash_is_emptied_in_the_background():
+    workspace = tempfile.mkdtemp()
+    try:
+        os.makedirs(os.path.join(workspace, 'build', 'pkg'))
+        with open(os.path.join(workspace, 'build', 'pkg', 'CMakeCache.txt'), 'w') as f:
+            f.write('cache')
+        trash_path = utils.get_trash_path(workspace)
+
+        assert utils.move_to_trash(os.path.join(workspace, 'build'), trash_path)
+        assert os.listdir(workspace) == [utils.TRASH_DIR_NAME]
+
+        process = utils.empty_trash_in_background(trash_path)
+        process.wait()
+        assert os.listdir(workspace) == []
+        assert utils.empty_trash_in_background(trash_path) is None
+    finally:
+        shutil.rmtree(workspace)
+
+
+class _Logger(object):
+
+    job_id = 'pkg'
+    stage_label = 'cleaninstall'
+
+    def __init__(self):
+        self.lines = []
+
+    def out(self, line):
+        self.lines.append(line)
+
+    def err(self, line):
+        self.lines.append(line)
+
+
+class _Queue(object):
+
+    def __init__(self):
+        self.events = []
+
+    def put(self, event):
+        self.events.append(event)
+
+
+def test_rmfiles_removes_directories_which_become_empty():
+    install = tempfile.mkdtemp()
+    try:
+        paths = []
+        for i in range(500):
+            paths.append(os.path.join(install, 'share', 'pkg', 'msg', 'M{}.msg'.format(i)))
+        paths.append(os.path.join(install, 'lib', 'libpkg.so'))
+        paths.append(os.path.join(install, 'share', 'pkg', 'package.xml'))
+        # Files of another package
+        other = os.path.join(install, 'lib', 'libother.so')
+        for path in paths + [other]:
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(path)
+
+        assert utils.find_empty_dirs(set(paths), install) == [
+            os.path.join(install, 'share', 'pkg', 'msg'),
+            os.path.join(install, 'share', 'pkg'),
+            os.path.join(install, 'share')]
+
+        queue = _Queue()
+        assert utils.rmfiles(_Logger(), queue, list(paths), dry_run=False, remove_empty=True, empty_root=install) == 0
+        assert os.listdir(install) == ['lib']
+        assert os.listdir(os.path.join(install, 'lib')) == ['libother.so']
+
+        # Progress is reported in percent, and only when it changes
+        percents = [int(e.data['percent']) for e in queue.events]
+        assert percents == sorted(set(percents))
+        assert percents[-1] == 100
+    finally:
+        shutil.rmtree(install)
+
+
+def test_rmfiles_only_trashes_directories_when_given_a_trash_path():
+    workspace = tempfile.mkdtemp()
+    try:
+        trash_path = utils.get_trash_path(workspace)
+        for name in ['a', 'b']:
+            os.makedirs(os.path.join(workspace, 'build', name))
+
+        paths = [os.path.join(workspace, 'build', 'a')]
+        assert utils.rmfiles(_Logger(), _Queue(), paths, dry_run=False, trash_path=trash_path) == 0
+        assert os.listdir(os.path.join(workspace, 'build')) == ['b']
+        assert len(os.listdir(trash_path)) == 1
+
+        # Without a trash path, a later clean deletes the directory right away
+        paths = [os.path.join(workspace, 'build', 'b')]
+        assert utils.rmfiles(_Logger(), _Queue(), paths, dry_run=False) == 0
+        assert os.listdir(os.path.join(workspace, 'build')) == []
+        assert len(os.listdir(trash_path)) == 1
+    finally:
+        shutil.rmtree(workspace)
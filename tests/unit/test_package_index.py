@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+
+import mock
+
+from ckx_tools import package_index
+
+PACKAGE_XML = """<package>
+  <name>{0}</name>
+  <version>0.0.1</version>
+  <description>{0}</description>
+  <maintainer email="maintainer@example.com">Maintainer</maintainer>
+  <license>BSD</license>
+</package>
+"""
+
+
+def _add_package(basepath, path, name):
+    pkg_path = os.path.join(basepath, path)
+    os.makedirs(pkg_path)
+    with open(os.path.join(pkg_path, 'package.xml'), 'w') as f:
+        f.write(PACKAGE_XML.format(name))
+
+
+def test_find_packages_reuses_index():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        src = os.path.join(tmpdir, 'src')
+        index_path = os.path.join(tmpdir, 'index.pickle')
+        _add_package(src, 'pkg1', 'pkg1')
+        _add_package(src, os.path.join('group', 'pkg2'), 'pkg2')
+
+        packages = package_index.find_packages(src, index_path)
+        assert sorted(p.name for p in packages.values()) == ['pkg1', 'pkg2']
+        assert os.path.exists(index_path)
+
+        # Nothing changed, so no manifest should be parsed again
+        with mock.patch.object(package_index, 'parse_package') as parse_package:
+            packages = package_index.find_packages(src, index_path)
+            assert not parse_package.called
+        assert sorted(p.name for p in packages.values()) == ['pkg1', 'pkg2']
+
+        # A new package is picked up, and only its manifest is parsed
+        _add_package(src, os.path.join('group', 'pkg3'), 'pkg3')
+        parse_package = mock.Mock(wraps=package_index.parse_package)
+        with mock.patch.object(package_index, 'parse_package', parse_package):
+            packages = package_index.find_packages(src, index_path)
+            assert parse_package.call_count == 1
+        assert sorted(p.name for p in packages.values()) == ['pkg1', 'pkg2', 'pkg3']
+
+        # Ignored directories are dropped from the index
+        open(os.path.join(src, 'group', 'CATKIN_IGNORE'), 'w').close()
+        packages = package_index.find_packages(src, index_path)
+        assert sorted(p.name for p in packages.values()) == ['pkg1']
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_find_packages_corrupt_index():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        src = os.path.join(tmpdir, 'src')
+        index_path = os.path.join(tmpdir, 'index.pickle')
+        _add_package(src, 'pkg1', 'pkg1')
+        with open(index_path, 'w') as f:
+            f.write('not a pickle')
+
+        packages = package_index.find_packages(src, index_path)
+        assert [p.name for p in packages.values()] == ['pkg1']
+    finally:
+        shutil.rmtree(tmpdir)
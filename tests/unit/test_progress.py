@@ -0,0 +1,56 @@
+from ckx_tools.execution.progress import EtaEstimator
+from ckx_tools.jobs.commands.cmake import MakeProgressTracker
+
+
+class _Stage(object):
+
+    def __init__(self, label):
+        self.label = label
+
+
+class _Job(object):
+
+    def __init__(self, jid, stage_labels):
+        self.jid = jid
+        self.stages = [_Stage(label) for label in stage_labels]
+
+
+def test_make_progress_is_parsed_from_every_line():
+    tracker = MakeProgressTracker()
+    assert tracker.feed(b'Scanning dependencies of target a\n[  5%] Building CXX object a.dir/a.cpp.o\n[ 1')
+    assert tracker.percent == 5
+    assert tracker.units == 1
+    # Split progress prefixes are parsed once their line is complete
+    assert not tracker.feed(b'0%] Buil')
+    assert tracker.feed(b'ding C object b.dir/b.c.o\n[  7%] Building C object b.dir/c.c.o\n')
+    assert tracker.percent == 10
+    assert tracker.units == 3
+    # Interleaved output of parallel targets doesn't make the progress go back
+    assert not tracker.feed(b'[  8%] Linking CXX executable a\n')
+    assert tracker.percent == 10
+    assert tracker.units == 3
+
+
+def test_eta_blends_progress_and_history():
+    estimator = EtaEstimator(
+        [_Job('a', ['cmake', 'make', 'install']), _Job('b', ['cmake', 'make'])],
+        {'a': {'cmake': 2.0, 'make': 20.0, 'install': 1.0}},
+        max_jobs=2)
+
+    # Without progress, the previous duration is counted down
+    assert estimator.stage_remaining('a', 'make', 5.0, '', 100.0) == 15.0
+    estimator.forget('a')
+    # Halfway through, progress and history are weighted equally
+    remaining = estimator.stage_remaining('a', 'make', 5.0, '50', 100.0)
+    assert remaining == 0.5 * 5.0 + 0.5 * 15.0
+    assert estimator.job_remaining('a', 'make', remaining) == remaining + 1.0
+    # Jobs without history are expected to take as long as the median job
+    assert estimator.total_remaining({'a': 11.0}, ['b']) == 23.0
+    # Stages without progress or history can't be estimated
+    assert estimator.stage_remaining('b', 'make', 5.0, '', 100.0) is None
+
+
+def test_eta_is_unknown_without_history():
+    estimator = EtaEstimator([_Job('a', ['make'])])
+    assert estimator.stage_remaining('a', 'make', 10.0, '25', 100.0) == 30.0
+    assert estimator.total_remaining({'a': 30.0}, []) is None
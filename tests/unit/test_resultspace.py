@@ -0,0 +1,111 @@
+import os
+import shutil
+import tempfile
+
+import mock
+
+from ckx_tools import resultspace
+
+
+def _make_resultspace(path, underlay=None):
+    os.makedirs(os.path.join(path, 'etc', 'catkin', 'profile.d'))
+    open(os.path.join(path, '.catkin'), 'w').close()
+    with open(os.path.join(path, 'env.sh'), 'w') as f:
+        f.write('#!/bin/sh\nexport FOO=bar\nunset BAZ\n')
+        if underlay is not None:
+            f.write('export CMAKE_PREFIX_PATH={}:{}\n'.format(path, underlay))
+        f.write('exec "$@"\n')
+    os.chmod(os.path.join(path, 'env.sh'), 0o755)
+
+
+def test_env_delta_round_trip():
+    base_env = {'A': '1', 'B': '2', 'PWD': '/tmp'}
+    result_env = {'A': '1', 'C': '3'}
+    delta = resultspace.get_env_delta(base_env, result_env)
+    assert delta == ({'C': '3'}, ['B'])
+    assert resultspace.apply_env_delta(dict(base_env, D='4'), delta) == {'A': '1', 'C': '3', 'D': '4'}
+
+
+def test_composable_env_delta_keeps_other_entries():
+    base_env = {'PATH': '/usr/bin', 'CMAKE_PREFIX_PATH': '/opt/ros', 'ROS_DISTRO': 'indigo'}
+    # A dependency prepends its own prefix and changes a plain variable
+    delta = resultspace.get_composable_env_delta(base_env, {
+        'PATH': '/ws/b/bin:/usr/bin',
+        'CMAKE_PREFIX_PATH': '/ws/b:/opt/ros',
+        'ROS_DISTRO': 'jade'})
+
+    # Applied on top of another dependency, the entries of both are kept
+    env = dict(base_env, PATH='/ws/a/bin:/usr/bin', CMAKE_PREFIX_PATH='/ws/a:/opt/ros')
+    assert resultspace.apply_composable_env_delta(env, delta) == {
+        'PATH': '/ws/b/bin:/ws/a/bin:/usr/bin',
+        'CMAKE_PREFIX_PATH': '/ws/b:/ws/a:/opt/ros',
+        'ROS_DISTRO': 'jade'}
+
+
+def test_composable_env_deltas_compose_new_path_lists():
+    # Two dependencies both set up a path list which isn't in the base environment
+    base_env = {'PATH': '/usr/bin'}
+    delta_a = resultspace.get_composable_env_delta(base_env, dict(base_env, PYTHONPATH='/ws/a/lib'))
+    delta_b = resultspace.get_composable_env_delta(base_env, dict(base_env, PYTHONPATH='/ws/b/lib'))
+    assert delta_a == {'PYTHONPATH': ([], ['/ws/a/lib'], [])}
+
+    env = resultspace.apply_composable_env_delta(resultspace.apply_composable_env_delta(base_env, delta_a), delta_b)
+    assert env == {'PATH': '/usr/bin', 'PYTHONPATH': '/ws/b/lib:/ws/a/lib'}
+
+
+def test_cached_environment_is_persistent():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        result_space_path = os.path.join(tmpdir, 'devel')
+        cache_path = os.path.join(tmpdir, 'env_cache')
+        _make_resultspace(result_space_path)
+        base_env = {'PATH': os.environ.get('PATH', ''), 'BAZ': 'qux', 'SHELL': '/bin/bash'}
+
+        env = resultspace.get_resultspace_environment(result_space_path, base_env=base_env, cache_path=cache_path)
+        assert env['FOO'] == 'bar'
+        assert 'BAZ' not in env
+
+        # Another invocation re-uses the environment from disk without spawning a shell
+        resultspace._resultspace_env_cache.clear()
+        with mock.patch('subprocess.Popen') as popen:
+            cached_env = resultspace.get_resultspace_environment(
+                result_space_path, base_env=dict(base_env, OLDPWD='/'), cache_path=cache_path)
+            assert not popen.called
+        assert cached_env == dict(env, OLDPWD='/')
+
+        # A change to the setup files invalidates the cached environment
+        os.utime(os.path.join(result_space_path, 'env.sh'), (0, 0))
+        with mock.patch('subprocess.Popen') as popen:
+            popen.return_value.communicate.return_value = (b'declare -x FOO="baz"\n', None)
+            env = resultspace.get_resultspace_environment(result_space_path, base_env=base_env, cache_path=cache_path)
+            assert popen.called
+        assert env['FOO'] == 'baz'
+    finally:
+        resultspace._resultspace_env_cache.clear()
+        shutil.rmtree(tmpdir)
+
+
+def test_cached_environment_tracks_underlays():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        underlay_path = os.path.join(tmpdir, 'underlay')
+        result_space_path = os.path.join(tmpdir, 'devel')
+        _make_resultspace(underlay_path)
+        _make_resultspace(result_space_path, underlay=underlay_path)
+        base_env = {'PATH': os.environ.get('PATH', ''), 'SHELL': '/bin/bash'}
+
+        env = resultspace.get_resultspace_environment(result_space_path, base_env=base_env)
+        assert resultspace.get_prefix_paths(env) == [result_space_path, underlay_path]
+        with mock.patch('subprocess.Popen') as popen:
+            resultspace.get_resultspace_environment(result_space_path, base_env=base_env)
+            assert not popen.called
+
+        # A new folder in the underlay, which its setup files would add to PATH, invalidates the environment
+        os.mkdir(os.path.join(underlay_path, 'bin'))
+        with mock.patch('subprocess.Popen') as popen:
+            popen.return_value.communicate.return_value = (b'declare -x FOO="baz"\n', None)
+            resultspace.get_resultspace_environment(result_space_path, base_env=base_env)
+            assert popen.called
+    finally:
+        resultspace._resultspace_env_cache.clear()
+        shutil.rmtree(tmpdir)
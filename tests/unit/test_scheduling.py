@@ -0,0 +1,35 @@
+from ckx_tools.execution.jobs import Job
+from ckx_tools.execution import scheduling
+
+
+def _jobs(deps):
+    return [Job(jid, jid_deps, None, []) for jid, jid_deps in deps]
+
+
+def test_critical_path_priorities():
+    # a -> b -> c is a chain, d is independent
+    jobs = _jobs([('a', []), ('d', []), ('b', ['a']), ('c', ['b'])])
+
+    weights, from_history = scheduling.get_job_weights(jobs, {})
+    assert not from_history
+    priorities = scheduling.get_critical_path_priorities(jobs, weights)
+    assert priorities == {'a': 3.0, 'b': 2.0, 'c': 1.0, 'd': 1.0}
+
+
+def test_get_job_weights_fills_unknown_with_mean():
+    jobs = _jobs([('a', []), ('b', []), ('c', [])])
+    weights, from_history = scheduling.get_job_weights(jobs, {'a': 2.0, 'b': 4.0})
+    assert from_history
+    assert weights == {'a': 2.0, 'b': 4.0, 'c': 3.0}
+
+
+def test_critical_path_beats_fifo():
+    # A long chain which is listed after a batch of short independent jobs
+    jobs = _jobs([('s1', []), ('s2', []), ('long1', []), ('long2', ['long1'])])
+    weights = {'s1': 1.0, 's2': 1.0, 'long1': 5.0, 'long2': 5.0}
+    priorities = scheduling.get_critical_path_priorities(jobs, weights)
+
+    fifo = scheduling.estimate_wall_time(jobs, weights, 2)
+    critical_path = scheduling.estimate_wall_time(jobs, weights, 2, priorities)
+    assert fifo == 11.0
+    assert critical_path == 10.0
@@ -0,0 +1,19 @@
+import os
+import signal
+
+import mock
+
+from ckx_tools import common
+
+
+def test_terminal_width_is_cached_until_resized():
+    assert common.cache_terminal_width()
+    with mock.patch.object(common, 'terminal_width_linux', return_value=100) as query:
+        with mock.patch.object(common, 'terminal_width_windows', return_value=100):
+            os.kill(os.getpid(), signal.SIGWINCH)
+            assert common.terminal_width() == 100
+            assert common.terminal_width() == 100
+            assert query.call_count <= 1
+            query.return_value = 120
+            os.kill(os.getpid(), signal.SIGWINCH)
+            assert common.terminal_width() == 120
@@ -0,0 +1,49 @@
+from ckx_tools.execution.events import ExecutionEvent
+from ckx_tools.execution.jobs import Job
+from ckx_tools.execution.stages import FunctionStage
+from ckx_tools.execution import trace
+
+
+def _event(event_id, time, **kwargs):
+    event = ExecutionEvent(event_id, **kwargs)
+    event.time = time
+    return event
+
+
+def _noop(logger, event_queue):
+    return 0
+
+
+def test_trace_lanes_follow_tokens():
+    jobs = [
+        Job(jid, [], None, [
+            FunctionStage('make', _noop),
+            FunctionStage('install', _noop, occupy_job=False, locked_resource='installspace')])
+        for jid in ['a', 'b']]
+    recorder = trace.TraceRecorder('build', jobs, start_time=0.0)
+
+    for event in [
+            _event('STARTED_JOB', 0.0, job_id='a'),
+            _event('STARTED_STAGE', 0.0, job_id='a', stage_label='make'),
+            _event('STARTED_JOB', 1.0, job_id='b'),
+            _event('STARTED_STAGE', 1.0, job_id='b', stage_label='make'),
+            _event('FINISHED_STAGE', 2.0, job_id='a', stage_label='make', retcode=0),
+            _event('STARTED_STAGE', 2.0, job_id='a', stage_label='install'),
+            _event('FINISHED_STAGE', 3.0, job_id='b', stage_label='make', retcode=0),
+            _event('FINISHED_STAGE', 4.0, job_id='a', stage_label='install', retcode=0),
+            _event('FINISHED_JOB', 4.0, job_id='a', succeeded=True),
+            _event('STARTED_STAGE', 4.0, job_id='b', stage_label='install'),
+            _event('FINISHED_STAGE', 5.0, job_id='b', stage_label='install', retcode=0),
+            _event('FINISHED_JOB', 5.0, job_id='b', succeeded=True)]:
+        recorder.handle_event(event)
+
+    spans = dict([((e['name'], e['pid']), e) for e in recorder.get_trace()['traceEvents'] if e['ph'] == 'X'])
+
+    # Both compile stages hold a token, on separate workers
+    assert spans[('a:make', trace.WORKERS_PID)]['tid'] == 0
+    assert spans[('b:make', trace.WORKERS_PID)]['tid'] == 1
+    # Install stages give back their token and run on their own lanes
+    assert spans[('a:install', trace.UNTOKENED_PID)]['dur'] == 2000000
+    # The second install stage waited for the lock held by the first one
+    wait = spans[('waiting for lock `installspace`', trace.JOBS_PID)]
+    assert (wait['ts'], wait['dur']) == (3000000, 1000000)